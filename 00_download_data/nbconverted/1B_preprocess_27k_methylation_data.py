@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 import mpmp.config as cfg
+import mpmp.utilities.methylation_utilities as mu
 import mpmp.utilities.tcga_utilities as tu
 
 
@@ -149,21 +150,15 @@ axarr[1].set_title('Methylation NA count per sample, >500 NA values')
 # to explore this, we'll remove samples in descending order of their
 # NA count, and see how many additional probes (predictors) this filtering
 # gives us
-def filter_bad_samples(methylation_df, bad_samples):
-    return (
-        methylation_df.copy()
-                      .loc[~methylation_df.index.isin(bad_samples)]
-                      .dropna(axis='columns')
-    )
+#
+# rather than filtering the data once for each number of removed samples,
+# this calculates the number of valid probes for every number of removed
+# samples in a single pass over the data
+probe_counts = mu.get_probe_count_curve(tcga_methylation_df.values.T)
 
 def count_probes_for_range(sample_counts):
-    probe_sample_count = []
-    sample_sorted = sample_na.sort_values(ascending=False)
-    for filter_count in sample_counts:
-        bad_samples = sample_sorted.iloc[:filter_count].index.values
-        filtered_df = filter_bad_samples(tcga_methylation_df, bad_samples)
-        probe_sample_count.append((filter_count, len(filtered_df.columns)))
-    return list(zip(*probe_sample_count))
+    sample_counts = list(sample_counts)
+    return [tuple(sample_counts), tuple(probe_counts[sample_counts])]
 
 probe_counts_small = count_probes_for_range(range(20))
 probe_counts_large = count_probes_for_range(range(0, 510, 10))
@@ -21,6 +21,8 @@ from mpmp.exceptions import (
 from mpmp.utilities.classify_utilities import run_cv_stratified
 import mpmp.utilities.data_utilities as du
 import mpmp.utilities.file_utilities as fu
+import mpmp.utilities.resource_utilities as ru
+import mpmp.utilities.scheduler_utilities as sch
 from mpmp.utilities.tcga_utilities import get_overlap_data_types
 
 def process_args():
@@ -39,6 +41,10 @@ def process_args():
     io.add_argument('--cancer_types', nargs='*',
                     help='cancer types to predict, if not included predict '
                         'all cancer types in TCGA')
+    io.add_argument('--cores', type=int, default=None,
+                    help='number of cores to use for model training, split '
+                         'between worker processes and BLAS threads '
+                         '(default: all available cores)')
     io.add_argument('--log_file', default=None,
                     help='name of file to log skipped cancer types to')
     io.add_argument('--output_preds', action='store_true')
@@ -60,15 +66,55 @@ def process_args():
     opts.add_argument('--num_folds', type=int, default=4,
                       help='number of folds of cross-validation to run')
     opts.add_argument('--seed', type=int, default=cfg.default_seed)
+    opts.add_argument('--seeds', type=int, nargs='+', default=None,
+                      help='run experiments for each of these seeds in turn, '
+                           'loading data only once (overrides --seed)')
+    opts.add_argument('--search', type=str, default=cfg.default_search,
+                      choices=cfg.search_methods,
+                      help='grid: fit every hyperparameter combination, '
+                           'halving: successive halving, starting with a small '
+                           'budget (only for --solver sgd)')
+    opts.add_argument('--solver', type=str, default=cfg.default_solver,
+                      choices=cfg.solvers,
+                      help='sgd: fit SGDClassifier for each hyperparameter '
+                           'combination, path: fit regularization path for '
+                           'each l1_ratio with warm starts, prox: fit with '
+                           'proximal gradient descent, stream: fit on batches '
+                           'of samples read from disk, to limit memory usage, '
+                           'gram: fit quadratic approximation using feature '
+                           'covariances cached across genes')
     opts.add_argument('--subset_mad_genes', type=int, default=cfg.num_features_raw,
                       help='if included, subset gene features to this number of '
                            'features having highest mean absolute deviation')
     opts.add_argument('--training_data', type=str, default='expression',
                       choices=list(cfg.data_types.keys()),
                       help='what data type to train model on')
+    opts.add_argument('--warm_start', action='store_true',
+                      help='initialize the fits for each outer CV fold from '
+                           'the previous fold\'s solutions (only for --solver '
+                           'path)')
+    opts.add_argument('--workers', type=int, default=1,
+                      help='if greater than 1, run all experiments in parallel '
+                           'on this many worker processes, rather than one at '
+                           'a time')
 
     args = parser.parse_args()
 
+    if args.seeds is None:
+        args.seeds = [args.seed]
+    args.seed = args.seeds[0]
+
+    if args.cores is not None and args.workers > args.cores:
+        parser.error('--workers must be at most --cores')
+    if args.search != 'grid' and args.solver != 'sgd':
+        parser.error('--search {} is only supported for --solver sgd'.format(
+            args.search))
+    if args.warm_start and args.solver not in cfg.warm_start_solvers:
+        parser.error('--warm_start is only supported for --solver {}'.format(
+            ' or '.join(cfg.warm_start_solvers)))
+    if args.warm_start and args.workers > 1:
+        parser.error('--warm_start is not supported with --workers > 1')
+
     args.results_dir = Path(args.results_dir).resolve()
 
     if args.log_file is None:
@@ -96,6 +142,15 @@ def process_args():
     model_options.l1_ratios = cfg.l1_ratios
     model_options.standardize_data_types = cfg.standardize_data_types
 
+    # set the core budget for training, and record how it's split between
+    # worker processes and threads (the budget doesn't affect model output,
+    # but the effective configuration is saved with the model options)
+    io_args.cores = ru.set_core_budget(io_args.cores)
+    model_options.resource_info = ru.get_resource_info(
+        n_tasks=cfg.folds * len(cfg.alphas) * len(cfg.l1_ratios),
+        n_workers=model_options.workers
+    )
+
     # add information about valid samples to model options
     model_options.sample_overlap_data_types = list(
         get_overlap_data_types(debug=model_options.debug).keys()
@@ -113,9 +168,11 @@ if __name__ == '__main__':
     experiment_dir = Path(io_args.results_dir, 'cancer_type').resolve()
     experiment_dir.mkdir(parents=True, exist_ok=True)
 
-    # save model options for this experiment
+    # save model options for this experiment, for each seed
     # (hyperparameters, preprocessing info, etc)
-    fu.save_model_options(experiment_dir, model_options)
+    for seed in model_options.seeds:
+        model_options.seed = seed
+        fu.save_model_options(experiment_dir, model_options)
 
     # create empty error log file if it doesn't exist
     log_columns = [
@@ -142,79 +199,148 @@ if __name__ == '__main__':
     # - for true labels and shuffled labels
     #   (shuffled labels acts as our lower baseline)
     # - for all cancer types in the given list of TCGA cancers
-    for shuffle_labels in (False, True):
-
-        print('shuffle_labels: {}'.format(shuffle_labels))
-
-        progress = tqdm(io_args.cancer_types,
-                        total=len(io_args.cancer_types),
-                        ncols=100,
-                        file=sys.stdout)
-
-        for cancer_type in progress:
-            cancer_type_log_df = None
-            progress.set_description('cancer type: {}'.format(cancer_type))
-
-            try:
-                cancer_type_dir = fu.make_output_dir(experiment_dir, cancer_type)
-                check_file = fu.check_output_file(cancer_type_dir,
-                                                  cancer_type,
-                                                  shuffle_labels,
-                                                  model_options)
-                tcga_data.process_data_for_cancer_type(cancer_type,
-                                                       cancer_type_dir,
-                                                       shuffle_labels=shuffle_labels)
-            except ResultsFileExistsError:
-                # this happens if cross-validation for this cancer type has
-                # already been run (i.e. the results file already exists)
+    #
+    # for now, don't standardize methylation data
+    standardize_columns = (model_options.training_data in
+                           cfg.standardize_data_types)
+
+    if model_options.workers > 1:
+        for seed in model_options.seeds:
+            tcga_data.set_seed(seed)
+            model_options.seed = seed
+
+            # run all experiments (and all folds/grid points within them)
+            # as a single graph of tasks, see scheduler_utilities.py
+            experiments = []
+            for shuffle_labels in (False, True):
+                for cancer_type in io_args.cancer_types:
+                    try:
+                        cancer_type_dir = fu.make_output_dir(experiment_dir,
+                                                             cancer_type)
+                        check_file = fu.check_output_file(cancer_type_dir,
+                                                          cancer_type,
+                                                          shuffle_labels,
+                                                          model_options)
+                    except ResultsFileExistsError:
+                        if io_args.verbose:
+                            print('Skipping because results file exists already: '
+                                  'cancer type {}'.format(cancer_type), file=sys.stderr)
+                        cancer_type_log_df = fu.generate_log_df(
+                            log_columns,
+                            [cancer_type, model_options.training_data, shuffle_labels, 'file_exists']
+                        )
+                        fu.write_log_file(cancer_type_log_df, io_args.log_file)
+                        continue
+                    experiments.append((cancer_type,
+                                        None,
+                                        cancer_type_dir,
+                                        check_file,
+                                        shuffle_labels))
+
+            errors, stage_report = sch.run_gene_experiments(
+                tcga_data,
+                experiments,
+                sample_info_df,
+                model_options,
+                exp_string='cancer_type',
+                standardize_columns=standardize_columns,
+                output_preds=io_args.output_preds,
+                n_workers=model_options.workers,
+                progress=True
+            )
+            for (cancer_type, shuffle_labels), error in errors.items():
+                skip_reason = sch.get_skip_reason(error)
                 if io_args.verbose:
-                    print('Skipping because results file exists already: '
-                          'cancer type {}'.format(cancer_type), file=sys.stderr)
+                    print('Skipping cancer type {} (shuffle_labels: {}): {}'.format(
+                        cancer_type, shuffle_labels, skip_reason), file=sys.stderr)
                 cancer_type_log_df = fu.generate_log_df(
                     log_columns,
-                    [cancer_type, model_options.training_data, shuffle_labels, 'file_exists']
+                    [cancer_type, model_options.training_data, shuffle_labels, skip_reason]
                 )
                 fu.write_log_file(cancer_type_log_df, io_args.log_file)
-                continue
-
-            try:
-                # for now, don't standardize methylation data
-                standardize_columns = (model_options.training_data in
-                                       cfg.standardize_data_types)
-                results = run_cv_stratified(tcga_data,
-                                            'cancer_type',
-                                            cancer_type,
-                                            model_options.training_data,
-                                            sample_info_df,
-                                            model_options.num_folds,
-                                            shuffle_labels,
-                                            standardize_columns,
-                                            io_args.output_preds)
-                # only save results if no exceptions
-                fu.save_results(cancer_type_dir,
-                                check_file,
-                                results,
-                                'cancer_type',
-                                cancer_type,
-                                shuffle_labels,
-                                model_options)
-            except NoTestSamplesError:
-                if io_args.verbose:
-                    print('Skipping due to no test samples: cancer type '
-                          '{}'.format(cancer_type), file=sys.stderr)
-                cancer_type_log_df = fu.generate_log_df(
-                    log_columns,
-                    [cancer_type, model_options.training_data, shuffle_labels, 'no_test_samples']
-                )
-            except OneClassError:
-                if io_args.verbose:
-                    print('Skipping due to one holdout class: cancer type '
-                          '{}'.format(cancer_type), file=sys.stderr)
-                cancer_type_log_df = fu.generate_log_df(
-                    log_columns,
-                    [cancer_type, model_options.training_data, shuffle_labels, 'one_class']
-                )
 
-            if cancer_type_log_df is not None:
-                fu.write_log_file(cancer_type_log_df, io_args.log_file)
+            print('Worker utilization by stage:')
+            print(stage_report.to_string(float_format='%.3f'))
+
+    else:
+        for shuffle_labels in (False, True):
+
+            print('shuffle_labels: {}'.format(shuffle_labels))
+
+            progress = tqdm(io_args.cancer_types,
+                            total=len(io_args.cancer_types),
+                            ncols=100,
+                            file=sys.stdout)
+
+            for cancer_type in progress:
+                progress.set_description('cancer type: {}'.format(cancer_type))
+
+                for seed in model_options.seeds:
+                    cancer_type_log_df = None
+                    tcga_data.set_seed(seed)
+                    model_options.seed = seed
+
+                    try:
+                        cancer_type_dir = fu.make_output_dir(experiment_dir, cancer_type)
+                        check_file = fu.check_output_file(cancer_type_dir,
+                                                          cancer_type,
+                                                          shuffle_labels,
+                                                          model_options)
+                        tcga_data.set_experiment_seed(cancer_type, shuffle_labels)
+                        tcga_data.process_data_for_cancer_type(cancer_type,
+                                                               cancer_type_dir,
+                                                               shuffle_labels=shuffle_labels)
+                    except ResultsFileExistsError:
+                        # this happens if cross-validation for this cancer type has
+                        # already been run (i.e. the results file already exists)
+                        if io_args.verbose:
+                            print('Skipping because results file exists already: '
+                                  'cancer type {}'.format(cancer_type), file=sys.stderr)
+                        cancer_type_log_df = fu.generate_log_df(
+                            log_columns,
+                            [cancer_type, model_options.training_data, shuffle_labels, 'file_exists']
+                        )
+                        fu.write_log_file(cancer_type_log_df, io_args.log_file)
+                        continue
+
+                    try:
+                        results = run_cv_stratified(tcga_data,
+                                                    'cancer_type',
+                                                    cancer_type,
+                                                    model_options.training_data,
+                                                    sample_info_df,
+                                                    model_options.num_folds,
+                                                    shuffle_labels,
+                                                    standardize_columns,
+                                                    io_args.output_preds,
+                                                    solver=model_options.solver,
+                                                    search=model_options.search,
+                                                    warm_start=model_options.warm_start)
+                        # only save results if no exceptions
+                        fu.save_results(cancer_type_dir,
+                                        check_file,
+                                        results,
+                                        'cancer_type',
+                                        cancer_type,
+                                        shuffle_labels,
+                                        model_options)
+                    except NoTestSamplesError:
+                        if io_args.verbose:
+                            print('Skipping due to no test samples: cancer type '
+                                  '{}'.format(cancer_type), file=sys.stderr)
+                        cancer_type_log_df = fu.generate_log_df(
+                            log_columns,
+                            [cancer_type, model_options.training_data, shuffle_labels, 'no_test_samples']
+                        )
+                    except OneClassError:
+                        if io_args.verbose:
+                            print('Skipping due to one holdout class: cancer type '
+                                  '{}'.format(cancer_type), file=sys.stderr)
+                        cancer_type_log_df = fu.generate_log_df(
+                            log_columns,
+                            [cancer_type, model_options.training_data, shuffle_labels, 'one_class']
+                        )
+
+                    if cancer_type_log_df is not None:
+                        fu.write_log_file(cancer_type_log_df, io_args.log_file)
 
@@ -19,6 +19,8 @@ from mpmp.exceptions import (
 from mpmp.utilities.classify_utilities import run_cv_stratified
 import mpmp.utilities.data_utilities as du
 import mpmp.utilities.file_utilities as fu
+import mpmp.utilities.resource_utilities as ru
+import mpmp.utilities.scheduler_utilities as sch
 from mpmp.utilities.tcga_utilities import get_overlap_data_types
 
 def process_args():
@@ -34,6 +36,10 @@ def process_args():
     io = parser.add_argument_group('io',
                                    'arguments related to script input/output, '
                                    'note these will *not* be saved in metadata ')
+    io.add_argument('--cores', type=int, default=None,
+                    help='number of cores to use for model training, split '
+                         'between worker processes and BLAS threads '
+                         '(default: all available cores)')
     io.add_argument('--log_file', default=None,
                     help='name of file to log errors to')
     io.add_argument('--output_preds', action='store_true')
@@ -55,6 +61,23 @@ def process_args():
     opts.add_argument('--num_folds', type=int, default=4,
                       help='number of folds of cross-validation to run')
     opts.add_argument('--seed', type=int, default=cfg.default_seed)
+    opts.add_argument('--seeds', type=int, nargs='+', default=None,
+                      help='run experiments for each of these seeds in turn, '
+                           'loading data only once (overrides --seed)')
+    opts.add_argument('--search', type=str, default=cfg.default_search,
+                      choices=cfg.search_methods,
+                      help='grid: fit every hyperparameter combination, '
+                           'halving: successive halving, starting with a small '
+                           'budget (only for --solver sgd)')
+    opts.add_argument('--solver', type=str, default=cfg.default_solver,
+                      choices=cfg.solvers,
+                      help='sgd: fit SGDClassifier for each hyperparameter '
+                           'combination, path: fit regularization path for '
+                           'each l1_ratio with warm starts, prox: fit with '
+                           'proximal gradient descent, stream: fit on batches '
+                           'of samples read from disk, to limit memory usage, '
+                           'gram: fit quadratic approximation using feature '
+                           'covariances cached across genes')
     opts.add_argument('--subset_mad_genes', type=int, default=cfg.num_features_raw,
                       help='if included, subset gene features to this number of '
                            'features having highest mean absolute deviation')
@@ -63,9 +86,32 @@ def process_args():
                       help='what data type to train model on')
     opts.add_argument('--use_compressed', action='store_true',
                       help='use PCA compressed data rather than raw features')
+    opts.add_argument('--warm_start', action='store_true',
+                      help='initialize the fits for each outer CV fold from '
+                           'the previous fold\'s solutions (only for --solver '
+                           'path)')
+    opts.add_argument('--workers', type=int, default=1,
+                      help='if greater than 1, run all experiments in parallel '
+                           'on this many worker processes, rather than one at '
+                           'a time')
 
     args = parser.parse_args()
 
+    if args.seeds is None:
+        args.seeds = [args.seed]
+    args.seed = args.seeds[0]
+
+    if args.cores is not None and args.workers > args.cores:
+        parser.error('--workers must be at most --cores')
+    if args.search != 'grid' and args.solver != 'sgd':
+        parser.error('--search {} is only supported for --solver sgd'.format(
+            args.search))
+    if args.warm_start and args.solver not in cfg.warm_start_solvers:
+        parser.error('--warm_start is only supported for --solver {}'.format(
+            ' or '.join(cfg.warm_start_solvers)))
+    if args.warm_start and args.workers > 1:
+        parser.error('--warm_start is not supported with --workers > 1')
+
     args.results_dir = Path(args.results_dir).resolve()
 
     if args.log_file is None:
@@ -92,6 +138,15 @@ def process_args():
     model_options.l1_ratios = cfg.l1_ratios
     model_options.standardize_data_types = cfg.standardize_data_types
 
+    # set the core budget for training, and record how it's split between
+    # worker processes and threads (the budget doesn't affect model output,
+    # but the effective configuration is saved with the model options)
+    io_args.cores = ru.set_core_budget(io_args.cores)
+    model_options.resource_info = ru.get_resource_info(
+        n_tasks=cfg.folds * len(cfg.alphas) * len(cfg.l1_ratios),
+        n_workers=model_options.workers
+    )
+
     # add information about valid samples to model options
     model_options.sample_overlap_data_types = list(
         get_overlap_data_types(
@@ -113,9 +168,11 @@ if __name__ == '__main__':
     experiment_dir = Path(io_args.results_dir, 'purity').resolve()
     experiment_dir.mkdir(parents=True, exist_ok=True)
 
-    # save model options for this experiment
+    # save model options for this experiment, for each seed
     # (hyperparameters, preprocessing info, etc)
-    fu.save_model_options(experiment_dir, model_options)
+    for seed in model_options.seeds:
+        model_options.seed = seed
+        fu.save_model_options(experiment_dir, model_options)
 
     # create empty log file if it doesn't exist
     log_columns = [
@@ -140,69 +197,138 @@ if __name__ == '__main__':
 
     # we want to run purity prediction experiments for true labels and
     # shuffled labels (the latter as a lower baseline)
-    progress = tqdm([False, True],
-                    ncols=100,
-                    file=sys.stdout)
-    for shuffle_labels in progress:
-        progress.set_description('shuffle labels: {}'.format(shuffle_labels))
-
-        try:
-            output_dir = fu.make_output_dir(experiment_dir, '')
-            check_file = fu.check_output_file(output_dir,
-                                              None,
-                                              shuffle_labels,
-                                              model_options)
-        except ResultsFileExistsError:
-            # this happens if cross-validation for this gene has already been
-            # run (i.e. the results file already exists)
-            if io_args.verbose:
-                print('Skipping because results file exists already', file=sys.stderr)
-            purity_log_df = fu.generate_log_df(
-                log_columns,
-                [model_options.training_data, shuffle_labels, 'file_exists']
-            )
-            fu.write_log_file(purity_log_df, io_args.log_file)
-            continue
-
-        tcga_data.process_purity_data(experiment_dir,
-                                      shuffle_labels=shuffle_labels)
-
-        try:
-            # for now, don't standardize methylation data
-            standardize_columns = (model_options.training_data in
-                                   cfg.standardize_data_types)
-            results = run_cv_stratified(tcga_data,
-                                        'purity',
-                                        None,
-                                        model_options.training_data,
-                                        sample_info_df,
-                                        model_options.num_folds,
-                                        shuffle_labels,
-                                        standardize_columns,
-                                        io_args.output_preds)
-            # only save results if no exceptions
-            fu.save_results(output_dir,
-                            check_file,
-                            results,
-                            'purity',
-                            None,
-                            shuffle_labels,
-                            model_options)
-        except NoTrainSamplesError:
-            if io_args.verbose:
-                print('Skipping due to no train samples', file=sys.stderr)
-            purity_log_df = fu.generate_log_df(
-                log_columns,
-                [model_options.training_data, shuffle_labels, 'no_train_samples']
-            )
-        except OneClassError:
-            if io_args.verbose:
-                print('Skipping due to one holdout class', file=sys.stderr)
-            purity_log_df = fu.generate_log_df(
-                log_columns,
-                [model_options.training_data, shuffle_labels, 'one_class']
+    #
+    # for now, don't standardize methylation data
+    standardize_columns = (model_options.training_data in
+                           cfg.standardize_data_types)
+
+    if model_options.workers > 1:
+        for seed in model_options.seeds:
+            tcga_data.set_seed(seed)
+            model_options.seed = seed
+
+            # run both experiments (and all folds/grid points within them)
+            # as a single graph of tasks, see scheduler_utilities.py
+            experiments = []
+            for shuffle_labels in (False, True):
+                try:
+                    output_dir = fu.make_output_dir(experiment_dir, '')
+                    check_file = fu.check_output_file(output_dir,
+                                                      None,
+                                                      shuffle_labels,
+                                                      model_options)
+                except ResultsFileExistsError:
+                    if io_args.verbose:
+                        print('Skipping because results file exists already', file=sys.stderr)
+                    purity_log_df = fu.generate_log_df(
+                        log_columns,
+                        [model_options.training_data, shuffle_labels, 'file_exists']
+                    )
+                    fu.write_log_file(purity_log_df, io_args.log_file)
+                    continue
+                experiments.append((None,
+                                    None,
+                                    output_dir,
+                                    check_file,
+                                    shuffle_labels))
+
+            errors, stage_report = sch.run_gene_experiments(
+                tcga_data,
+                experiments,
+                sample_info_df,
+                model_options,
+                exp_string='purity',
+                standardize_columns=standardize_columns,
+                output_preds=io_args.output_preds,
+                n_workers=model_options.workers,
+                progress=True
             )
+            for (_, shuffle_labels), error in errors.items():
+                skip_reason = sch.get_skip_reason(error)
+                if io_args.verbose:
+                    print('Skipping (shuffle_labels: {}): {}'.format(
+                        shuffle_labels, skip_reason), file=sys.stderr)
+                purity_log_df = fu.generate_log_df(
+                    log_columns,
+                    [model_options.training_data, shuffle_labels, skip_reason]
+                )
+                fu.write_log_file(purity_log_df, io_args.log_file)
+
+            print('Worker utilization by stage:')
+            print(stage_report.to_string(float_format='%.3f'))
+
+    else:
+        progress = tqdm([False, True],
+                        ncols=100,
+                        file=sys.stdout)
+        for shuffle_labels in progress:
+            progress.set_description('shuffle labels: {}'.format(shuffle_labels))
+
+            for seed in model_options.seeds:
+                purity_log_df = None
+                tcga_data.set_seed(seed)
+                model_options.seed = seed
+
+                try:
+                    output_dir = fu.make_output_dir(experiment_dir, '')
+                    check_file = fu.check_output_file(output_dir,
+                                                      None,
+                                                      shuffle_labels,
+                                                      model_options)
+                except ResultsFileExistsError:
+                    # this happens if cross-validation for this gene has already been
+                    # run (i.e. the results file already exists)
+                    if io_args.verbose:
+                        print('Skipping because results file exists already', file=sys.stderr)
+                    purity_log_df = fu.generate_log_df(
+                        log_columns,
+                        [model_options.training_data, shuffle_labels, 'file_exists']
+                    )
+                    fu.write_log_file(purity_log_df, io_args.log_file)
+                    continue
+
+                # seeded the same way as with --workers, see
+                # scheduler_utilities.get_experiment_seed_id
+                tcga_data.set_experiment_seed('purity', shuffle_labels)
+                tcga_data.process_purity_data(experiment_dir,
+                                              shuffle_labels=shuffle_labels)
+
+                try:
+                    results = run_cv_stratified(tcga_data,
+                                                'purity',
+                                                None,
+                                                model_options.training_data,
+                                                sample_info_df,
+                                                model_options.num_folds,
+                                                shuffle_labels,
+                                                standardize_columns,
+                                                io_args.output_preds,
+                                                solver=model_options.solver,
+                                                search=model_options.search,
+                                                warm_start=model_options.warm_start)
+                    # only save results if no exceptions
+                    fu.save_results(output_dir,
+                                    check_file,
+                                    results,
+                                    'purity',
+                                    None,
+                                    shuffle_labels,
+                                    model_options)
+                except NoTrainSamplesError:
+                    if io_args.verbose:
+                        print('Skipping due to no train samples', file=sys.stderr)
+                    purity_log_df = fu.generate_log_df(
+                        log_columns,
+                        [model_options.training_data, shuffle_labels, 'no_train_samples']
+                    )
+                except OneClassError:
+                    if io_args.verbose:
+                        print('Skipping due to one holdout class', file=sys.stderr)
+                    purity_log_df = fu.generate_log_df(
+                        log_columns,
+                        [model_options.training_data, shuffle_labels, 'one_class']
+                    )
 
-        if purity_log_df is not None:
-            fu.write_log_file(purity_log_df, io_args.log_file)
+                if purity_log_df is not None:
+                    fu.write_log_file(purity_log_df, io_args.log_file)
 
@@ -20,6 +20,9 @@ from mpmp.exceptions import (
 from mpmp.utilities.classify_utilities import run_cv_stratified
 import mpmp.utilities.data_utilities as du
 import mpmp.utilities.file_utilities as fu
+import mpmp.utilities.prefetch_utilities as pf
+import mpmp.utilities.resource_utilities as ru
+import mpmp.utilities.scheduler_utilities as sch
 from mpmp.utilities.tcga_utilities import get_overlap_data_types
 
 def process_args():
@@ -35,6 +38,10 @@ def process_args():
     io = parser.add_argument_group('io',
                                    'arguments related to script input/output, '
                                    'note these will *not* be saved in metadata ')
+    io.add_argument('--cores', type=int, default=None,
+                    help='number of cores to use for model training, split '
+                         'between worker processes and BLAS threads '
+                         '(default: all available cores)')
     io.add_argument('--custom_genes', nargs='*', default=None,
                     help='currently this needs to be a subset of top_50')
     io.add_argument('--gene_set', type=str,
@@ -45,6 +52,15 @@ def process_args():
                          'any gene or set of genes in TCGA, specified in --custom_genes')
     io.add_argument('--log_file', default=None,
                     help='name of file to log skipped genes to')
+    io.add_argument('--prefetch_depth', type=int, default=cfg.prefetch_depth,
+                    help='number of experiments to prepare data for in the '
+                         'background while the current one trains, 0 to '
+                         'prepare data only when it\'s needed')
+    io.add_argument('--prefetch_max_gb', type=float,
+                    default=cfg.prefetch_max_bytes / 1e9,
+                    help='maximum memory (in GB) for data prepared in the '
+                         'background, at least one experiment is always '
+                         'prepared ahead')
     io.add_argument('--results_dir', default=cfg.results_dir,
                     help='where to write results to')
     io.add_argument('--verbose', action='store_true')
@@ -64,18 +80,67 @@ def process_args():
                            'that we have any data for, not just compressed')
     opts.add_argument('--debug', action='store_true',
                       help='use subset of data for fast debugging')
+    opts.add_argument('--fold_compression', action='store_true',
+                      help='fit compression on the training data within each '
+                           'CV fold, rather than using data compressed using '
+                           'all samples (including test samples)')
     opts.add_argument('--n_dim', type=int, default=100,
                       choices=[100, 1000, 5000], # TODO store this somewhere central
                       help='number of compressed components/dimensions to use')
     opts.add_argument('--num_folds', type=int, default=4,
                       help='number of folds of cross-validation to run')
     opts.add_argument('--seed', type=int, default=cfg.default_seed)
+    opts.add_argument('--seeds', type=int, nargs='+', default=None,
+                      help='run experiments for each of these seeds in turn, '
+                           'loading data only once (overrides --seed)')
+    opts.add_argument('--search', type=str, default=cfg.default_search,
+                      choices=cfg.search_methods,
+                      help='grid: fit every hyperparameter combination, '
+                           'halving: successive halving, starting with a small '
+                           'budget (only for --solver sgd)')
+    opts.add_argument('--solver', type=str, default=cfg.default_solver,
+                      choices=cfg.solvers,
+                      help='sgd: fit SGDClassifier for each hyperparameter '
+                           'combination, path: fit regularization path for '
+                           'each l1_ratio with warm starts, prox: fit with '
+                           'proximal gradient descent, stream: fit on batches '
+                           'of samples read from disk, to limit memory usage, '
+                           'gram: fit quadratic approximation using feature '
+                           'covariances cached across genes')
     opts.add_argument('--training_data', type=str, default='expression',
                       choices=list(cfg.compressed_data_types.keys()),
                       help='what data type to train model on')
+    opts.add_argument('--warm_start', action='store_true',
+                      help='initialize the fits for each outer CV fold from '
+                           'the previous fold\'s solutions (only for --solver '
+                           'path)')
+    opts.add_argument('--workers', type=int, default=1,
+                      help='if greater than 1, run all experiments in parallel '
+                           'on this many worker processes, rather than one at '
+                           'a time (note that shuffled labels will differ from '
+                           'serial runs)')
 
     args = parser.parse_args()
 
+    if args.seeds is None:
+        args.seeds = [args.seed]
+    args.seed = args.seeds[0]
+
+    if args.cores is not None and args.workers > args.cores:
+        parser.error('--workers must be at most --cores')
+    if args.search != 'grid' and args.solver != 'sgd':
+        parser.error('--search {} is only supported for --solver sgd'.format(
+            args.search))
+    if args.warm_start and args.solver not in cfg.warm_start_solvers:
+        parser.error('--warm_start is only supported for --solver {}'.format(
+            ' or '.join(cfg.warm_start_solvers)))
+    if args.warm_start and args.workers > 1:
+        parser.error('--warm_start is not supported with --workers > 1')
+    if args.warm_start and args.fold_compression:
+        parser.error('--warm_start is not supported with --fold_compression')
+    if args.fold_compression and args.solver == 'stream':
+        parser.error('--fold_compression is not supported for --solver stream')
+
     args.results_dir = Path(args.results_dir).resolve()
 
     if args.log_file is None:
@@ -99,6 +164,15 @@ def process_args():
     model_options.l1_ratios = cfg.l1_ratios
     model_options.standardize_data_types = cfg.standardize_data_types
 
+    # set the core budget for training, and record how it's split between
+    # worker processes and threads (the budget doesn't affect model output,
+    # but the effective configuration is saved with the model options)
+    io_args.cores = ru.set_core_budget(io_args.cores)
+    model_options.resource_info = ru.get_resource_info(
+        n_tasks=cfg.folds * len(cfg.alphas) * len(cfg.l1_ratios),
+        n_workers=model_options.workers
+    )
+
     # add information about valid samples to model options
     model_options.sample_overlap_data_types = list(
         get_overlap_data_types(
@@ -121,9 +195,11 @@ if __name__ == '__main__':
     experiment_dir = Path(io_args.results_dir, 'gene').resolve()
     experiment_dir.mkdir(parents=True, exist_ok=True)
 
-    # save model options for this experiment
+    # save model options for this experiment, for each seed
     # (hyperparameters, preprocessing info, etc)
-    fu.save_model_options(experiment_dir, model_options)
+    for seed in model_options.seeds:
+        model_options.seed = seed
+        fu.save_model_options(experiment_dir, model_options)
 
     # create empty log file if it doesn't exist
     log_columns = [
@@ -140,7 +216,8 @@ if __name__ == '__main__':
 
     tcga_data = TCGADataModel(seed=model_options.seed,
                               training_data=model_options.training_data,
-                              load_compressed_data=True,
+                              load_compressed_data=(not model_options.fold_compression),
+                              fold_compression=model_options.fold_compression,
                               n_dim=model_options.n_dim,
                               sample_info_df=sample_info_df,
                               verbose=io_args.verbose,
@@ -151,44 +228,123 @@ if __name__ == '__main__':
     # - for true labels and shuffled labels
     #   (shuffled labels acts as our lower baseline)
     # - for all genes in the given gene set
-    for shuffle_labels in (False, True):
+    if model_options.workers > 1:
+        for seed in model_options.seeds:
+            tcga_data.set_seed(seed)
+            model_options.seed = seed
 
-        print('shuffle_labels: {}'.format(shuffle_labels))
+            # columns should be standardized before compression
+            # so we don't want to standardize them again here, unless
+            # we're fitting the compression within each fold
+            standardize_columns = (
+                model_options.fold_compression and
+                (model_options.training_data in cfg.standardize_data_types)
+            )
+            # run all experiments (and all folds/grid points within them)
+            # as a single graph of tasks, see scheduler_utilities.py
+            experiments = []
+            for shuffle_labels in (False, True):
+                for gene_idx, gene_series in genes_df.iterrows():
+                    gene = gene_series.gene
+                    try:
+                        gene_dir = fu.make_output_dir(experiment_dir, gene)
+                        check_file = fu.check_output_file(gene_dir,
+                                                          gene,
+                                                          shuffle_labels,
+                                                          model_options)
+                    except ResultsFileExistsError:
+                        if io_args.verbose:
+                            print('Skipping because results file exists already: gene {}'.format(
+                                gene), file=sys.stderr)
+                        mutation_log_df = fu.generate_log_df(
+                            log_columns,
+                            [gene, model_options.training_data, shuffle_labels, 'file_exists']
+                        )
+                        fu.write_log_file(mutation_log_df, io_args.log_file)
+                        continue
+                    experiments.append((gene,
+                                        gene_series.classification,
+                                        gene_dir,
+                                        check_file,
+                                        shuffle_labels))
 
-        progress = tqdm(genes_df.iterrows(),
-                        total=genes_df.shape[0],
+            errors, stage_report = sch.run_gene_experiments(
+                tcga_data,
+                experiments,
+                sample_info_df,
+                model_options,
+                standardize_columns=standardize_columns,
+                n_workers=model_options.workers,
+                progress=True
+            )
+            for (gene, shuffle_labels), error in errors.items():
+                skip_reason = sch.get_skip_reason(error)
+                if io_args.verbose or skip_reason == 'gene_not_found':
+                    print('Skipping gene {} (shuffle_labels: {}): {}'.format(
+                        gene, shuffle_labels, skip_reason), file=sys.stderr)
+                mutation_log_df = fu.generate_log_df(
+                    log_columns,
+                    [gene, model_options.training_data, shuffle_labels, skip_reason]
+                )
+                fu.write_log_file(mutation_log_df, io_args.log_file)
+
+            print('Worker utilization by stage:')
+            print(stage_report.to_string(float_format='%.3f'))
+
+    else:
+        # first check which experiments still need to be run, then prepare
+        # data for the next experiment in the background while the current
+        # one trains (see prefetch_utilities.py)
+        experiments, check_files = [], {}
+        for shuffle_labels in (False, True):
+            for gene_idx, gene_series in genes_df.iterrows():
+                gene = gene_series.gene
+                for seed in model_options.seeds:
+                    model_options.seed = seed
+                    try:
+                        gene_dir = fu.make_output_dir(experiment_dir, gene)
+                        check_file = fu.check_output_file(gene_dir,
+                                                          gene,
+                                                          shuffle_labels,
+                                                          model_options)
+                    except ResultsFileExistsError:
+                        # this happens if cross-validation for this gene has already been
+                        # run (i.e. the results file already exists)
+                        if io_args.verbose:
+                            print('Skipping because results file exists already: gene {}'.format(
+                                gene), file=sys.stderr)
+                        mutation_log_df = fu.generate_log_df(
+                            log_columns,
+                            [gene, model_options.training_data, shuffle_labels, 'file_exists']
+                        )
+                        fu.write_log_file(mutation_log_df, io_args.log_file)
+                        continue
+                    experiments.append((gene,
+                                        gene_series.classification,
+                                        gene_dir,
+                                        shuffle_labels,
+                                        seed))
+                    check_files[gene, shuffle_labels, seed] = check_file
+
+        prefetcher = pf.prefetch_gene_data(tcga_data,
+                                           experiments,
+                                           sample_info_df,
+                                           model_options.num_folds,
+                                           depth=io_args.prefetch_depth,
+                                           max_bytes=io_args.prefetch_max_gb * 1e9)
+        progress = tqdm(prefetcher,
+                        total=len(experiments),
                         ncols=100,
                         file=sys.stdout)
 
-        for gene_idx, gene_series in progress:
+        for experiment, gene_data, error in progress:
             mutation_log_df = None
-            gene = gene_series.gene
-            classification = gene_series.classification
+            gene, classification, gene_dir, shuffle_labels, seed = experiment
+            model_options.seed = seed
+            check_file = check_files[gene, shuffle_labels, seed]
             progress.set_description('gene: {}'.format(gene))
 
-            try:
-                gene_dir = fu.make_output_dir(experiment_dir, gene)
-                check_file = fu.check_output_file(gene_dir,
-                                                  gene,
-                                                  shuffle_labels,
-                                                  model_options)
-                tcga_data.process_data_for_gene(gene,
-                                                classification,
-                                                gene_dir,
-                                                shuffle_labels=shuffle_labels)
-            except ResultsFileExistsError:
-                # this happens if cross-validation for this gene has already been
-                # run (i.e. the results file already exists)
-                if io_args.verbose:
-                    print('Skipping because results file exists already: gene {}'.format(
-                        gene), file=sys.stderr)
-                mutation_log_df = fu.generate_log_df(
-                    log_columns,
-                    [gene, model_options.training_data, shuffle_labels, 'file_exists']
-                )
-                fu.write_log_file(mutation_log_df, io_args.log_file)
-                continue
-            except KeyError:
+            if isinstance(error, KeyError):
                 # this might happen if the given gene isn't in the mutation data
                 # (or has a different alias, TODO we could check for this later)
                 print('Gene {} not found in mutation data, skipping'.format(gene),
@@ -199,18 +355,28 @@ if __name__ == '__main__':
                 )
                 fu.write_log_file(mutation_log_df, io_args.log_file)
                 continue
+            elif error is not None:
+                raise error
 
             try:
                 # columns should be standardized before compression
-                # so we don't want to standardize them again here
-                results = run_cv_stratified(tcga_data,
+                # so we don't want to standardize them again here, unless
+                # we're fitting the compression within each fold
+                standardize_columns = (
+                    model_options.fold_compression and
+                    (model_options.training_data in cfg.standardize_data_types)
+                )
+                results = run_cv_stratified(gene_data,
                                             'gene',
                                             gene,
                                             model_options.training_data,
                                             sample_info_df,
                                             model_options.num_folds,
                                             shuffle_labels,
-                                            standardize_columns=False)
+                                            standardize_columns=standardize_columns,
+                                            solver=model_options.solver,
+                                            search=model_options.search,
+                                            warm_start=model_options.warm_start)
                 # only save results if no exceptions
                 fu.save_results(gene_dir,
                                 check_file,
@@ -239,3 +405,5 @@ if __name__ == '__main__':
             if mutation_log_df is not None:
                 fu.write_log_file(mutation_log_df, io_args.log_file)
 
+        print('Time spent busy/idle by stage:')
+        print(prefetcher.get_stage_report().to_string(float_format='%.3f'))
@@ -43,6 +43,12 @@ data_types = {
 # if false, use all the samples present in the dataset being analyzed
 use_only_cross_data_samples = True
 
+# location of cached cross-validation fold assignments
+fold_assignments_dir = data_dir / 'fold_assignments'
+
+# location of chunked intermediate files for 450K methylation preprocessing
+methylation_450k_intermediate_dir = data_dir / 'methylation_450k_chunks'
+
 # locations of compressed multimodal data files
 exp_compressed_dir = data_dir / 'exp_compressed'
 me_compressed_dir = data_dir / 'me_compressed'
@@ -70,6 +76,12 @@ default_seed = 42
 # number of features to use by default
 num_features_raw = 8000
 
+# whether or not to store one-hot cancer type covariates as sparse columns
+# in the feature matrix; the prox solver uses them without converting them to
+# dense arrays (see solver_utilities.get_design_matrix), the other solvers
+# convert the feature matrix to a dense array when fitting
+sparse_covariates = True
+
 # gene/cancer type filtering hyperparameters
 # filter cancer types with less than this percent of mutated samples
 filter_prop = 0.05
@@ -82,6 +94,90 @@ max_iter = 200
 alphas = [0.1, 0.13, 0.15, 0.2, 0.25, 0.3]
 l1_ratios = [0.15, 0.16, 0.2, 0.25, 0.3, 0.4]
 
+# solvers for fitting classification models
+# sgd: fit SGDClassifier for each hyperparameter combination (GridSearchCV)
+# path: fit regularization path for each l1_ratio, with warm starts
+# prox: fit with full-batch proximal gradient descent, for many targets at
+#       once if they share the same samples (see run_cv_multi_target)
+# stream: fit SGDClassifier with partial_fit on batches of samples read from
+#         a memory-mapped file, to limit memory usage (see run_cv_streaming)
+# gram: fit a quadratic approximation of the loss with coordinate descent,
+#       using feature covariances that are cached and shared by every gene
+#       with the same training data (see solver_utilities.GramPathCV)
+solvers = ['sgd', 'path', 'prox', 'stream', 'gram']
+default_solver = 'sgd'
+# hyperparameter search methods (for the sgd solver)
+# grid: fit every point in the grid with max_iter epochs
+# halving: successive halving, starting with a small budget for every point
+#          in the grid and keeping the best 1/halving_factor at each round
+search_methods = ['grid', 'halving']
+default_search = 'grid'
+halving_factor = 3
+# budget for successive halving: either 'n_samples' (number of training
+# samples) or 'classify__max_iter' (number of SGD epochs)
+halving_resource = 'n_samples'
+# whether or not to record the training loss for each fit in the grid
+# search (see solver_utilities.fit_with_info), this is off by default since
+# it takes an extra pass over the training data for every fit
+record_train_loss = False
+
+# solvers that can be warm started from the previous outer CV fold's
+# solutions (see solver_utilities.WarmStartCache). SGD isn't included:
+# SGDClassifier restarts its learning rate schedule on every fit, so
+# starting from a previous solution doesn't save any epochs
+warm_start_solvers = ['path']
+
+# convergence tolerance (on relative change in coefficients) for prox solver
+prox_tol = 1e-4
+# maximum number of models (targets * hyperparameter combinations) to fit at
+# once with prox solver, larger values use more memory but stream the data
+# matrix through memory fewer times
+prox_max_columns = 256
+# whether or not to screen out features that are likely to have zero
+# coefficients (using the strong rule, with KKT checks) for prox solver
+prox_screen = True
+
+# convergence tolerance (on the largest change in the loss from a single
+# coefficient update) for gram solver
+gram_tol = 1e-7
+# maximum memory (in bytes) used by cached feature covariances, with the
+# gram solver; the cache for each training set uses about n_features *
+# (n_samples + n_folds * n_features_used) floats, where n_features_used is
+# the number of features that have had a nonzero coefficient in any model.
+# The least recently used caches are dropped first (for a single gene,
+# there's one cache per outer CV fold).
+gram_cache_max_bytes = 4e9
+
+# maximum memory (in bytes) used by projections fit within CV folds, with
+# --fold_compression; each projection uses about n_dim * n_features floats,
+# and there's one per outer CV fold (shared by every identifier with the
+# same training samples). The least recently used ones are dropped first.
+fold_projection_max_bytes = 1e9
+
+# training data larger than this (in bytes) is written to a memory-mapped
+# file once per fold and shared with grid search workers, rather than being
+# serialized for them (this is the same as joblib's default threshold)
+shared_array_min_bytes = 1e6
+
+# number of samples to read at a time for stream solver, the memory used for
+# training (in addition to the loaded data) is about
+# stream_batch_size * (number of features) floats
+stream_batch_size = 256
+
+# number of experiments to prepare data for in the background while the
+# current one trains, in the run scripts (see prefetch_utilities.py), 0
+# prepares data for each experiment when it's needed. This is off by
+# default, since it was slightly slower on the test data, and it hasn't
+# been benchmarked on full-size data yet.
+prefetch_depth = 0
+# maximum memory (in bytes) used by prepared experiments waiting to be
+# trained, one experiment is always allowed to wait regardless of its size
+prefetch_max_bytes = 4e9
+
+# number of samples to score at a time when applying saved models to new
+# data (see model_utilities.ModelStack)
+inference_chunk_size = 1000
+
 # repo/commit information to retrieve precomputed cancer gene information
 # this is used in data_utilities.py
 top50_base_url = "https://github.com/greenelab/BioBombe/raw"
@@ -1,5 +1,7 @@
 import sys
 import typing
+import zlib
+from collections import OrderedDict
 from pathlib import Path
 
 import numpy as np
@@ -27,6 +29,7 @@ class TCGADataModel():
                  subset_mad_genes=-1,
                  training_data='expression',
                  load_compressed_data=False,
+                 fold_compression=False,
                  n_dim=None,
                  sample_info_df=None,
                  verbose=False,
@@ -37,23 +40,45 @@ class TCGADataModel():
 
         Arguments
         ---------
-        seed (int): seed for random number generator
+        seed (int): seed for random number generator, this can be changed
+                    later with set_seed
         subset_mad_genes (int): how many genes to keep (top by mean absolute deviation).
                                 -1 doesn't do any filtering (all genes will be kept).
         training_data (str): what data type to train the model on
         load_compressed_data (bool): whether or not to use compressed data
+        fold_compression (bool): if True, load raw data and fit the compression
+                                 within each training fold, rather than using
+                                 data compressed using all samples
         n_dim (int): how many dimensions to use for compression algorithm
         verbose (bool): whether or not to write verbose output
         sample_info_df (pd.DataFrame): dataframe containing info about TCGA samples
         debug (bool): if True, use a subset of expression data for quick debugging
         test (bool): if True, don't save results to files
         """
+        if load_compressed_data and fold_compression:
+            raise ValueError('load_compressed_data and fold_compression '
+                             'cannot both be used')
+        if fold_compression and n_dim is None:
+            raise ValueError('n_dim must be provided to use fold_compression')
+
         # save relevant parameters
-        np.random.seed(seed)
-        self.seed = seed
+        self.set_seed(seed)
         self.subset_mad_genes = subset_mad_genes
         self.compressed_data = load_compressed_data
+        self.fold_compression = fold_compression
         self.n_dim = n_dim
+        # projections fit within CV folds, keyed by (fold hash, n_dim, seed)
+        # these are reused across identifiers and shuffled label runs
+        # that share the same training samples, up to a total size of
+        # cfg.fold_projection_max_bytes (see compress_fold)
+        self.fold_projections = OrderedDict()
+        # labels and aligned data for the most recent identifier, so
+        # experiments with multiple seeds don't have to recompute them
+        self._filtered_cache = (None, None)
+        # memory-mapped copy of the loaded data for the stream solver,
+        # written the first time it's needed (see
+        # stream_utilities.get_data_store) and shared with copies
+        self._stream_store = {}
         self.verbose = verbose
         self.debug = debug
         self.test = test
@@ -66,6 +91,38 @@ class TCGADataModel():
                         debug=debug,
                         test=self.test)
 
+    def set_seed(self, seed):
+        """Set random seed for fold assignments and label shuffling.
+
+        Each data model has its own random generator, rather than using
+        numpy's global random state, so runs with different seeds can be
+        done in the same process without reloading data.
+
+        Arguments
+        ---------
+        seed (int): seed for random number generator
+        """
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+    def set_experiment_seed(self, identifier, shuffle_labels):
+        """Reseed the random generator for a single experiment.
+
+        The generator is seeded using self.seed, the identifier, and whether
+        labels are shuffled, so each experiment gets its own random stream,
+        and its shuffled labels don't depend on which experiments were run
+        before it (or in which process, when experiments are run in
+        parallel). self.seed is unchanged.
+
+        Arguments
+        ---------
+        identifier (str): string describing the target value/environment
+        shuffle_labels (bool): whether or not labels will be shuffled
+        """
+        key = '{}_{}'.format(identifier, shuffle_labels).encode()
+        self.rng = np.random.default_rng(
+            (self.seed + zlib.crc32(key)) % (2**32))
+
     def load_gene_set(self, gene_set='top_50'):
         """
         Load gene set data from previous GitHub repos.
@@ -124,16 +181,13 @@ class TCGADataModel():
         shuffle_labels (bool): whether or not to shuffle labels (negative
                                control)
         """
-        y_df_raw = self._generate_cancer_type_labels(cancer_type)
-
-        filtered_data = self._filter_data(
-            self.data_df,
-            y_df_raw
+        train_filtered_df, y_filtered_df, gene_features = self._get_filtered_data(
+            ('cancer_type', cancer_type),
+            lambda: self._generate_cancer_type_labels(cancer_type)
         )
-        train_filtered_df, y_filtered_df, gene_features = filtered_data
 
         if shuffle_labels:
-            y_filtered_df.status = np.random.permutation(
+            y_filtered_df.status = self.rng.permutation(
                 y_filtered_df.status.values)
 
         if cfg.use_only_cross_data_samples:
@@ -167,17 +221,14 @@ class TCGADataModel():
         use_pancancer (bool): whether or not to use pancancer data
         shuffle_labels (bool): whether or not to shuffle labels (negative control)
         """
-        y_df_raw = self._generate_gene_labels(gene, classification, gene_dir)
-
-        filtered_data = self._filter_data(
-            self.data_df,
-            y_df_raw,
+        train_filtered_df, y_filtered_df, gene_features = self._get_filtered_data(
+            ('gene', gene, classification),
+            lambda: self._generate_gene_labels(gene, classification, gene_dir),
             add_cancertype_covariate=True
         )
-        train_filtered_df, y_filtered_df, gene_features = filtered_data
 
         if shuffle_labels:
-            y_filtered_df.status = np.random.permutation(
+            y_filtered_df.status = self.rng.permutation(
                 y_filtered_df.status.values)
 
         if cfg.use_only_cross_data_samples:
@@ -212,18 +263,15 @@ class TCGADataModel():
         output_dir (str): directory to write output to, if None don't write output
         shuffle_labels (bool): whether or not to shuffle labels (negative control)
         """
-        y_df_raw = du.load_purity(self.mut_burden_df, self.sample_info_df,
-                                  verbose=self.verbose)
-
-        filtered_data = self._filter_data(
-            self.data_df,
-            y_df_raw,
+        train_filtered_df, y_filtered_df, gene_features = self._get_filtered_data(
+            ('purity',),
+            lambda: du.load_purity(self.mut_burden_df, self.sample_info_df,
+                                   verbose=self.verbose),
             add_cancertype_covariate=True
         )
-        train_filtered_df, y_filtered_df, gene_features = filtered_data
 
         if shuffle_labels:
-            y_filtered_df.status = np.random.permutation(
+            y_filtered_df.status = self.rng.permutation(
                 y_filtered_df.status.values)
 
         if cfg.use_only_cross_data_samples:
@@ -344,6 +392,36 @@ class TCGADataModel():
         )
         return y_df
 
+    def _get_filtered_data(self,
+                           key,
+                           generate_labels,
+                           add_cancertype_covariate=False):
+        """Get labels and aligned training data for an identifier.
+
+        The result for the most recent key is cached, so calling this
+        repeatedly for the same identifier (e.g. with a different seed or
+        with shuffled labels) only generates labels and aligns the data
+        once. Labels are copied, so they can be shuffled without changing
+        the cached values; the training data is shared and shouldn't be
+        modified in place.
+
+        Arguments
+        ---------
+        key (tuple): identifies the labels to generate
+        generate_labels (function): generates labels, if not cached
+        add_cancertype_covariate (bool): passed to _filter_data
+        """
+        cache_key, filtered_data = self._filtered_cache
+        if cache_key != key:
+            filtered_data = self._filter_data(
+                self.data_df,
+                generate_labels(),
+                add_cancertype_covariate=add_cancertype_covariate
+            )
+            self._filtered_cache = (key, filtered_data)
+        train_filtered_df, y_filtered_df, gene_features = filtered_data
+        return train_filtered_df, y_filtered_df.copy(), gene_features
+
     def _filter_data(self,
                      data_df,
                      y_df,
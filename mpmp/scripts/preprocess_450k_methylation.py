@@ -0,0 +1,75 @@
+"""
+Preprocess raw 450K methylation data without loading it all into memory.
+
+This runs the same filtering/imputation steps as
+00_download_data/1C_preprocess_450k_methylation_data.ipynb, and writes the
+same processed data and sample info files, but processes the data in chunks
+of probes to stay under a configurable memory budget.
+"""
+import argparse
+import os
+
+import pandas as pd
+
+import mpmp.config as cfg
+import mpmp.utilities.methylation_utilities as mu
+import mpmp.utilities.tcga_utilities as tu
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--intermediate_dir',
+                   default=cfg.methylation_450k_intermediate_dir,
+                   help='where to write chunked intermediate files')
+    p.add_argument('--max_memory_gb', type=float, default=8,
+                   help='approximate peak memory budget for chunked '
+                        'processing, in GB')
+    p.add_argument('--n_filter', type=int, default=10,
+                   help='number of samples with most NA values to remove')
+    p.add_argument('--n_impute', type=int, default=5,
+                   help='impute probes with at most this many NA values')
+    p.add_argument('--n_mad_genes', type=int, default=100000,
+                   help='number of probes to keep, by mean absolute deviation')
+    p.add_argument('--skip_sample_info', action='store_true',
+                   help='don\'t write sample info files (these require '
+                        'downloading TCGA barcode info)')
+    p.add_argument('--verbose', action='store_true')
+    args = p.parse_args()
+
+    manifest_df = pd.read_csv(os.path.join(cfg.data_dir, 'manifest.tsv'),
+                              sep='\t', index_col=0)
+    raw_file = os.path.join(cfg.raw_data_dir,
+                            manifest_df.loc['methylation_450k'].filename)
+
+    values, metadata, mad_values = mu.preprocess_methylation_data(
+        raw_file,
+        args.intermediate_dir,
+        n_filter=args.n_filter,
+        n_impute=args.n_impute,
+        max_memory_gb=args.max_memory_gb,
+        verbose=args.verbose
+    )
+
+    me_mad_df = mu.subset_by_mad(values, metadata, mad_values, args.n_mad_genes)
+    me_mad_df.to_pickle(os.path.join(cfg.data_dir,
+                                     'methylation_450k_f{}_i{}_mad{}.pkl'.format(
+                                         args.n_filter, args.n_impute,
+                                         args.n_mad_genes)))
+
+    if not args.skip_sample_info:
+        (cancer_types_df,
+         cancertype_codes_dict,
+         sample_types_df,
+         sampletype_codes_dict) = tu.get_tcga_barcode_info()
+
+        tcga_id = tu.get_and_save_sample_info(me_mad_df,
+                                              sampletype_codes_dict,
+                                              cancertype_codes_dict,
+                                              training_data='me_450k')
+
+        cancertype_count_df = (
+            pd.DataFrame(tcga_id.cancer_type.value_counts())
+            .reset_index()
+            .rename({'index': 'cancertype', 'cancer_type': 'n ='}, axis='columns')
+        )
+        file = os.path.join(cfg.sample_info_dir, 'tcga_me_450k_sample_counts.tsv')
+        cancertype_count_df.to_csv(file, sep='\t', index=False)
@@ -0,0 +1,95 @@
+"""
+Score new samples with all the saved models for a data type.
+
+Models are loaded from the .npz model files written by the run scripts (see
+model_utilities.py), stacked into a single sparse weight matrix, and applied
+to the input data a chunk of samples at a time. The output is a samples x
+identifiers matrix of positive class probabilities, averaged over the models
+for each CV fold.
+
+Only models trained with the same seed and configuration (by default, the
+default seed and the base configuration, see model_utilities.base_model_config)
+are used, since predictions from different configurations aren't comparable.
+"""
+import argparse
+import sys
+
+import mpmp.config as cfg
+import mpmp.utilities.model_utilities as mu
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--data_file', required=True,
+                   help='samples x features data to score, as a tab-separated '
+                        'file (read in chunks) or a pickled data frame. This '
+                        'should contain the same features as the training '
+                        'data, including covariates; missing features are '
+                        'imputed')
+    p.add_argument('--output_file', required=True,
+                   help='where to write predictions, as a tab-separated file')
+    p.add_argument('--chunk_size', type=int, default=cfg.inference_chunk_size,
+                   help='number of samples to score at a time')
+    p.add_argument('--fold_compression', action='store_true',
+                   help='use models trained with compression fit within CV '
+                        'folds (requires --n_dim)')
+    p.add_argument('--n_dim', type=int, default=0,
+                   help='use models trained on data compressed to this many '
+                        'dimensions, 0 for raw features')
+    p.add_argument('--output_folds', action='store_true',
+                   help='write predictions from each CV fold model, rather '
+                        'than averaging over folds')
+    p.add_argument('--results_dir', default=cfg.results_dir,
+                   help='directory to search for saved models')
+    p.add_argument('--search', choices=cfg.search_methods,
+                   default=cfg.default_search,
+                   help='use models trained with this search method')
+    p.add_argument('--seed', type=int, default=cfg.default_seed,
+                   help='only use models trained with this seed')
+    p.add_argument('--signal', choices=['signal', 'shuffled'], default='signal',
+                   help='use models trained on true or shuffled labels')
+    p.add_argument('--solver', choices=cfg.solvers, default=cfg.default_solver,
+                   help='use models trained with this solver')
+    p.add_argument('--standardize', choices=['train', 'input'], default='train',
+                   help='standardize features using the training statistics '
+                        'for each model, or the statistics of the input data '
+                        '(this matches how test sets are standardized in CV, '
+                        'but takes an extra pass over the input)')
+    p.add_argument('--training_data', default='expression',
+                   choices=list(cfg.data_types.keys()),
+                   help='data type the models were trained on')
+    p.add_argument('--verbose', action='store_true')
+    p.add_argument('--warm_start', action='store_true',
+                   help='use models trained with warm starts')
+    args = p.parse_args()
+
+    if args.fold_compression and args.n_dim == 0:
+        p.error('--fold_compression requires --n_dim')
+
+    model_files = mu.get_model_files(args.results_dir,
+                                     args.training_data,
+                                     args.signal)
+    try:
+        stack = mu.load_model_stack(model_files,
+                                    training_data=args.training_data,
+                                    signal=args.signal,
+                                    seed=args.seed,
+                                    model_config={
+                                        key: getattr(args, key)
+                                            for key in mu.base_model_config
+                                    })
+    except ValueError:
+        p.error('no saved models found in {}'.format(args.results_dir))
+
+    if args.verbose:
+        print('Scoring with {} models for {} identifiers, {} input features'.format(
+                  stack.n_models,
+                  stack.model_info_.identifier.nunique(),
+                  stack.input_features_.shape[0]),
+              file=sys.stderr)
+
+    probs_df = stack.predict_proba(args.data_file,
+                                   chunk_size=args.chunk_size,
+                                   standardize=args.standardize,
+                                   combine_folds=(not args.output_folds),
+                                   verbose=args.verbose)
+    probs_df.to_csv(args.output_file, sep='\t', float_format='%.5g')
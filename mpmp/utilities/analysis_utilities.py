@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import warnings
 from pathlib import Path
@@ -7,6 +8,8 @@ import numpy as np
 import pandas as pd
 from scipy.stats import ttest_ind
 
+import mpmp.utilities.null_utilities as nu
+
 def load_stratified_prediction_results(results_dir, experiment_descriptor):
     """Load results of stratified prediction experiments.
 
@@ -65,7 +68,7 @@ def load_compressed_prediction_results(results_dir, experiment_descriptor):
             if not check_compressed_file(results_filename): continue
             if 'classify' not in results_filename: continue
             if results_filename[0] == '.': continue
-            n_dims = int(results_filename.split('_')[-3].replace('n', ''))
+            n_dims = int(re.search(r'_n(\d+)_', results_filename).group(1))
             id_results_df = pd.read_csv(results_file, sep='\t')
             id_results_df['n_dims'] = n_dims
             id_results_df['experiment'] = experiment_descriptor
@@ -121,15 +124,13 @@ def load_purity_by_cancer_type(results_dir, sample_info_df):
         results_filename = str(results_file.stem)
         if 'preds' not in results_filename: continue
         if results_filename[0] == '.': continue
+        # filenames can have other parameters after the seed (see
+        # file_utilities.get_config_kwargs), so we don't count from the end
+        training_data, signal, seed = re.match(
+            r'(.+)_(signal|shuffled)_s(\d+)_', results_filename).groups()
+        seed = int(seed)
         if check_compressed_file(results_filename):
-            training_data = '_'.join(results_filename.split('_')[:-4])
             training_data += '_compressed'
-            signal = results_filename.split('_')[-4]
-            seed = int(results_filename.split('_')[-3].replace('s', ''))
-        else:
-            training_data = '_'.join(results_filename.split('_')[:-3])
-            signal = results_filename.split('_')[-3]
-            seed = int(results_filename.split('_')[-2].replace('s', ''))
         id_results_df = pd.read_csv(results_file, sep='\t', index_col=0)
         cancer_type_results_df = calculate_metrics_for_cancer_type(id_results_df,
                                                                    training_data,
@@ -348,6 +349,52 @@ def compare_control(results_df,
     return pd.DataFrame(results, columns=['identifier', 'delta_mean', 'p_value'])
 
 
+def compare_permutation_null(results_dir,
+                             metric='auroc',
+                             verbose=False):
+    """Get permutation p-values from saved null distributions.
+
+    This is an alternative to compare_control, using the null distributions
+    written by the run scripts with --null_permutations (see
+    null_utilities.py) rather than a single shuffled-label run.
+
+    Arguments
+    ---------
+    results_dir (str): directory to look in for results, subdirectories should
+                       be experiments for individual genes or cancer types
+    metric (str): 'auroc' or 'aupr'
+    verbose (bool): whether or not to print files that are skipped
+
+    Returns
+    -------
+    results_df (pd.DataFrame): observed and null mean metric over folds,
+                               and permutation p-value, for each
+                               identifier and seed
+    """
+    results = []
+    for null_file in sorted(Path(results_dir).glob('*/*_null_distribution.npz')):
+        seed_match = re.search(r'_s(\d+)_', null_file.name)
+        if seed_match is None:
+            if verbose:
+                print('no seed in filename {}, skipping'.format(null_file),
+                      file=sys.stderr)
+            continue
+        null_results = nu.load_null_distribution(null_file)
+        observed, null_mean, p_value = nu.get_permutation_pvalue(
+            null_results, metric=metric)
+        results.append([null_file.parent.name,
+                        int(seed_match.group(1)),
+                        observed,
+                        null_mean,
+                        observed - null_mean,
+                        null_results[metric].shape[1] - 1,
+                        p_value])
+
+    return pd.DataFrame(results, columns=['identifier', 'seed', 'observed',
+                                          'null_mean', 'delta_mean',
+                                          'n_permutations', 'p_value'])
+
+
 def compare_experiment(single_cancer_df,
                        pancancer_df,
                        identifier='gene',
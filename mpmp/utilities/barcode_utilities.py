@@ -0,0 +1,124 @@
+"""
+Functions for parsing TCGA sample barcodes.
+
+TCGA sample IDs used in this repo are barcodes truncated to 15 characters,
+e.g. TCGA-02-0047-01, which consist of:
+* project (TCGA)
+* tissue source site (TSS) code (02), which maps to cancer type
+* participant (0047)
+* sample type code (01), e.g. primary tumor, normal tissue, metastatic
+
+See https://docs.gdc.cancer.gov/Encyclopedia/pages/TCGA_Barcode/ for more
+details.
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+# cache of parsed barcodes, keyed by sample index (and code mappings)
+_barcode_cache = {}
+
+
+def _get_cache_key(sample_ids, *code_dicts):
+    """Get a key identifying a set of sample IDs and code mappings."""
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(sample_ids, index=False).values.tobytes())
+    for code_dict in code_dicts:
+        h.update(repr(sorted(code_dict.items())).encode())
+    return h.hexdigest()
+
+
+def _map_codes(codes, code_dict):
+    """Map codes to their descriptions, as a categorical.
+
+    The mapping is applied only to the unique codes, then broadcast to all
+    samples. Codes not in code_dict are kept as is (i.e. this matches the
+    behavior of pd.Series.replace, rather than pd.Series.map), and missing
+    codes stay missing.
+    """
+    codes = pd.Categorical(codes)
+    categories = pd.Series(codes.categories)
+    mapped = categories.map(code_dict)
+    mapped = mapped.where(mapped.notna(), categories).values
+    # missing values have code -1, which would index the last category
+    values = np.full(len(codes), np.nan, dtype='object')
+    is_valid = codes.codes != -1
+    values[is_valid] = mapped[codes.codes[is_valid]]
+    return pd.Categorical(values)
+
+
+def get_stratification_counts(id_for_stratification):
+    """Get number of samples with the same stratification ID as each sample."""
+    ids = pd.Series(id_for_stratification)
+    return ids.map(ids.value_counts()).values
+
+
+def recode_stratification_ids(id_for_stratification, min_count):
+    """Recode stratification IDs with fewer than min_count samples as 'other'.
+
+    These are singletons or near-singletons, which won't work with
+    StratifiedKFold (at least, when min_count is the number of folds).
+
+    Returns
+    -------
+    recoded_ids (np.array): recoded IDs, same order as input
+    stratify_counts (np.array): count of samples with each input ID
+    """
+    stratify_counts = get_stratification_counts(id_for_stratification)
+    recoded_ids = np.where(stratify_counts < min_count,
+                           'other',
+                           np.asarray(id_for_stratification, dtype='object'))
+    return recoded_ids, stratify_counts
+
+
+def parse_barcodes(sample_ids,
+                   sampletype_codes_dict,
+                   cancertype_codes_dict,
+                   use_cache=True):
+    """Extract cancer type/sample type info from TCGA sample barcodes.
+
+    Arguments
+    ---------
+    sample_ids (list-like): TCGA sample barcodes, truncated to 15 characters
+    sampletype_codes_dict (dict): maps last 2 digits of TCGA barcode to sample type
+    cancertype_codes_dict (dict): maps first 2 digits of TCGA barcode to cancer type
+    use_cache (bool): if True, reuse results for previously parsed sample IDs
+
+    Returns
+    -------
+    barcode_df (pd.DataFrame): df with one row per sample, in the same order
+                               as sample_ids, with categorical columns for
+                               each part of the barcode and the stratification
+                               ID (cancer type + sample type) for CV splits
+    """
+    sample_ids = pd.Series(sample_ids, name='sample_id').reset_index(drop=True)
+    cache_key = _get_cache_key(sample_ids,
+                               sampletype_codes_dict,
+                               cancertype_codes_dict)
+    if use_cache and cache_key in _barcode_cache:
+        return _barcode_cache[cache_key].copy()
+
+    tss_codes = sample_ids.str.slice(5, 7)
+    sample_type_codes = sample_ids.str.slice(-2)
+    sample_type = _map_codes(sample_type_codes, sampletype_codes_dict)
+    cancer_type = _map_codes(tss_codes, cancertype_codes_dict)
+    id_for_stratification = pd.Series(cancer_type).str.cat(
+        pd.Series(sample_type).astype('str')
+    )
+
+    barcode_df = pd.DataFrame({
+        'sample_id': sample_ids,
+        'sample_type': sample_type,
+        'cancer_type': cancer_type,
+        'id_for_stratification': pd.Categorical(id_for_stratification),
+        'tss_code': pd.Categorical(tss_codes),
+        'participant': pd.Categorical(sample_ids.str.slice(8, 12)),
+        'sample_type_code': pd.Categorical(sample_type_codes),
+        'stratify_samples_count': get_stratification_counts(
+            id_for_stratification),
+    })
+
+    if use_cache:
+        _barcode_cache[cache_key] = barcode_df.copy()
+    return barcode_df
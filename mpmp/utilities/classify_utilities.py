@@ -4,10 +4,18 @@ Functions for training classifiers on TCGA data.
 Many of these functions are adapted from:
 https://github.com/greenelab/BioBombe/blob/master/9.tcga-classify/scripts/tcga_util.py
 """
+import copy
+import hashlib
+import os
+import threading
+import time
 import warnings
+from collections import OrderedDict
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
+from scipy.special import expit
 from sklearn.pipeline import Pipeline
 from sklearn.linear_model import SGDClassifier
 from sklearn.metrics import (
@@ -16,13 +24,15 @@ from sklearn.metrics import (
     precision_recall_curve,
     average_precision_score
 )
-from sklearn.model_selection import (
-    StratifiedKFold,
-    cross_val_predict,
-    GridSearchCV,
-)
+from sklearn.model_selection import StratifiedKFold
 
 import mpmp.config as cfg
+import mpmp.utilities.barcode_utilities as bu
+import mpmp.utilities.compression_utilities as cmp
+import mpmp.utilities.model_utilities as mu
+import mpmp.utilities.resource_utilities as ru
+import mpmp.utilities.solver_utilities as su
+import mpmp.utilities.stream_utilities as stream
 import mpmp.utilities.tcga_utilities as tu
 from mpmp.exceptions import (
     NoTrainSamplesError,
@@ -30,6 +40,14 @@ from mpmp.exceptions import (
     OneClassError,
 )
 
+# fold assignments, keyed by hash of samples/stratification IDs, seed and
+# number of folds (see get_fold_assignments)
+_fold_assignment_cache = {}
+
+# feature covariances for the gram solver, keyed by hash of the training
+# samples and features, number of inner folds and seed (see get_gram_cache)
+_gram_caches = OrderedDict()
+
 def run_cv_stratified(data_model,
                       exp_string,
                       identifier,
@@ -38,7 +56,10 @@ def run_cv_stratified(data_model,
                       num_folds,
                       shuffle_labels=False,
                       standardize_columns=False,
-                      output_preds=False):
+                      output_preds=False,
+                      solver=cfg.default_solver,
+                      search=cfg.default_search,
+                      warm_start=False):
     """
     Run stratified cross-validation experiments for a given dataset, then write
     the results to files in the results directory. If the relevant files already
@@ -55,120 +76,674 @@ def run_cv_stratified(data_model,
     shuffle_labels (bool): whether or not to shuffle labels (negative control)
     standardize_columns (bool): whether or not to standardize predictors
     output_preds (bool): whether or not to write predictions to file
+    solver (str): how to fit models, options in cfg.solvers
+    search (str): how to search over hyperparameters, options in
+                  cfg.search_methods
+    warm_start (bool): whether or not to initialize the fits for each outer
+                       fold from the previous fold's solutions, for the same
+                       hyperparameters (see solver_utilities.WarmStartCache),
+                       this is only supported for the 'path' solver
     """
+    if solver == 'stream':
+        return run_cv_streaming(data_model,
+                                exp_string,
+                                identifier,
+                                training_data,
+                                sample_info,
+                                num_folds,
+                                shuffle_labels=shuffle_labels,
+                                standardize_columns=standardize_columns,
+                                output_preds=output_preds)
+
+    results = _init_results(exp_string, output_preds)
+    signal = 'shuffled' if shuffle_labels else 'signal'
+
+    fold_assignments = get_cv_fold_assignments(data_model,
+                                               identifier,
+                                               sample_info,
+                                               num_folds)
+
+    # solutions are only shared between the folds of this experiment, not
+    # between signal and shuffled runs (the shuffled labels have an
+    # unrelated optimum, and we don't want the signal model to leak into
+    # the negative control)
+    warm_start_cache = su.WarmStartCache() if warm_start else None
+
+    for fold_no in range(num_folds):
+
+        (X_train_df,
+         X_test_df,
+         y_train_df,
+         y_test_df,
+         preprocessing) = get_fold_data(data_model,
+                                        sample_info,
+                                        fold_assignments,
+                                        fold_no,
+                                        standardize_columns,
+                                        return_preprocessing=True)
+
+        try:
+            model_results = train_model(
+                X_train=X_train_df,
+                X_test=X_test_df,
+                y_train=y_train_df,
+                alphas=cfg.alphas,
+                l1_ratios=cfg.l1_ratios,
+                seed=data_model.seed,
+                n_folds=cfg.folds,
+                max_iter=cfg.max_iter,
+                solver=solver,
+                search=search,
+                warm_start_cache=warm_start_cache
+            )
+        except ValueError as e:
+            check_one_class_error(e, identifier)
+
+        fold_results = get_fold_results(model_results,
+                                        X_train_df,
+                                        X_test_df,
+                                        y_train_df,
+                                        y_test_df,
+                                        identifier,
+                                        training_data,
+                                        signal,
+                                        data_model.seed,
+                                        fold_no,
+                                        output_preds=output_preds,
+                                        preprocessing=preprocessing)
+
+        for result_type, result_df in fold_results.items():
+            results['{}_{}'.format(exp_string, result_type)].append(result_df)
+
+    return results
+
+
+
+def _init_results(exp_string, output_preds=False):
     results = {
         '{}_metrics'.format(exp_string): [],
         '{}_auc'.format(exp_string): [],
         '{}_aupr'.format(exp_string): [],
         '{}_coef'.format(exp_string): [],
+        '{}_model'.format(exp_string): [],
+        '{}_fits'.format(exp_string): [],
     }
-    signal = 'shuffled' if shuffle_labels else 'signal'
-
     if output_preds:
         results['{}_preds'.format(exp_string)] = []
+    return results
 
-    for fold_no in range(num_folds):
 
+def run_cv_multi_target(data_model,
+                        exp_string,
+                        identifiers,
+                        training_data,
+                        sample_info,
+                        num_folds,
+                        shuffle_labels=False,
+                        standardize_columns=False,
+                        output_preds=False):
+    """
+    Run stratified cross-validation experiments for a list of genes, fitting
+    genes that have the same samples (and thus the same data matrix and CV
+    folds) together with the 'prox' solver.
+
+    Genes that don't share their samples with any other gene are fit one at a
+    time, with run_cv_stratified. Since each target is fit independently
+    (see solver_utilities.fit_logistic_enet), results for a gene are the same
+    whether it's fit alone or with other genes.
+
+    Arguments
+    ---------
+    data_model (TCGADataModel): class containing TCGA data
+    exp_string (str): string describing the experiment being run
+    identifiers (list): list of (gene, classification, gene_dir) tuples
+    training_data (str): what type of data is being used to train model
+    sample_info (pd.DataFrame): df with TCGA sample information
+    num_folds (int): number of cross-validation folds to run
+    shuffle_labels (bool): whether or not to shuffle labels (negative control)
+    standardize_columns (bool): whether or not to standardize predictors
+    output_preds (bool): whether or not to write predictions to file
+
+    Returns
+    -------
+    all_results (dict): maps each gene to its results (in the same format as
+                        run_cv_stratified), or to the error raised if the
+                        experiment couldn't be run
+    """
+    # first, get labels for each gene and group genes by sample set; we
+    # keep the data matrix for the first gene in each group, so it doesn't
+    # have to be aligned again when the group is fit (genes in the same
+    # group share the same data matrix)
+    all_results, groups, group_data = {}, {}, {}
+    for identifier, classification, gene_dir in identifiers:
         try:
-            with warnings.catch_warnings():
-                # sklearn warns us if one of the stratification classes has fewer
-                # members than num_folds: in our case that will be the 'other'
-                # class, and it's fine to distribute those unevenly. so here we
-                # can ignore that warning.
-                warnings.filterwarnings('ignore',
-                                        message='The least populated class in y')
-                X_train_raw_df, X_test_raw_df, _ = split_stratified(
-                   data_model.X_df, sample_info, num_folds=num_folds,
-                   fold_no=fold_no, seed=data_model.seed)
-        except ValueError:
-            if data_model.X_df.shape[0] == 0:
-                raise NoTrainSamplesError(
-                    'No train samples found for identifier: {}'.format(
-                        identifier)
+            # each gene gets its own random stream for shuffling labels,
+            # the same as when experiments are run one at a time
+            data_model.set_experiment_seed(identifier, shuffle_labels)
+            data_model.process_data_for_gene(identifier,
+                                             classification,
+                                             gene_dir,
+                                             shuffle_labels=shuffle_labels)
+        except KeyError as e:
+            all_results[identifier] = e
+            continue
+        group_key = get_sample_set_key(data_model.X_df, data_model.gene_features)
+        if group_key not in groups:
+            groups[group_key] = []
+            group_data[group_key] = (data_model.X_df, data_model.gene_features)
+        groups[group_key].append((identifier, classification, data_model.y_df))
+
+    for group_key, group in groups.items():
+        identifier, classification, y_df = group[0]
+        data_model.X_df, data_model.gene_features = group_data.pop(group_key)
+        data_model.y_df = y_df
+        if len(group) == 1:
+            try:
+                all_results[identifier] = run_cv_stratified(
+                    data_model,
+                    exp_string,
+                    identifier,
+                    training_data,
+                    sample_info,
+                    num_folds,
+                    shuffle_labels=shuffle_labels,
+                    standardize_columns=standardize_columns,
+                    output_preds=output_preds,
+                    solver='prox'
                 )
+            except (NoTrainSamplesError, OneClassError) as e:
+                all_results[identifier] = e
+        else:
+            all_results.update(_run_cv_shared_samples(
+                data_model,
+                exp_string,
+                {identifier: y_df for identifier, _, y_df in group},
+                training_data,
+                sample_info,
+                num_folds,
+                shuffle_labels,
+                standardize_columns,
+                output_preds
+            ))
+
+    return all_results
+
+
+def _run_cv_shared_samples(data_model,
+                           exp_string,
+                           y_dfs,
+                           training_data,
+                           sample_info,
+                           num_folds,
+                           shuffle_labels,
+                           standardize_columns,
+                           output_preds):
+    """Run CV for genes with the same samples, see run_cv_multi_target."""
+    signal = 'shuffled' if shuffle_labels else 'signal'
+    try:
+        fold_assignments = get_cv_fold_assignments(data_model,
+                                                   list(y_dfs.keys())[0],
+                                                   sample_info,
+                                                   num_folds)
+    except NoTrainSamplesError as e:
+        return {identifier: e for identifier in y_dfs}
 
-        y_train_df = data_model.y_df.reindex(X_train_raw_df.index)
-        y_test_df = data_model.y_df.reindex(X_test_raw_df.index)
+    results = {identifier: _init_results(exp_string, output_preds)
+                 for identifier in y_dfs}
 
-        X_train_df, X_test_df = tu.preprocess_data(X_train_raw_df,
-                                                   X_test_raw_df,
-                                                   data_model.gene_features,
-                                                   standardize_columns,
-                                                   data_model.subset_mad_genes)
+    for fold_no in range(num_folds):
 
-        if cfg.subsample_to_smallest:
-            sample_counts_df = pd.read_csv(cfg.sample_counts, sep='\t')
-            X_train_df, y_train_df = tu.subsample_to_smallest_cancer_type(
-                    X_train_df, y_train_df, sample_info, data_model.seed)
-            X_test_df, y_test_df = tu.subsample_to_smallest_cancer_type(
-                    X_test_df, y_test_df, sample_info, data_model.seed)
+        # if a gene fails in one fold (e.g. only one class in the test set),
+        # we don't need to keep fitting it
+        targets = [identifier for identifier in y_dfs
+                     if not isinstance(results[identifier], Exception)]
+        if len(targets) == 0:
+            break
+
+        # the labels here are only used for subsampling (if applicable),
+        # which doesn't depend on the labels
+        X_train_df, X_test_df, _, _, preprocessing = get_fold_data(
+            data_model,
+            sample_info,
+            fold_assignments,
+            fold_no,
+            standardize_columns,
+            return_preprocessing=True
+        )
+        y_train_dfs = [y_dfs[t].reindex(X_train_df.index) for t in targets]
+        y_test_dfs = [y_dfs[t].reindex(X_test_df.index) for t in targets]
 
         try:
-            model_results = train_model(
+            model_results = train_multi_target_model(
                 X_train=X_train_df,
                 X_test=X_test_df,
-                y_train=y_train_df,
+                Y_train=pd.concat([y_df.status for y_df in y_train_dfs],
+                                  axis=1, keys=targets),
                 alphas=cfg.alphas,
                 l1_ratios=cfg.l1_ratios,
-                seed=data_model.seed,
                 n_folds=cfg.folds,
                 max_iter=cfg.max_iter
             )
-        except ValueError as e:
-            if ('Only one class' in str(e)) or ('got 1 class' in str(e)):
-                raise OneClassError(
-                    'Only one class present in test set for identifier: '
-                    '{}'.format(identifier)
-                )
-            else:
-                # if not only one class error, just re-raise
-                raise e
-
-        (cv_pipeline,
-         y_pred_train,
-         y_pred_test,
-         y_cv_df) = model_results
-
-        # get coefficients
-        coef_df = extract_coefficients(
-            cv_pipeline=cv_pipeline,
-            feature_names=X_train_df.columns,
-            signal=signal,
-            seed=data_model.seed
-        )
-        coef_df = coef_df.assign(identifier=identifier)
-        coef_df = coef_df.assign(training_data=training_data)
-        coef_df = coef_df.assign(fold=fold_no)
+        except ValueError:
+            # at least one gene has only one class in some split, so fit
+            # the genes one at a time to find out which one(s)
+            model_results = []
+            for y_train_df in y_train_dfs:
+                try:
+                    model_results.append(train_model(
+                        X_train=X_train_df,
+                        X_test=X_test_df,
+                        y_train=y_train_df,
+                        alphas=cfg.alphas,
+                        l1_ratios=cfg.l1_ratios,
+                        seed=data_model.seed,
+                        n_folds=cfg.folds,
+                        max_iter=cfg.max_iter,
+                        solver='prox'
+                    ))
+                except ValueError as e:
+                    model_results.append(e)
+
+        for identifier, target_results, y_train_df, y_test_df in zip(
+                targets, model_results, y_train_dfs, y_test_dfs):
+            try:
+                if isinstance(target_results, Exception):
+                    check_one_class_error(target_results, identifier)
+                fold_results = get_fold_results(target_results,
+                                                X_train_df,
+                                                X_test_df,
+                                                y_train_df,
+                                                y_test_df,
+                                                identifier,
+                                                training_data,
+                                                signal,
+                                                data_model.seed,
+                                                fold_no,
+                                                output_preds=output_preds,
+                                                preprocessing=preprocessing)
+            except OneClassError as e:
+                results[identifier] = e
+                continue
+            for result_type, result_df in fold_results.items():
+                results[identifier]['{}_{}'.format(exp_string, result_type)].append(
+                    result_df)
+
+    return results
+
+
+def run_cv_streaming(data_model,
+                     exp_string,
+                     identifier,
+                     training_data,
+                     sample_info,
+                     num_folds,
+                     shuffle_labels=False,
+                     standardize_columns=False,
+                     output_preds=False,
+                     batch_size=cfg.stream_batch_size):
+    """
+    Run stratified cross-validation experiments for a given dataset, reading
+    the data in batches of samples from a memory-mapped file.
+
+    Results should be about the same as for run_cv_stratified with the 'sgd'
+    solver, but the data for each fold is never copied, and models are fit
+    with partial_fit on one batch of samples at a time (see
+    stream_utilities.py). The loaded data matrix is written to disk the first
+    time this is called for a data model, and reused after that.
+
+    Arguments
+    ---------
+    data_model (TCGADataModel): class containing preprocessed train/test data
+    exp_string (str): string describing the experiment being run
+    identifier (str): string describing the target value/environment
+    training_data (str): what type of data is being used to train model
+    sample_info (pd.DataFrame): df with TCGA sample information
+    num_folds (int): number of cross-validation folds to run
+    shuffle_labels (bool): whether or not to shuffle labels (negative control)
+    standardize_columns (bool): whether or not to standardize predictors
+    output_preds (bool): whether or not to write predictions to file
+    batch_size (int): number of samples to read at a time
+    """
+    if data_model.fold_compression:
+        raise ValueError('fold compression is not supported for solver stream')
+
+    results = _init_results(exp_string, output_preds)
+    signal = 'shuffled' if shuffle_labels else 'signal'
+
+    fold_assignments = get_cv_fold_assignments(data_model,
+                                               identifier,
+                                               sample_info,
+                                               num_folds)
+
+    # the loaded data is written to disk once per data model, and only
+    # the rows needed for each batch are read from it
+    X = stream.ExperimentMatrix(
+        stream.get_data_store(data_model, batch_size=batch_size),
+        data_model.data_df,
+        data_model.X_df,
+        data_model.gene_features
+    )
+
+    for fold_no in range(num_folds):
+
+        train_ixs, test_ixs = get_fold_ixs(fold_assignments, fold_no)
+        if cfg.subsample_to_smallest:
+            cancer_types = sample_info.cancer_type.reindex(
+                data_model.X_df.index).values
+            train_ixs = train_ixs[tu.subsample_to_smallest_cancer_type(
+                cancer_types[train_ixs], data_model.seed)]
+            test_ixs = test_ixs[tu.subsample_to_smallest_cancer_type(
+                cancer_types[test_ixs], data_model.seed)]
+        y_train_df = data_model.y_df.reindex(
+            data_model.X_df.index[train_ixs])
+        y_test_df = data_model.y_df.reindex(
+            data_model.X_df.index[test_ixs])
+
+        # features are selected on the training set, then the train and
+        # test sets are standardized independently, like get_fold_data
+        train_scaler = stream.get_fold_scaler(X,
+                                              train_ixs,
+                                              data_model.gene_features,
+                                              standardize_columns,
+                                              data_model.subset_mad_genes,
+                                              batch_size=batch_size)
+        test_scaler = copy.copy(train_scaler).fit(X, test_ixs)
+        train_scaler.fit(X, train_ixs)
 
         try:
-            metric_df, auc_df, aupr_df = get_metrics(
-                y_train_df, y_test_df, y_cv_df, y_pred_train,
-                y_pred_test, identifier, training_data, signal,
-                data_model.seed, fold_no
-            )
+            start_time = time.time()
+            cv_pipeline = stream.StreamingSGDSearchCV(
+                alphas=cfg.alphas,
+                l1_ratios=cfg.l1_ratios,
+                cv=cfg.folds,
+                max_iter=cfg.max_iter,
+                batch_size=batch_size,
+                seed=data_model.seed
+            ).fit(X, y_train_df.status, train_ixs, train_scaler)
+            cv_pipeline.fit_time_ = time.time() - start_time
         except ValueError as e:
-            if 'Only one class' in str(e):
-                raise OneClassError(
-                    'Only one class present in test set for identifier: '
-                    '{}'.format(identifier)
-                )
-            else:
-                # if not only one class error, just re-raise
-                raise e
-
-        results['{}_metrics'.format(exp_string)].append(metric_df)
-        results['{}_auc'.format(exp_string)].append(auc_df)
-        results['{}_aupr'.format(exp_string)].append(aupr_df)
-        results['{}_coef'.format(exp_string)].append(coef_df)
+            check_one_class_error(e, identifier)
 
+        model_results = (
+            cv_pipeline,
+            cv_pipeline.decision_function_rows(X, train_ixs, train_scaler),
+            cv_pipeline.decision_function_rows(X, test_ixs, test_scaler),
+            cv_pipeline.cv_decision_function_
+        )
+        # only the feature names are used from the data frames here,
+        # test set predictions are added below
+        feature_names = data_model.X_df.columns[train_scaler.feature_ixs]
+        preprocessing = {
+            'input_features': feature_names.values.astype(str),
+            'standardize_mask': train_scaler.standardize_mask,
+            'center': train_scaler.mean_,
+            'scale': train_scaler.scale_,
+        }
+        fold_results = get_fold_results(model_results,
+                                        pd.DataFrame(columns=feature_names),
+                                        None,
+                                        y_train_df,
+                                        y_test_df,
+                                        identifier,
+                                        training_data,
+                                        signal,
+                                        data_model.seed,
+                                        fold_no,
+                                        preprocessing=preprocessing)
         if output_preds:
-            results['{}_preds'.format(exp_string)].append(
-                get_preds(X_test_df, y_test_df, cv_pipeline, fold_no)
-            )
+            fold_results['preds'] = pd.DataFrame({
+                'fold_no': fold_no,
+                'true_class': y_test_df.status,
+                'positive_prob': expit(model_results[2])
+            }, index=y_test_df.index)
+
+        for result_type, result_df in fold_results.items():
+            results['{}_{}'.format(exp_string, result_type)].append(result_df)
 
     return results
 
 
+def get_sample_set_key(X_df, gene_features):
+    """Get a hash identifying the samples/features in a data matrix.
+
+    Gene features are subset from the same data for every gene, so we only
+    need to hash the sample IDs, the feature names, and the covariate values
+    (which can depend on the samples included).
+    """
+    h = hashlib.sha1()
+    h.update('\t'.join(X_df.index.astype(str)).encode())
+    h.update(b'\n')
+    h.update('\t'.join(X_df.columns.astype(str)).encode())
+    h.update(pd.util.hash_pandas_object(
+        X_df.loc[:, ~gene_features], index=False
+    ).values.tobytes())
+    return h.hexdigest()
+
+
+def get_cv_fold_assignments(data_model, identifier, sample_info, num_folds):
+    """Get outer CV fold assignments for the current identifier.
+
+    This is a wrapper around get_fold_assignments that handles the
+    stratification warning, and the case where there are no samples.
+    """
+    try:
+        with warnings.catch_warnings():
+            # sklearn warns us if one of the stratification classes has fewer
+            # members than num_folds: in our case that will be the 'other'
+            # class, and it's fine to distribute those unevenly. so here we
+            # can ignore that warning.
+            warnings.filterwarnings('ignore',
+                                    message='The least populated class in y')
+            return get_fold_assignments(
+                data_model.X_df, sample_info, num_folds=num_folds,
+                seed=data_model.seed,
+                cache_dir=(None if data_model.test else cfg.fold_assignments_dir))
+    except ValueError:
+        if data_model.X_df.shape[0] == 0:
+            raise NoTrainSamplesError(
+                'No train samples found for identifier: {}'.format(
+                    identifier)
+            )
+        raise
+
+
+def get_fold_data(data_model,
+                  sample_info,
+                  fold_assignments,
+                  fold_no,
+                  standardize_columns=False,
+                  return_preprocessing=False):
+    """Get preprocessed train/test data for a single outer CV fold.
+
+    Arguments
+    ---------
+    data_model (TCGADataModel): class containing preprocessed train/test data
+    sample_info (pd.DataFrame): df with TCGA sample information
+    fold_assignments (np.array): fold number for each row of data_model.X_df
+    fold_no (int): which fold to use as the test set
+    standardize_columns (bool): whether or not to standardize predictors
+    return_preprocessing (bool): whether or not to return the preprocessing
+                                 parameters fit on the training data
+
+    Returns
+    -------
+    X_train_df, X_test_df, y_train_df, y_test_df (pd.DataFrame): train/test
+        data and labels for the given fold
+    preprocessing (dict): preprocessing parameters for the given fold (see
+                          model_utilities.get_preprocessing_params), only
+                          returned if return_preprocessing is True
+    """
+    train_ixs, test_ixs = get_fold_ixs(fold_assignments, fold_no)
+    if cfg.subsample_to_smallest:
+        # subsample positions within each split, so the data is only
+        # indexed (and copied) once per split
+        cancer_types = sample_info.cancer_type.reindex(
+            data_model.X_df.index).values
+        train_ixs = train_ixs[tu.subsample_to_smallest_cancer_type(
+            cancer_types[train_ixs], data_model.seed)]
+        test_ixs = test_ixs[tu.subsample_to_smallest_cancer_type(
+            cancer_types[test_ixs], data_model.seed)]
+    X_train_raw_df = data_model.X_df.iloc[train_ixs]
+    X_test_raw_df = data_model.X_df.iloc[test_ixs]
+
+    y_train_df = data_model.y_df.reindex(X_train_raw_df.index)
+    y_test_df = data_model.y_df.reindex(X_test_raw_df.index)
+
+    X_train_df, X_test_df = tu.preprocess_data(X_train_raw_df,
+                                               X_test_raw_df,
+                                               data_model.gene_features,
+                                               standardize_columns,
+                                               data_model.subset_mad_genes)
+
+    non_gene_features = data_model.X_df.columns[~data_model.gene_features]
+    preprocessed_features = X_train_df.columns
+    projection = None
+    if data_model.fold_compression:
+        # fit compression on training fold only, projections are cached
+        # in the data model so they can be reused for other identifiers
+        # (or the shuffled control) with the same training samples
+        X_train_df, X_test_df, projection = cmp.compress_fold(
+            X_train_df,
+            X_test_df,
+            data_model.X_df.columns[~data_model.gene_features],
+            data_model.n_dim,
+            seed=data_model.seed,
+            cache=data_model.fold_projections,
+            standardize_columns=standardize_columns,
+            verbose=data_model.verbose,
+            return_projection=True
+        )
+
+    if return_preprocessing:
+        preprocessing = mu.get_preprocessing_params(X_train_raw_df,
+                                                    preprocessed_features,
+                                                    non_gene_features,
+                                                    standardize_columns,
+                                                    projection)
+        return X_train_df, X_test_df, y_train_df, y_test_df, preprocessing
+    return X_train_df, X_test_df, y_train_df, y_test_df
+
+
+def check_one_class_error(e, identifier):
+    """Raise OneClassError if e was caused by only having one class of labels.
+
+    Otherwise, re-raise e.
+    """
+    if ('Only one class' in str(e)) or ('got 1 class' in str(e)):
+        raise OneClassError(
+            'Only one class present in test set for identifier: '
+            '{}'.format(identifier)
+        )
+    else:
+        # if not only one class error, just re-raise
+        raise e
+
+
+def get_fold_results(model_results,
+                     X_train_df,
+                     X_test_df,
+                     y_train_df,
+                     y_test_df,
+                     identifier,
+                     training_data,
+                     signal,
+                     seed,
+                     fold_no,
+                     output_preds=False,
+                     preprocessing=None):
+    """Get coefficients and performance metrics for a single outer CV fold.
+
+    Arguments
+    ---------
+    model_results (tuple): output of train_model
+    X_train_df, X_test_df, y_train_df, y_test_df (pd.DataFrame): train/test
+        data and labels for the given fold
+    identifier (str): string describing the target value/environment
+    training_data (str): what type of data is being used to train model
+    signal (str): 'signal' or 'shuffled'
+    seed (int): seed used for model training
+    fold_no (int): which fold was used as the test set
+    output_preds (bool): whether or not to get test set predictions
+    preprocessing (dict): preprocessing parameters for the given fold, if
+                          provided a model artifact is included in the
+                          results (see model_utilities.get_model_artifact)
+
+    Returns
+    -------
+    fold_results (dict): maps result type ('metrics', 'auc', 'aupr', 'coef',
+                         'preds' if output_preds, 'model' if
+                         preprocessing is provided, and 'fits' if the
+                         search recorded convergence information for each
+                         fit) to results
+    """
+    (cv_pipeline,
+     y_pred_train,
+     y_pred_test,
+     y_cv_df) = model_results
+
+    # get coefficients
+    coef_df = extract_coefficients(
+        cv_pipeline=cv_pipeline,
+        feature_names=X_train_df.columns,
+        signal=signal,
+        seed=seed
+    )
+    coef_df = coef_df.assign(identifier=identifier)
+    coef_df = coef_df.assign(training_data=training_data)
+    coef_df = coef_df.assign(fold=fold_no)
+
+    try:
+        metric_df, auc_df, aupr_df = get_metrics(
+            y_train_df, y_test_df, y_cv_df, y_pred_train,
+            y_pred_test, identifier, training_data, signal,
+            seed, fold_no
+        )
+    except ValueError as e:
+        check_one_class_error(e, identifier)
+
+    # record how much work it took to fit the model, this is useful for
+    # comparing solvers/search methods
+    metric_df = metric_df.assign(
+        n_fits=getattr(cv_pipeline, 'n_fits_', np.nan),
+        fit_time=getattr(cv_pipeline, 'fit_time_', np.nan),
+        bytes_serialized=getattr(cv_pipeline, 'bytes_serialized_', np.nan),
+        n_iter=getattr(cv_pipeline, 'n_iter_', np.nan),
+        n_iter_saved=getattr(cv_pipeline, 'n_iter_saved_', np.nan)
+    )
+
+    fold_results = {
+        'metrics': metric_df,
+        'auc': auc_df,
+        'aupr': aupr_df,
+        'coef': coef_df,
+    }
+    if output_preds:
+        fold_results['preds'] = get_preds(X_test_df, y_test_df,
+                                          cv_pipeline, fold_no)
+    if getattr(cv_pipeline, 'fit_info_', None) is not None:
+        # iterations, fit time, training loss and convergence status for
+        # every fit in the search
+        fold_results['fits'] = cv_pipeline.fit_info_.assign(
+            identifier=identifier,
+            training_data=training_data,
+            signal=signal,
+            seed=seed,
+            fold=fold_no
+        )
+    if preprocessing is not None:
+        fold_results['model'] = dict(
+            mu.get_model_artifact(cv_pipeline,
+                                  X_train_df.columns,
+                                  preprocessing),
+            identifier=identifier,
+            training_data=training_data,
+            signal=signal,
+            seed=seed,
+            fold=fold_no
+        )
+    return fold_results
+
+
 def get_preds(X_test_df, y_test_df, cv_pipeline, fold_no):
 
     # get probability of belonging to positive class
@@ -264,6 +839,35 @@ def get_metrics(y_train_df, y_test_df, y_cv_df, y_pred_train, y_pred_test,
     return metric_df, auc_df, aupr_df
 
 
+def get_sgd_param_grid(alphas, l1_ratios):
+    """Get hyperparameter grid for the SGDClassifier pipeline."""
+    return {
+        "classify__loss": ["log"],
+        "classify__penalty": ["elasticnet"],
+        "classify__alpha": alphas,
+        "classify__l1_ratio": l1_ratios,
+    }
+
+
+def get_sgd_estimator(seed, max_iter=1000):
+    """Get (unfit) SGDClassifier pipeline used for hyperparameter search."""
+    return Pipeline(
+        steps=[
+            (
+                "classify",
+                SGDClassifier(
+                    random_state=seed,
+                    class_weight="balanced",
+                    loss="log",
+                    max_iter=max_iter,
+                    tol=1e-3,
+                ),
+            )
+        ]
+    )
+
+
+@ru.limit_threads()
 def train_model(X_train,
                 X_test,
                 y_train,
@@ -271,7 +875,10 @@ def train_model(X_train,
                 l1_ratios,
                 seed,
                 n_folds=4,
-                max_iter=1000):
+                max_iter=1000,
+                solver='sgd',
+                search='grid',
+                warm_start_cache=None):
     """
     Build the logic and sklearn pipelines to train x matrix based on input y
 
@@ -284,55 +891,140 @@ def train_model(X_train,
     l1_ratios: list of l1 mixing parameters to perform cross validation over
     n_folds: int of how many folds of cross validation to perform
     max_iter: the maximum number of iterations to test until convergence
+    solver: 'sgd' to fit each grid point from scratch with SGDClassifier,
+            'path' to fit the regularization path with warm starts
+            (see solver_utilities.ElasticNetPathCV), or 'prox' to fit with
+            proximal gradient descent (see solver_utilities.fit_logistic_enet),
+            or 'stream' to fit SGDClassifier on mini-batches with partial_fit
+            (see stream_utilities.StreamingSGDSearchCV), or 'gram' to fit a
+            quadratic approximation with cached feature covariances
+            (see solver_utilities.GramPathCV)
+    search: 'grid' to fit every hyperparameter combination, or 'halving' to
+            use successive halving (see solver_utilities.HalvingOOFGridSearchCV),
+            this only applies to the 'sgd' solver
+    warm_start_cache: solver_utilities.WarmStartCache to initialize fits
+                      from (and save solutions to, for the next call, e.g.
+                      for the next outer CV fold), this only applies to the
+                      'sgd' (with grid search) and 'path' solvers
 
     Returns
     ------
     The full pipeline sklearn object and y matrix predictions for training, testing,
     and cross validation
     """
-    # Setup the classifier parameters
-    clf_parameters = {
-        "classify__loss": ["log"],
-        "classify__penalty": ["elasticnet"],
-        "classify__alpha": alphas,
-        "classify__l1_ratio": l1_ratios,
-    }
-
-    estimator = Pipeline(
-        steps=[
-            (
-                "classify",
-                SGDClassifier(
-                    random_state=seed,
-                    class_weight="balanced",
-                    loss="log",
-                    max_iter=max_iter,
-                    tol=1e-3,
-                ),
+    if search not in cfg.search_methods:
+        raise ValueError('search must be one of: {}'.format(
+            ', '.join(cfg.search_methods)))
+    if search != 'grid' and solver != 'sgd':
+        raise ValueError('search method {} is only supported for '
+                         'solver sgd'.format(search))
+    if warm_start_cache is not None:
+        if solver not in cfg.warm_start_solvers:
+            raise ValueError('warm starts are only supported for solvers: '
+                             '{}'.format(', '.join(cfg.warm_start_solvers)))
+        warm_start_cache.set_features(X_train.columns)
+
+    start_time = time.time()
+    if solver == 'path':
+        cv_pipeline = su.ElasticNetPathCV(
+            alphas=alphas,
+            l1_ratios=l1_ratios,
+            n_folds=n_folds,
+            max_iter=max_iter,
+            seed=seed,
+            warm_start_cache=warm_start_cache
+        )
+        cv_pipeline.fit(X=X_train, y=y_train.status)
+
+        # out-of-fold predictions are saved during the search
+        y_cv = cv_pipeline.cv_decision_function_
+
+    elif solver == 'sgd':
+        clf_parameters = get_sgd_param_grid(alphas, l1_ratios)
+        estimator = get_sgd_estimator(seed, max_iter)
+        # split the core budget between worker processes (one per fit, up
+        # to the budget) and BLAS threads within each worker
+        n_jobs = ru.get_n_jobs(n_folds * len(alphas) * len(l1_ratios))
+
+        if search == 'halving':
+            cv_pipeline = su.HalvingOOFGridSearchCV(
+                estimator=estimator,
+                param_grid=clf_parameters,
+                n_jobs=n_jobs,
+                cv=n_folds,
+                factor=cfg.halving_factor,
+                resource=cfg.halving_resource,
+                random_state=seed,
+            )
+        else:
+            # this is the same as GridSearchCV, but it saves the out-of-fold
+            # predictions for each grid point, so we don't have to refit the
+            # best model on each CV split to get cross-validated predictions
+            cv_pipeline = su.OOFGridSearchCV(
+                estimator=estimator,
+                param_grid=clf_parameters,
+                n_jobs=n_jobs,
+                cv=n_folds,
             )
-        ]
-    )
 
-    cv_pipeline = GridSearchCV(
-        estimator=estimator,
-        param_grid=clf_parameters,
-        n_jobs=-1,
-        cv=n_folds,
-        scoring="roc_auc",
-        return_train_score=True,
-    )
+        # Fit the model, the training data is written to a memory-mapped
+        # file once so it isn't serialized for each worker (or for each
+        # round of successive halving)
+        with su.shared_array(X_train, n_jobs=n_jobs) as X_shared, \
+                ru.worker_config(n_jobs):
+            cv_pipeline.fit(X=X_shared, y=y_train.status)
+
+        # Obtain cross validation results
+        y_cv = cv_pipeline.cv_decision_function_
+
+    elif solver == 'stream':
+        # the data here is already in memory, but this can still be useful
+        # for large data matrices since it doesn't make copies for each
+        # grid search worker (see run_cv_streaming for the version that
+        # reads batches from disk)
+        cv_pipeline = stream.StreamingSGDSearchCV(
+            alphas=alphas,
+            l1_ratios=l1_ratios,
+            cv=n_folds,
+            max_iter=max_iter,
+            seed=seed
+        )
+        cv_pipeline.fit(X=X_train, y=y_train.status)
+
+        y_cv = cv_pipeline.cv_decision_function_
+
+    elif solver == 'gram':
+        # feature covariances are cached, and reused for any other genes
+        # (and the shuffled control) with the same training data
+        cv_pipeline = su.GramPathCV(
+            alphas=alphas,
+            l1_ratios=l1_ratios,
+            n_folds=n_folds,
+            max_iter=max_iter,
+            seed=seed,
+            gram_cache=get_gram_cache(X_train, n_folds, seed)
+        )
+        cv_pipeline.fit(X=X_train, y=y_train.status)
 
-    # Fit the model
-    cv_pipeline.fit(X=X_train, y=y_train.status)
+        y_cv = cv_pipeline.cv_decision_function_
 
-    # Obtain cross validation results
-    y_cv = cross_val_predict(
-        cv_pipeline.best_estimator_,
-        X=X_train,
-        y=y_train.status,
-        cv=n_folds,
-        method="decision_function",
-    )
+    elif solver == 'prox':
+        # this is a multi-target search with one target, see
+        # train_multi_target_model for fitting many targets at once
+        cv_pipeline = su.MultiTargetGridSearchCV(
+            alphas=alphas,
+            l1_ratios=l1_ratios,
+            cv=n_folds,
+            max_iter=max_iter
+        ).fit(X=X_train, Y=y_train.status.values[:, np.newaxis]).searches_[0]
+
+        y_cv = cv_pipeline.cv_decision_function_
+
+    else:
+        raise ValueError('solver must be one of: {}'.format(
+            ', '.join(cfg.solvers)))
+
+    cv_pipeline.fit_time_ = time.time() - start_time
 
     # Get all performance results
     y_predict_train = cv_pipeline.decision_function(X_train)
@@ -341,6 +1033,91 @@ def train_model(X_train,
     return cv_pipeline, y_predict_train, y_predict_test, y_cv
 
 
+def get_gram_cache(X_train, n_folds, seed,
+                   max_bytes=cfg.gram_cache_max_bytes):
+    """Get cached feature covariances for a training set, for the gram solver.
+
+    Caches are identified by the training samples and features, so this
+    assumes training sets with the same samples and features have the same
+    values. That's the case within a data model, since preprocessing only
+    depends on the training samples. The most recently used caches are
+    kept, up to a total of max_bytes (the current one is always kept, even
+    if it's larger than that).
+
+    Arguments
+    ---------
+    X_train (pd.DataFrame): samples x features training data
+    n_folds (int): number of inner CV folds
+    seed (int): seed for inner CV splits
+    max_bytes (float): maximum memory used by caches, in bytes
+
+    Returns
+    -------
+    gram_cache (solver_utilities.GramCache): cache for X_train
+    """
+    h = hashlib.sha1()
+    h.update('\t'.join(X_train.index.astype(str)).encode())
+    h.update(b'\n')
+    h.update('\t'.join(X_train.columns.astype(str)).encode())
+    cache_key = (h.hexdigest(), n_folds, seed)
+    if cache_key in _gram_caches:
+        _gram_caches.move_to_end(cache_key)
+    else:
+        _gram_caches[cache_key] = su.GramCache(
+            np.ascontiguousarray(X_train.values, dtype='float64'),
+            n_folds, seed)
+    # caches grow as columns are added, so we check the total size each
+    # time, rather than only when a new cache is added
+    while (len(_gram_caches) > 1 and
+           sum(c.nbytes for c in _gram_caches.values()) > max_bytes):
+        _gram_caches.popitem(last=False)
+    return _gram_caches[cache_key]
+
+
+def train_multi_target_model(X_train,
+                             X_test,
+                             Y_train,
+                             alphas,
+                             l1_ratios,
+                             n_folds=4,
+                             max_iter=1000):
+    """
+    Train elastic net logistic regression models for several binary targets
+    that share the same training data, with the 'prox' solver.
+
+    Arguments
+    ---------
+    X_train: pandas DataFrame of feature matrix for training data
+    X_test: pandas DataFrame of feature matrix for testing data
+    Y_train: pandas DataFrame of binary labels, one column per target
+    alphas: list of alphas to perform cross validation over
+    l1_ratios: list of l1 mixing parameters to perform cross validation over
+    n_folds: int of how many folds of cross validation to perform
+    max_iter: the maximum number of iterations to test until convergence
+
+    Returns
+    ------
+    List with the same output as train_model, for each target
+    """
+    cv_pipeline = su.MultiTargetGridSearchCV(
+        alphas=alphas,
+        l1_ratios=l1_ratios,
+        cv=n_folds,
+        max_iter=max_iter
+    )
+    start_time = time.time()
+    cv_pipeline.fit(X=X_train, Y=Y_train.values)
+    # models for all targets are fit together, so they share the fit time
+    for search in cv_pipeline.searches_:
+        search.fit_time_ = time.time() - start_time
+
+    return [(search,
+             search.decision_function(X_train),
+             search.decision_function(X_test),
+             search.cv_decision_function_)
+            for search in cv_pipeline.searches_]
+
+
 def extract_coefficients(cv_pipeline, feature_names, signal, seed):
     """
     Pull out the coefficients from the trained classifiers
@@ -425,6 +1202,119 @@ def summarize_results(results,
     return metrics_out_, roc_df_, pr_df_
 
 
+def get_stratification_info(data_df, sample_info_df, num_folds=4):
+    """Get stratification IDs for the samples in data_df.
+
+    Arguments
+    ---------
+    data_df (pd.DataFrame): samples x features dataframe
+    sample_info_df (pd.DataFrame): maps samples to cancer types
+    num_folds (int): number of cross-validation folds, stratification IDs
+                     with fewer samples than this are recoded as 'other'
+
+    Returns
+    -------
+    sample_info_df (pd.DataFrame): sample info for samples in data_df, with
+                                   stratification IDs
+    """
+    # subset sample info to samples in pre-filtered expression data
+    sample_info_df = sample_info_df.reindex(data_df.index)
+
+    # generate id for stratification
+    # this is a concatenation of cancer type and sample/tumor type, since we want
+    # to stratify by both. it's usually precomputed in the sample info file
+    # (see barcode_utilities.parse_barcodes), if not we generate it here
+    if 'id_for_stratification' not in sample_info_df.columns:
+        sample_info_df = sample_info_df.assign(
+            id_for_stratification = sample_info_df.cancer_type.str.cat(
+                                                    sample_info_df.sample_type)
+        )
+    # recode stratification id if they are singletons or near-singletons,
+    # since these won't work with StratifiedKFold
+    id_for_stratification, stratify_counts = bu.recode_stratification_ids(
+        sample_info_df.id_for_stratification, num_folds
+    )
+    sample_info_df = sample_info_df.assign(
+        id_for_stratification = id_for_stratification,
+        stratify_samples_count = stratify_counts
+    )
+    return sample_info_df
+
+
+def get_fold_assignments(data_df,
+                         sample_info_df,
+                         num_folds=4,
+                         seed=cfg.default_seed,
+                         cache_dir=None):
+    """Assign each sample to the cross-validation fold it is held out in.
+
+    This does the same stratified split as split_stratified, but for all
+    folds at once. The assignments only depend on the samples (and their
+    order), the sample info, the seed and the number of folds, so they are
+    cached and can be reused across folds, identifiers and data types.
+
+    Arguments
+    ---------
+    data_df (pd.DataFrame): samples x features dataframe
+    sample_info_df (pd.DataFrame): maps samples to cancer types
+    num_folds (int): number of cross-validation folds
+    seed (int): seed for deterministic splits
+    cache_dir (str): if provided, save fold assignments to (and load them
+                     from) this directory
+
+    Returns
+    -------
+    fold_assignments (np.array): test fold for each sample in data_df
+    """
+    strat_ids = get_stratification_info(
+        data_df, sample_info_df, num_folds
+    ).id_for_stratification
+
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(data_df.index.to_series(),
+                                        index=False).values.tobytes())
+    h.update(pd.util.hash_pandas_object(strat_ids.fillna('nan'),
+                                        index=False).values.tobytes())
+    cache_key = '{}_s{}_f{}'.format(h.hexdigest(), seed, num_folds)
+
+    if cache_key in _fold_assignment_cache:
+        return _fold_assignment_cache[cache_key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = Path(cache_dir, '{}.npy'.format(cache_key))
+        if cache_file.is_file():
+            fold_assignments = np.load(cache_file)
+            _fold_assignment_cache[cache_key] = fold_assignments
+            return fold_assignments
+
+    # do stratified CV splitting once, and store the held out fold
+    # for each sample
+    fold_assignments = np.empty(data_df.shape[0], dtype='int16')
+    kf = StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=seed)
+    for fold, (_, test_ixs) in enumerate(kf.split(data_df, strat_ids)):
+        fold_assignments[test_ixs] = fold
+
+    _fold_assignment_cache[cache_key] = fold_assignments
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, since other processes (or
+        # threads, see prefetch_utilities.py) may be trying to read (or
+        # write) the same file
+        tmp_file = cache_file.with_suffix('.{}_{}.tmp.npy'.format(
+            os.getpid(), threading.get_ident()))
+        np.save(tmp_file, fold_assignments)
+        os.replace(tmp_file, cache_file)
+
+    return fold_assignments
+
+
+def get_fold_ixs(fold_assignments, fold_no):
+    """Get positional indexes of train and test samples for a given fold."""
+    test_mask = (fold_assignments == fold_no)
+    return np.flatnonzero(~test_mask), np.flatnonzero(test_mask)
+
+
 def split_stratified(data_df,
                      sample_info_df,
                      num_folds=4,
@@ -448,34 +1338,12 @@ def split_stratified(data_df,
     train_df (pd.DataFrame): samples x features train data
     test_df (pd.DataFrame): samples x features test data
     """
-    # subset sample info to samples in pre-filtered expression data
-    sample_info_df = sample_info_df.reindex(data_df.index)
-
-    # generate id for stratification
-    # this is a concatenation of cancer type and sample/tumor type, since we want
-    # to stratify by both
-    sample_info_df = sample_info_df.assign(
-        id_for_stratification = sample_info_df.cancer_type.str.cat(
-                                                sample_info_df.sample_type)
-    )
-    # recode stratification id if they are singletons or near-singletons,
-    # since these won't work with StratifiedKFold
-    stratify_counts = sample_info_df.id_for_stratification.value_counts().to_dict()
-    sample_info_df = sample_info_df.assign(
-        stratify_samples_count = sample_info_df.id_for_stratification
-    )
-    sample_info_df.stratify_samples_count = sample_info_df.stratify_samples_count.replace(
-        stratify_counts)
-    sample_info_df.loc[
-        sample_info_df.stratify_samples_count < num_folds, 'id_for_stratification'
-    ] = 'other'
-
-    # now do stratified CV splitting and return the desired fold
-    kf = StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=seed)
-    for fold, (train_ixs, test_ixs) in enumerate(
-            kf.split(data_df, sample_info_df.id_for_stratification)):
-        if fold == fold_no:
-            train_df = data_df.iloc[train_ixs]
-            test_df = data_df.iloc[test_ixs]
+    fold_assignments = get_fold_assignments(data_df,
+                                            sample_info_df,
+                                            num_folds=num_folds,
+                                            seed=seed)
+    train_ixs, test_ixs = get_fold_ixs(fold_assignments, fold_no)
+    train_df = data_df.iloc[train_ixs]
+    test_df = data_df.iloc[test_ixs]
+    sample_info_df = get_stratification_info(data_df, sample_info_df, num_folds)
     return train_df, test_df, sample_info_df
-
@@ -0,0 +1,156 @@
+"""
+Functions for compressing (dimension reducing) TCGA data within
+cross-validation folds.
+
+The precomputed compressed datasets in the data directory are fit on all
+samples, including those that end up in the test set of each CV fold. The
+functions here fit the projection on the training fold only, and cache the
+fitted projection so that it can be reused for every identifier (and for the
+shuffled label control) that shares the same training samples.
+"""
+import hashlib
+import sys
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+
+import mpmp.config as cfg
+import mpmp.utilities.resource_utilities as ru
+
+def get_fold_hash(train_samples, feature_names=None, standardize_columns=False):
+    """Get a hash that uniquely identifies the data in a training fold.
+
+    Arguments
+    ---------
+    train_samples (list-like): sample IDs in the training fold
+    feature_names (list-like): features to be compressed, if None only
+                               the sample IDs are used to build the hash
+    standardize_columns (bool): whether or not features were standardized
+                                before compression
+
+    Returns
+    -------
+    fold_hash (str): hex digest identifying the training fold
+    """
+    h = hashlib.sha1()
+    h.update('\t'.join(np.sort(np.asarray(train_samples, dtype=str))).encode())
+    if feature_names is not None:
+        h.update(b'\n')
+        h.update('\t'.join(np.asarray(feature_names, dtype=str)).encode())
+    h.update(b'\n' + str(bool(standardize_columns)).encode())
+    return h.hexdigest()
+
+
+def get_projection_nbytes(pca):
+    """Get memory used by the arrays in a fitted projection."""
+    return sum(v.nbytes for v in vars(pca).values()
+                 if isinstance(v, np.ndarray))
+
+
+@ru.limit_threads()
+def fit_fold_projection(X_train, n_dim, seed=cfg.default_seed):
+    """Fit a PCA projection to the training data for a single fold.
+
+    This uses the randomized SVD solver, which is much faster than an exact
+    SVD for the number of components we typically use.
+
+    Arguments
+    ---------
+    X_train (array-like): samples x features training data
+    n_dim (int): number of components to keep
+    seed (int): seed for the randomized solver
+
+    Returns
+    -------
+    pca (sklearn.decomposition.PCA): fitted projection
+    """
+    pca = PCA(n_components=n_dim,
+              svd_solver='randomized',
+              random_state=seed)
+    pca.fit(X_train)
+    return pca
+
+
+def compress_fold(X_train_df,
+                  X_test_df,
+                  non_gene_features,
+                  n_dim,
+                  seed=cfg.default_seed,
+                  cache=None,
+                  standardize_columns=False,
+                  verbose=False,
+                  return_projection=False,
+                  max_bytes=cfg.fold_projection_max_bytes):
+    """Compress gene features for a single train/test split.
+
+    The projection is fit to the training data only, then applied to both
+    the training and test data. Non-gene features (e.g. cancer type and
+    mutation burden covariates) are passed through unchanged.
+
+    Arguments
+    ---------
+    X_train_df (pd.DataFrame): samples x features training data
+    X_test_df (pd.DataFrame): samples x features test data
+    non_gene_features (list-like): names of covariate features, these
+                                   won't be compressed
+    n_dim (int): number of components to keep
+    seed (int): seed for the randomized solver
+    cache (OrderedDict): maps (fold hash, n_dim, seed) to fitted projections,
+                         if None don't cache projections
+    standardize_columns (bool): whether or not gene features were
+                                standardized, this is included in the fold hash
+    verbose (bool): whether or not to print verbose output
+    return_projection (bool): whether or not to return the fitted projection
+    max_bytes (float): maximum memory used by cached projections, the least
+                       recently used ones are dropped first (the current
+                       one is always kept, even if it's larger than that)
+
+    Returns
+    -------
+    X_train_cmp_df (pd.DataFrame): compressed training data
+    X_test_cmp_df (pd.DataFrame): compressed test data
+    pca (sklearn.decomposition.PCA): fitted projection, only returned if
+                                     return_projection is True
+    """
+    gene_features = ~X_train_df.columns.isin(non_gene_features)
+    X_train_gene = X_train_df.loc[:, gene_features]
+
+    fold_hash = get_fold_hash(X_train_df.index,
+                              X_train_gene.columns,
+                              standardize_columns)
+    # the randomized solver gives (slightly) different projections for
+    # different seeds, so the seed is part of the key too
+    cache_key = (fold_hash, n_dim, seed)
+    if cache is not None and cache_key in cache:
+        if verbose:
+            print('Using cached projection for fold {}'.format(fold_hash[:8]),
+                  file=sys.stderr)
+        pca = cache[cache_key]
+        cache.move_to_end(cache_key)
+    else:
+        pca = fit_fold_projection(X_train_gene.values, n_dim, seed=seed)
+        if cache is not None:
+            cache[cache_key] = pca
+            while (len(cache) > 1 and
+                   sum(get_projection_nbytes(p)
+                       for p in cache.values()) > max_bytes):
+                cache.popitem(last=False)
+
+    component_names = [str(i) for i in range(pca.n_components_)]
+    X_train_cmp_df = pd.concat((
+        pd.DataFrame(pca.transform(X_train_gene.values),
+                     index=X_train_df.index,
+                     columns=component_names),
+        X_train_df.loc[:, ~gene_features]
+    ), axis=1)
+    X_test_cmp_df = pd.concat((
+        pd.DataFrame(pca.transform(X_test_df.loc[:, X_train_gene.columns].values),
+                     index=X_test_df.index,
+                     columns=component_names),
+        X_test_df.loc[:, X_train_df.columns[~gene_features]]
+    ), axis=1)
+
+    if return_projection:
+        return X_train_cmp_df, X_test_cmp_df, pca
+    return X_train_cmp_df, X_test_cmp_df
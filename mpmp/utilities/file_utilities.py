@@ -6,7 +6,10 @@ import pickle as pkl
 
 import pandas as pd
 
+import mpmp.config as cfg
 from mpmp.exceptions import ResultsFileExistsError
+import mpmp.utilities.model_utilities as mu
+import mpmp.utilities.null_utilities as nu
 
 def make_output_dir(experiment_dir, identifier):
     """Create a directory to write output to."""
@@ -59,17 +62,46 @@ def construct_filename(output_dir,
                                         extension))
 
 
+def get_config_kwargs(model_options):
+    """Get parameters describing an experiment's configuration, for filenames.
+
+    The fold compression, solver, search method and warm start options are
+    only included if they're different from the defaults, so results for the
+    default configuration keep the same filenames. Results for other
+    configurations get their own files, so they aren't skipped (or
+    overwritten) when they're written to the same results directory.
+    """
+    solver = getattr(model_options, 'solver', cfg.default_solver)
+    search = getattr(model_options, 'search', cfg.default_search)
+    return {
+        's': model_options.seed,
+        'n': getattr(model_options, 'n_dim', None),
+        # compression fit within CV folds gives different results than
+        # the precomputed compressed data, with the same n_dim
+        'foldcmp': ('' if getattr(model_options, 'fold_compression', False)
+                    else None),
+        'solver': solver if solver != cfg.default_solver else None,
+        'search': search if search != cfg.default_search else None,
+        # this is a flag, so the filename just contains 'warmstart'
+        'warmstart': '' if getattr(model_options, 'warm_start', False) else None,
+    }
+
+
 def save_model_options(output_dir, model_options):
     """Save model hyperparameters/metadata to output directory.
 
     model_options is an argparse Namespace, and is converted to a dictionary
     and pickled.
     """
+    config_kwargs = get_config_kwargs(model_options)
+    # model options don't depend on n_dim (it's one of the options), so
+    # it isn't included here
+    del config_kwargs['n']
     output_file = construct_filename(output_dir,
                                      'model_options',
                                      '.pkl',
                                      model_options.training_data,
-                                     s=model_options.seed)
+                                     **config_kwargs)
     with open(output_file, 'wb') as f:
         pkl.dump(vars(model_options), f)
 
@@ -90,8 +122,7 @@ def check_output_file(output_dir,
                                     identifier,
                                     model_options.training_data,
                                     signal,
-                                    s=model_options.seed,
-                                    n=model_options.n_dim)
+                                    **get_config_kwargs(model_options))
     if check_file.is_file():
         raise ResultsFileExistsError(
             'Results file already exists for identifier: {}\n'.format(
@@ -141,8 +172,7 @@ def save_results(output_dir,
                                      identifier,
                                      model_options.training_data,
                                      signal,
-                                     s=model_options.seed,
-                                     n=model_options.n_dim)
+                                     **get_config_kwargs(model_options))
     auc_df.to_csv(
         output_file, sep="\t", index=False, float_format="%.5g"
     )
@@ -153,8 +183,7 @@ def save_results(output_dir,
                                      identifier,
                                      model_options.training_data,
                                      signal,
-                                     s=model_options.seed,
-                                     n=model_options.n_dim)
+                                     **get_config_kwargs(model_options))
     aupr_df.to_csv(
         output_file, sep="\t", index=False, float_format="%.5g"
     )
@@ -165,12 +194,40 @@ def save_results(output_dir,
                                      identifier,
                                      model_options.training_data,
                                      signal,
-                                     s=model_options.seed,
-                                     n=model_options.n_dim)
+                                     **get_config_kwargs(model_options))
     metrics_df.to_csv(
         output_file, sep="\t", index=False, float_format="%.5g"
     )
 
+    if results.get('{}_fits'.format(exp_string)):
+        # convergence information for each fit in the hyperparameter search
+        output_file = construct_filename(output_dir,
+                                         'fit_info',
+                                         '.tsv.gz',
+                                         identifier,
+                                         model_options.training_data,
+                                         signal,
+                                         **get_config_kwargs(model_options))
+        pd.concat(results['{}_fits'.format(exp_string)]).to_csv(
+            output_file, sep="\t", index=False, float_format="%.5g"
+        )
+
+    if results.get('{}_model'.format(exp_string)):
+        output_file = construct_filename(output_dir,
+                                         'model',
+                                         '.npz',
+                                         identifier,
+                                         model_options.training_data,
+                                         signal,
+                                         **get_config_kwargs(model_options))
+        # the training configuration is saved with each model, so models
+        # that aren't comparable aren't stacked together when scoring
+        model_config = mu.get_model_config(model_options)
+        mu.save_model_artifacts(output_file, [
+            dict(artifact, **model_config)
+                for artifact in results['{}_model'.format(exp_string)]
+        ])
+
     if preds_df is not None:
         output_file = construct_filename(output_dir,
                                          'preds',
@@ -178,13 +235,30 @@ def save_results(output_dir,
                                          identifier,
                                          model_options.training_data,
                                          signal,
-                                         s=model_options.seed,
-                                         n=model_options.n_dim)
+                                         **get_config_kwargs(model_options))
         preds_df.to_csv(
             output_file, sep="\t", float_format="%.5g"
         )
 
 
+def save_null_distribution(output_dir,
+                           null_results,
+                           identifier,
+                           model_options):
+    """Save permutation null distributions for a single identifier.
+
+    See null_utilities.run_permutation_null for details.
+    """
+    output_file = construct_filename(output_dir,
+                                     'null_distribution',
+                                     '.npz',
+                                     identifier,
+                                     model_options.training_data,
+                                     'signal',
+                                     **get_config_kwargs(model_options))
+    nu.save_null_distribution(output_file, null_results)
+
+
 def generate_log_df(log_columns, log_values):
     """Generate and format log output."""
     return pd.DataFrame(dict(zip(log_columns, log_values)), index=[0])
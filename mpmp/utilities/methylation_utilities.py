@@ -0,0 +1,330 @@
+"""
+Functions for preprocessing TCGA DNA methylation data.
+
+The raw 450K methylation data is too large to comfortably load into memory
+(~40GB as a .tsv file, probes x samples), so the functions here process it in
+chunks of probes. The raw data is first converted to a probe-major binary
+intermediate file, which can be memory-mapped and read in chunks much faster
+than the raw .tsv file.
+"""
+import sys
+import pickle as pkl
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# number of bytes per value in the intermediate file (float32)
+_value_bytes = np.dtype('float32').itemsize
+
+# filenames for the chunked binary intermediate
+_values_file = 'values.f32'
+_metadata_file = 'metadata.pkl'
+
+
+def get_chunk_size(n_values_per_row, max_memory_gb, n_copies=4):
+    """Get the number of rows that fit into the given memory budget.
+
+    Arguments
+    ---------
+    n_values_per_row (int): number of float32 values in a single row
+    max_memory_gb (float): memory budget, in GB
+    n_copies (int): number of copies of each chunk that may be in memory at
+                    the same time (e.g. during parsing or imputation)
+
+    Returns
+    -------
+    chunk_size (int): number of rows to process at once
+    """
+    row_bytes = n_values_per_row * _value_bytes * n_copies
+    return max(1, int((max_memory_gb * 1e9) // row_bytes))
+
+
+def write_intermediate(raw_file,
+                       intermediate_dir,
+                       max_memory_gb=8,
+                       verbose=False):
+    """Convert raw methylation data to a probe-major binary file.
+
+    The raw data is parsed in chunks of probes (rows), using the same parser
+    settings as the preprocessing notebooks (values are loaded as float32).
+
+    Arguments
+    ---------
+    raw_file (str): location of raw probes x samples .tsv file
+    intermediate_dir (str): directory to write intermediate files to
+    max_memory_gb (float): approximate peak memory budget, in GB
+    verbose (bool): whether or not to print verbose output
+    """
+    intermediate_dir = Path(intermediate_dir)
+    intermediate_dir.mkdir(parents=True, exist_ok=True)
+
+    # read header to get number of samples, which determines chunk size
+    header_df = pd.read_csv(raw_file, sep='\t', index_col=0, nrows=0)
+    chunk_size = get_chunk_size(header_df.shape[1], max_memory_gb)
+
+    probes = []
+    values_file = intermediate_dir / _values_file
+    with open(values_file, 'wb') as f:
+        for ix, chunk_df in enumerate(pd.read_csv(raw_file,
+                                                  index_col=0,
+                                                  sep='\t',
+                                                  dtype='float32',
+                                                  converters={0: str},
+                                                  chunksize=chunk_size)):
+            if verbose:
+                print('Writing chunk {} ({} probes)'.format(
+                    ix, chunk_df.shape[0]), file=sys.stderr)
+            np.ascontiguousarray(chunk_df.values, dtype='float32').tofile(f)
+            probes.append(chunk_df.index.values)
+
+    metadata = {
+        'probes': np.concatenate(probes),
+        'samples': header_df.columns.values,
+        'probe_index_name': header_df.index.name,
+    }
+    with open(intermediate_dir / _metadata_file, 'wb') as f:
+        pkl.dump(metadata, f)
+
+
+def load_intermediate(intermediate_dir):
+    """Memory-map a probe-major binary intermediate file.
+
+    Arguments
+    ---------
+    intermediate_dir (str): directory containing intermediate files
+
+    Returns
+    -------
+    values (np.memmap): probes x samples array
+    metadata (dict): probe and sample IDs for the array
+    """
+    intermediate_dir = Path(intermediate_dir)
+    with open(intermediate_dir / _metadata_file, 'rb') as f:
+        metadata = pkl.load(f)
+    shape = (metadata['probes'].shape[0], metadata['samples'].shape[0])
+    values = np.memmap(intermediate_dir / _values_file,
+                       dtype='float32', mode='r', shape=shape)
+    return values, metadata
+
+
+def iterate_chunks(values, chunk_size):
+    """Iterate over (start, stop) ranges of rows in chunks."""
+    for start in range(0, values.shape[0], chunk_size):
+        yield start, min(start + chunk_size, values.shape[0])
+
+
+def get_sample_na_counts(values, chunk_size):
+    """Count NA values for each sample (column), reading in chunks of probes."""
+    sample_na = np.zeros(values.shape[1], dtype='int64')
+    for start, stop in iterate_chunks(values, chunk_size):
+        sample_na += np.isnan(values[start:stop]).sum(axis=0)
+    return sample_na
+
+
+def _chunk_to_df(values_chunk, sample_ids, probe_ids):
+    """Convert a probes x samples chunk to a samples x probes dataframe.
+
+    This has the same memory layout as the transposed dataframe used in the
+    notebooks, so reductions over samples give identical results.
+    """
+    return pd.DataFrame(values_chunk,
+                        index=probe_ids,
+                        columns=sample_ids).transpose()
+
+
+def impute_leq(methylation_df, n_na):
+    """Impute probes with at most n_na missing values using the probe mean.
+
+    Note that for probes with more than n_na missing values, the first n_na
+    will still be imputed. These probes will be dropped later anyway.
+    """
+    if n_na == 0:
+        return methylation_df
+    else:
+        return methylation_df.fillna(methylation_df.mean(), limit=n_na)
+
+
+def preprocess_methylation_data(raw_file,
+                                intermediate_dir,
+                                n_filter=10,
+                                n_impute=5,
+                                max_memory_gb=8,
+                                verbose=False):
+    """Filter and impute raw methylation data, processing it in chunks.
+
+    This reproduces the preprocessing steps from the 450K methylation
+    notebook:
+    1) truncate sample barcodes and remove duplicate samples
+    2) remove the n_filter samples with the most missing values
+    3) impute probes with at most n_impute missing values
+    4) remove probes that still have missing values
+
+    Arguments
+    ---------
+    raw_file (str): location of raw probes x samples .tsv file
+    intermediate_dir (str): directory to write intermediate files to, if a
+                            raw intermediate file exists here already it will
+                            be reused rather than re-parsing raw_file
+    n_filter (int): number of samples to remove
+    n_impute (int): max number of missing values to impute for each probe
+    max_memory_gb (float): approximate peak memory budget, in GB
+    verbose (bool): whether or not to print verbose output
+
+    Returns
+    -------
+    values (np.memmap): filtered probes x samples array
+    metadata (dict): probe and sample IDs for the filtered array
+    mad_values (np.array): mean absolute deviation for each filtered probe
+    """
+    raw_dir = Path(intermediate_dir, 'raw')
+    filtered_dir = Path(intermediate_dir, 'filtered')
+
+    if (raw_dir / _metadata_file).is_file():
+        if verbose:
+            print('Loading raw data from existing intermediate file',
+                  file=sys.stderr)
+    else:
+        if verbose:
+            print('Converting raw data to intermediate file', file=sys.stderr)
+        write_intermediate(raw_file, raw_dir, max_memory_gb, verbose)
+
+    values, metadata = load_intermediate(raw_dir)
+    chunk_size = get_chunk_size(values.shape[1], max_memory_gb)
+
+    # update sample IDs to remove multiple samples measured on the same tumor
+    # and to map with the clinical information
+    sample_ids = pd.Index(metadata['samples']).str.slice(start=0, stop=15)
+    keep_samples = ~sample_ids.duplicated()
+
+    # remove n_filter samples with the most NA values
+    sample_na = pd.Series(
+        get_sample_na_counts(values, chunk_size)[keep_samples],
+        index=sample_ids[keep_samples]
+    )
+    bad_samples = sample_na.sort_values(ascending=False).iloc[:n_filter].index.values
+    keep_samples &= ~sample_ids.isin(bad_samples)
+    sample_ids = sample_ids[keep_samples].rename('sample_id')
+    keep_ixs = np.flatnonzero(keep_samples)
+
+    if verbose:
+        print('Keeping {} of {} samples'.format(
+            keep_ixs.shape[0], keep_samples.shape[0]), file=sys.stderr)
+
+    # then impute and filter probes, one chunk at a time
+    filtered_dir.mkdir(parents=True, exist_ok=True)
+    probe_ids = pd.Index(metadata['probes'], name=metadata['probe_index_name'])
+    filtered_probes, mad_values = [], []
+    with open(filtered_dir / _values_file, 'wb') as f:
+        for start, stop in iterate_chunks(values, chunk_size):
+            chunk_df = _chunk_to_df(values[start:stop, keep_ixs],
+                                    sample_ids,
+                                    probe_ids[start:stop])
+            chunk_df = impute_leq(chunk_df, n_impute).dropna(axis='columns')
+            # this is equivalent to pd.DataFrame.mad, which is deprecated
+            mad_values.append(
+                (chunk_df - chunk_df.mean()).abs().mean().values
+            )
+            filtered_probes.append(chunk_df.columns.values)
+            np.ascontiguousarray(chunk_df.values.T, dtype='float32').tofile(f)
+
+    filtered_metadata = {
+        'probes': np.concatenate(filtered_probes),
+        'samples': sample_ids.values,
+        'probe_index_name': metadata['probe_index_name'],
+    }
+    with open(filtered_dir / _metadata_file, 'wb') as f:
+        pkl.dump(filtered_metadata, f)
+
+    if verbose:
+        print('Keeping {} of {} probes'.format(
+            filtered_metadata['probes'].shape[0], probe_ids.shape[0]),
+            file=sys.stderr)
+
+    filtered_values, filtered_metadata = load_intermediate(filtered_dir)
+    return filtered_values, filtered_metadata, np.concatenate(mad_values)
+
+
+def subset_by_mad(values, metadata, mad_values, n_mad_genes):
+    """Get a samples x probes dataframe for the probes with highest MAD.
+
+    Arguments
+    ---------
+    values (np.memmap): filtered probes x samples array
+    metadata (dict): probe and sample IDs for the array
+    mad_values (np.array): mean absolute deviation for each probe
+    n_mad_genes (int): number of probes to keep
+
+    Returns
+    -------
+    me_mad_df (pd.DataFrame): samples x probes dataframe, with probes in
+                              descending order of MAD
+    """
+    probe_ids = pd.Index(metadata['probes'], name=metadata['probe_index_name'])
+    mad_genes = pd.Series(mad_values, index=probe_ids)
+    mad_genes.sort_values(ascending=False, inplace=True)
+    top_ixs = probe_ids.get_indexer(mad_genes.iloc[:n_mad_genes].index)
+    # sorting the row indexes makes the memmap read sequential
+    read_order = np.argsort(top_ixs, kind='stable')
+    top_values = np.empty((top_ixs.shape[0], values.shape[1]), dtype='float32')
+    top_values[read_order] = values[top_ixs[read_order]]
+    return _chunk_to_df(top_values,
+                        pd.Index(metadata['samples'], name='sample_id'),
+                        mad_genes.index[:n_mad_genes])
+
+
+def get_probe_count_curve(values,
+                          sample_ixs=None,
+                          max_memory_gb=8,
+                          verbose=False):
+    """Count valid probes after removing samples with the most NA values.
+
+    Samples are removed in descending order of their NA count (as in the
+    methylation preprocessing notebooks). A probe becomes valid (i.e. has
+    no NA values) once every sample where it is NA has been removed, so
+    for each probe we only need the position, in that sorted order, of its
+    last NA sample. This gives the number of valid probes for every number
+    of removed samples in a single pass over the data.
+
+    Arguments
+    ---------
+    values (array-like): probes x samples array, e.g. the memory-mapped
+                         intermediate file from load_intermediate, or the
+                         transposed values of a samples x probes dataframe
+    sample_ixs (array-like): if provided, only use these sample columns
+    max_memory_gb (float): approximate peak memory budget, in GB
+    verbose (bool): whether or not to print verbose output
+
+    Returns
+    -------
+    probe_counts (np.array): probe_counts[i] is the number of probes with no
+                             NA values after removing the i samples with the
+                             most NA values, for i = 0, ..., n_samples
+    """
+    if sample_ixs is None:
+        sample_ixs = np.arange(values.shape[1])
+    else:
+        sample_ixs = np.asarray(sample_ixs)
+    n_samples = sample_ixs.shape[0]
+    chunk_size = get_chunk_size(values.shape[1], max_memory_gb)
+
+    # first pass: get NA counts for each sample, and sort samples by them
+    # (this uses the same sort as pd.Series.sort_values, so ties are broken
+    # in the same order as in the notebooks)
+    sample_na = get_sample_na_counts(values, chunk_size)[sample_ixs]
+    sample_order = (
+        pd.Series(sample_na).sort_values(ascending=False).index.values
+    )
+
+    # second pass: for each probe, get the number of samples that have to be
+    # removed for that probe to be valid
+    removed_counts = np.zeros(n_samples + 1, dtype='int64')
+    for start, stop in iterate_chunks(values, chunk_size):
+        if verbose:
+            print('Counting probes {}-{}'.format(start, stop), file=sys.stderr)
+        na_mask = np.isnan(values[start:stop][:, sample_ixs[sample_order]])
+        last_na = n_samples - np.argmax(na_mask[:, ::-1], axis=1)
+        last_na[~na_mask.any(axis=1)] = 0
+        removed_counts += np.bincount(last_na, minlength=n_samples + 1)
+
+    return np.cumsum(removed_counts)
@@ -0,0 +1,574 @@
+"""
+Functions for saving and loading trained models.
+
+The coefficient files written by file_utilities.save_results are useful for
+looking at which features were selected, but they don't contain enough
+information to apply a model to new data. The model artifacts here contain
+everything needed to get predictions from raw (unpreprocessed) data for a
+single outer CV fold:
+
+* the selected hyperparameters (alpha and l1_ratio)
+* the nonzero coefficients and their indices, and the intercept
+* the raw features used by the model, in order (i.e. the features kept after
+  MAD feature selection, if applicable)
+* the standardization parameters fit on the training data
+* the rows of the in-fold compression projection (if applicable) needed to
+  compute the features that have nonzero coefficients
+
+Artifacts for all folds of an experiment are saved together in a single
+compressed .npz file, which can be loaded without pickle, along with the
+training configuration (solver, search method, warm starts and compression,
+see get_model_config).
+
+To score new samples with many saved models at once, ModelStack combines
+the models into a single sparse weight matrix over raw input features (all
+of the preprocessing steps are linear, so they can be folded into the
+weights), then scores chunks of input rows with one sparse-dense matrix
+multiply per chunk.
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.special import expit
+
+import mpmp.config as cfg
+import mpmp.utilities.stream_utilities as stream
+
+# training configuration saved with each model, with the values for the
+# base configuration (raw features, default solver and search method).
+# Models saved without a configuration are assumed to use these values.
+base_model_config = {
+    'solver': cfg.default_solver,
+    'search': cfg.default_search,
+    'warm_start': False,
+    'n_dim': 0,
+    'fold_compression': False,
+}
+
+def get_model_config(model_options):
+    """Get the training configuration to save with each model artifact.
+
+    Arguments
+    ---------
+    model_options (argparse.Namespace): options for the experiment
+
+    Returns
+    -------
+    model_config (dict): maps each key in base_model_config to its value
+                         for the experiment, n_dim is 0 for models trained
+                         on raw (uncompressed) features
+    """
+    model_config = {key: getattr(model_options, key, default)
+                      for key, default in base_model_config.items()}
+    if model_config['n_dim'] is None:
+        model_config['n_dim'] = 0
+    return model_config
+
+
+def get_scaler_params(X):
+    """Get mean/scale for standardizing X, the same as StandardScaler.
+
+    This uses the population standard deviation, and constant features
+    are only centered.
+    """
+    std = X.std(axis=0)
+    return X.mean(axis=0), np.where(std == 0, 1, std)
+
+
+def get_preprocessing_params(X_train_raw_df,
+                             feature_names,
+                             non_gene_features,
+                             standardize_columns=False,
+                             projection=None):
+    """Get preprocessing parameters for a single outer CV fold.
+
+    This should match the preprocessing done in
+    classify_utilities.get_fold_data (see tcga_utilities.preprocess_data).
+
+    Arguments
+    ---------
+    X_train_raw_df (pd.DataFrame): raw training data, before preprocessing
+    feature_names (list-like): features kept after preprocessing (but before
+                               compression), in order
+    non_gene_features (list-like): names of covariate features, these are
+                                   never standardized or compressed
+    standardize_columns (bool): whether or not gene features were standardized
+    projection (sklearn.decomposition.PCA): in-fold compression fit to the
+                                            gene features, if applicable
+
+    Returns
+    -------
+    preprocessing (dict): preprocessing parameters, see module docstring
+    """
+    feature_names = pd.Index(feature_names)
+    gene_mask = ~feature_names.isin(non_gene_features)
+    standardize_mask = gene_mask & bool(standardize_columns)
+    center = np.zeros(feature_names.shape[0])
+    scale = np.ones(feature_names.shape[0])
+    if standardize_mask.any():
+        center[standardize_mask], scale[standardize_mask] = get_scaler_params(
+            X_train_raw_df.loc[:, feature_names[standardize_mask]].values)
+    preprocessing = {
+        'input_features': feature_names.values.astype(str),
+        'standardize_mask': standardize_mask,
+        'center': center,
+        'scale': scale,
+    }
+    if projection is not None:
+        preprocessing.update({
+            'projected_mask': gene_mask,
+            'projection_mean': projection.mean_,
+            'projection_components': projection.components_,
+        })
+    return preprocessing
+
+
+def get_model_artifact(cv_pipeline, feature_names, preprocessing):
+    """Get a compact representation of the best model from a CV search.
+
+    Arguments
+    ---------
+    cv_pipeline: the trained sklearn cross validation pipeline
+    feature_names (list-like): the column names of the x matrix used to
+                               train the model
+    preprocessing (dict): output of get_preprocessing_params
+
+    Returns
+    -------
+    artifact (dict): maps names to numpy arrays, see module docstring
+    """
+    classifier = cv_pipeline.best_estimator_.named_steps['classify']
+    coef = np.asarray(classifier.coef_).ravel()
+    coef_ix = np.flatnonzero(coef)
+    artifact = {
+        'feature_names': np.asarray(feature_names).astype(str),
+        'coef_ix': coef_ix.astype(np.int32),
+        'coef_value': coef[coef_ix],
+        'intercept': np.asarray(classifier.intercept_).ravel()[0],
+        'alpha': cv_pipeline.best_params_['classify__alpha'],
+        'l1_ratio': cv_pipeline.best_params_['classify__l1_ratio'],
+    }
+    artifact.update({k: v for k, v in preprocessing.items()
+                       if k != 'projection_components'})
+    if 'projection_components' in preprocessing:
+        # compressed features come first (see compression_utilities), and
+        # we only need the components that have nonzero coefficients
+        n_components = preprocessing['projection_components'].shape[0]
+        artifact['projection_components'] = (
+            preprocessing['projection_components'][
+                coef_ix[coef_ix < n_components], :]
+        )
+    return artifact
+
+
+def get_model_features(artifact, X_df, refit_scaler=False):
+    """Preprocess raw data for the features with nonzero coefficients.
+
+    Arguments
+    ---------
+    artifact (dict): model artifact, from get_model_artifact or
+                     load_model_artifacts
+    X_df (pd.DataFrame): raw samples x features data, must contain all the
+                         model's input features
+    refit_scaler (bool): if True, standardize X_df using its own statistics
+                         rather than the training statistics. This matches
+                         how test sets are standardized in our CV experiments
+                         (see tcga_utilities.preprocess_data).
+
+    Returns
+    -------
+    X_model (np.array): samples x nonzero coefficient features, in the same
+                        order as artifact['coef_value']
+    """
+    X = X_df.loc[:, artifact['input_features']].values.astype('float64')
+    center, scale = artifact['center'], artifact['scale']
+    if refit_scaler:
+        standardize_mask = artifact['standardize_mask']
+        center, scale = center.copy(), scale.copy()
+        center[standardize_mask], scale[standardize_mask] = get_scaler_params(
+            X[:, standardize_mask])
+    X = (X - center) / scale
+
+    coef_ix = artifact['coef_ix']
+    if 'projected_mask' not in artifact:
+        return X[:, coef_ix]
+
+    # model features are the compressed gene features, then the covariates
+    projected_mask = artifact['projected_mask']
+    components = artifact['projection_components']
+    n_components = artifact['feature_names'].shape[0] - (~projected_mask).sum()
+    X_model = np.zeros((X.shape[0], coef_ix.shape[0]))
+    is_component = coef_ix < n_components
+    X_model[:, is_component] = (
+        (X[:, projected_mask] - artifact['projection_mean']) @ components.T
+    )
+    X_model[:, ~is_component] = X[:, ~projected_mask][
+        :, coef_ix[~is_component] - n_components]
+    return X_model
+
+
+def decision_function(artifact, X_df, refit_scaler=False):
+    """Get model predictions (log-odds of the positive class) for raw data.
+
+    See get_model_features for arguments.
+    """
+    X_model = get_model_features(artifact, X_df, refit_scaler=refit_scaler)
+    return X_model @ artifact['coef_value'] + artifact['intercept']
+
+
+def save_model_artifacts(output_file, artifacts):
+    """Save model artifacts for each fold of an experiment to a .npz file.
+
+    Arguments
+    ---------
+    output_file (str or Path): file to write to
+    artifacts (list): list of artifacts (from get_model_artifact), each
+                      with a 'fold' key
+    """
+    arrays = {}
+    for artifact in artifacts:
+        for key, value in artifact.items():
+            arrays['fold{}/{}'.format(artifact['fold'], key)] = value
+    # np.savez adds the extension if it's not there, so we open the file
+    # ourselves to make sure it's written to the given filename
+    with open(output_file, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_model_artifacts(input_file):
+    """Load model artifacts saved with save_model_artifacts.
+
+    Returns
+    -------
+    artifacts (dict): maps fold numbers to model artifacts
+    """
+    artifacts = {}
+    with np.load(input_file, allow_pickle=False) as arrays:
+        for name in arrays.files:
+            fold, key = name.split('/', 1)
+            value = arrays[name]
+            if value.ndim == 0:
+                value = value.item()
+            artifacts.setdefault(int(fold[len('fold'):]), {})[key] = value
+    return dict(sorted(artifacts.items()))
+
+
+def get_input_weights(artifact):
+    """Get weights for a model's (preprocessed) input features.
+
+    This folds the compression projection, if any, into the weights, so
+    the model is linear in the standardized input features.
+
+    Returns
+    -------
+    weights (np.array): one weight per input feature
+    intercept (float): model intercept
+    """
+    weights = np.zeros(artifact['input_features'].shape[0])
+    intercept = artifact['intercept']
+    coef_ix, coef_value = artifact['coef_ix'], artifact['coef_value']
+    if 'projected_mask' not in artifact:
+        weights[coef_ix] = coef_value
+        return weights, intercept
+
+    projected_mask = artifact['projected_mask']
+    n_components = artifact['feature_names'].shape[0] - (~projected_mask).sum()
+    is_component = coef_ix < n_components
+    projected_weights = (artifact['projection_components'].T @
+                         coef_value[is_component])
+    weights[projected_mask] = projected_weights
+    weights[np.flatnonzero(~projected_mask)[
+        coef_ix[~is_component] - n_components]] = coef_value[~is_component]
+    return weights, intercept - artifact['projection_mean'] @ projected_weights
+
+
+def get_data_chunks(X, chunk_size=cfg.inference_chunk_size):
+    """Iterate over chunks of rows of a data matrix.
+
+    Arguments
+    ---------
+    X (pd.DataFrame, str or Path): samples x features data, or a file
+                                   containing it. Tab-separated files are
+                                   read a chunk at a time, pickled data
+                                   frames have to be loaded all at once.
+    chunk_size (int): number of rows in each chunk
+
+    Returns
+    -------
+    chunks (iterator): iterator over data frames with at most chunk_size rows
+    """
+    if isinstance(X, (str, Path)):
+        if Path(X).suffix == '.pkl':
+            X = pd.read_pickle(X)
+        else:
+            return pd.read_csv(X, sep='\t', index_col=0, chunksize=chunk_size)
+    return (X.iloc[start:start+chunk_size]
+              for start in range(0, X.shape[0], chunk_size))
+
+
+class ModelStack():
+    """
+    Score samples with many linear models at once.
+
+    Each model's preprocessing (feature selection, standardization and
+    compression) is folded into its weights, so the models are stacked into
+    a single sparse (models x raw input features) weight matrix. Input rows
+    are read in chunks, so the full input matrix doesn't need to be in
+    memory.
+    """
+
+    def __init__(self, artifacts):
+        """
+        Arguments
+        ---------
+        artifacts (list): model artifacts, see get_model_artifact
+        """
+        self.model_info_ = pd.DataFrame([
+            {key: artifact.get(key) for key in
+                ['identifier', 'training_data', 'signal', 'seed', 'fold']}
+            for artifact in artifacts
+        ])
+        self.input_features_ = pd.Index(np.concatenate(
+            [artifact['input_features'] for artifact in artifacts]
+        )).unique()
+
+        # nonzero weights in coordinate format, with the standardization
+        # parameters for each one
+        rows, cols, values, centers, scales, standardized = ([] for _ in range(6))
+        self.intercepts_ = np.zeros(len(artifacts))
+        for model_ix, artifact in enumerate(artifacts):
+            weights, self.intercepts_[model_ix] = get_input_weights(artifact)
+            nz_ixs = np.flatnonzero(weights)
+            rows.append(self.input_features_.get_indexer(
+                artifact['input_features'][nz_ixs]))
+            cols.append(np.full(nz_ixs.shape[0], model_ix))
+            values.append(weights[nz_ixs])
+            centers.append(artifact['center'][nz_ixs])
+            scales.append(artifact['scale'][nz_ixs])
+            standardized.append(artifact['standardize_mask'][nz_ixs])
+        (self.rows_, self.cols_, self.values_, self.centers_, self.scales_,
+         self.standardized_) = (np.concatenate(a) for a in
+            (rows, cols, values, centers, scales, standardized))
+
+    @property
+    def n_models(self):
+        return self.intercepts_.shape[0]
+
+    def get_weights(self, present=None, center=None, scale=None):
+        """Get the stacked weight matrix for raw input features.
+
+        Arguments
+        ---------
+        present (np.array): boolean array, True for each input feature that
+                            is present in the data to be scored. Missing
+                            features are left out of all models, which is
+                            the same as imputing their training mean (for
+                            standardized features) or 0.
+        center, scale (np.array): standardization parameters for each input
+                                  feature, if None use each model's
+                                  training parameters
+
+        Returns
+        -------
+        weights (sp.csr_matrix): models x input features weight matrix
+        intercepts (np.array): intercept for each model
+        """
+        keep = (np.ones(self.rows_.shape[0], dtype='bool') if present is None
+                  else present[self.rows_])
+        rows, cols, values = self.rows_[keep], self.cols_[keep], self.values_[keep]
+        if center is None:
+            center, scale = self.centers_[keep], self.scales_[keep]
+        else:
+            standardized = self.standardized_[keep]
+            center = np.where(standardized, center[rows], 0)
+            scale = np.where(standardized, scale[rows], 1)
+        weights = sp.csr_matrix((values / scale, (cols, rows)),
+                                shape=(self.n_models, self.input_features_.shape[0]))
+        intercepts = self.intercepts_ - np.bincount(
+            cols, weights=values * center / scale, minlength=self.n_models)
+        return weights, intercepts
+
+    def check_input_features(self, present):
+        """Check that each model has some nonzero weights on the input.
+
+        A model with nonzero weights, but none on features present in the
+        input, would only predict its intercept. This usually means it was
+        trained on different features (e.g. compressed data), so we raise
+        an error rather than averaging it with the other models.
+
+        Arguments
+        ---------
+        present (np.array): boolean array, True for each input feature that
+                            is present in the data to be scored
+        """
+        has_weights = np.bincount(self.cols_, minlength=self.n_models) > 0
+        has_present = np.bincount(self.cols_[present[self.rows_]],
+                                  minlength=self.n_models) > 0
+        missing = has_weights & ~has_present
+        if missing.any():
+            model_info = self.model_info_.loc[missing, ['identifier', 'fold']]
+            raise ValueError(
+                'None of the input features for {} models are present in '
+                'the data to score, e.g. {} fold {}'.format(
+                    missing.sum(), *model_info.iloc[0]))
+
+    def get_input_stats(self, X, chunk_size=cfg.inference_chunk_size):
+        """Get mean and standard deviation of the input features in X."""
+        stats = (0,
+                 np.zeros(self.input_features_.shape[0]),
+                 np.zeros(self.input_features_.shape[0]))
+        for X_chunk in get_data_chunks(X, chunk_size):
+            stats = stream.update_feature_stats(
+                stats,
+                X_chunk.reindex(columns=self.input_features_).values
+            )
+        n, mean, m2 = stats
+        std = np.sqrt(m2 / n)
+        return mean, np.where(std == 0, 1, std)
+
+    def decision_function(self,
+                          X,
+                          chunk_size=cfg.inference_chunk_size,
+                          standardize='train',
+                          verbose=False):
+        """Get predictions (log-odds of the positive class) from each model.
+
+        Arguments
+        ---------
+        X (pd.DataFrame, str or Path): raw samples x features data to score,
+                                       or a file containing it
+        chunk_size (int): number of samples to score at a time
+        standardize (str): 'train' to standardize features using each
+                           model's training statistics, or 'input' to
+                           standardize using the statistics of X (this is
+                           how test sets are standardized in our CV
+                           experiments, but it takes an extra pass over X)
+        verbose (bool): whether or not to print verbose output
+
+        Returns
+        -------
+        y_pred_df (pd.DataFrame): samples x models predictions, the columns
+                                  are in the same order as model_info_
+        """
+        if standardize not in ['train', 'input']:
+            raise ValueError('standardize must be one of: train, input')
+        center, scale = None, None
+        if standardize == 'input':
+            center, scale = self.get_input_stats(X, chunk_size)
+
+        weights, intercepts, index, y_pred = None, None, [], []
+        for X_chunk in get_data_chunks(X, chunk_size):
+            if weights is None:
+                present = self.input_features_.isin(X_chunk.columns)
+                if verbose and not present.all():
+                    print('{} of {} input features missing, these will be '
+                          'imputed'.format((~present).sum(), present.shape[0]),
+                          file=sys.stderr)
+                self.check_input_features(present)
+                weights, intercepts = self.get_weights(present, center, scale)
+            X_values = X_chunk.reindex(
+                columns=self.input_features_).fillna(0).values
+            # sparse (models x features) @ dense (features x samples)
+            y_pred.append((weights @ X_values.T).T + intercepts)
+            index.append(X_chunk.index)
+
+        return pd.DataFrame(
+            np.concatenate(y_pred) if len(y_pred) > 0
+                else np.zeros((0, self.n_models)),
+            index=(index[0].append(index[1:]) if len(index) > 0
+                     else pd.Index([])),
+            columns=pd.MultiIndex.from_frame(
+                self.model_info_.loc[:, ['identifier', 'fold']])
+        )
+
+    def predict_proba(self,
+                      X,
+                      chunk_size=cfg.inference_chunk_size,
+                      standardize='train',
+                      combine_folds=True,
+                      verbose=False):
+        """Get probability of the positive class for each identifier.
+
+        See decision_function for arguments.
+
+        Arguments
+        ---------
+        combine_folds (bool): if True, average the probabilities from the
+                              models for each CV fold, otherwise return
+                              one column for each (identifier, fold)
+
+        Returns
+        -------
+        probs_df (pd.DataFrame): samples x identifiers probabilities
+        """
+        probs_df = expit(self.decision_function(X,
+                                                chunk_size=chunk_size,
+                                                standardize=standardize,
+                                                verbose=verbose))
+        if combine_folds:
+            probs_df = probs_df.T.groupby(level='identifier',
+                                          sort=False).mean().T
+        return probs_df
+
+
+def get_model_files(results_dir, training_data, signal='signal'):
+    """Get saved model files for a data type, in a results directory.
+
+    Arguments
+    ---------
+    results_dir (str or Path): directory to search (recursively)
+    training_data (str): data type the models were trained on
+    signal (str): 'signal' or 'shuffled'
+
+    Returns
+    -------
+    model_files (list): sorted list of paths to .npz model files
+    """
+    return sorted(Path(results_dir).rglob(
+        '*_{}_{}_s*_model.npz'.format(training_data, signal)))
+
+
+def load_model_stack(model_files,
+                     training_data=None,
+                     signal=None,
+                     seed=None,
+                     model_config=None):
+    """Load saved models from model_files into a ModelStack.
+
+    Models that don't match training_data, signal or seed (if provided)
+    are skipped, since file name patterns can be ambiguous. Models trained
+    with a different configuration than model_config are also skipped, since
+    their predictions aren't comparable (e.g. models trained on compressed
+    data have different input features).
+
+    Arguments
+    ---------
+    model_files (list): paths to .npz model files
+    training_data (str): data type the models were trained on
+    signal (str): 'signal' or 'shuffled'
+    seed (int): seed the models were trained with
+    model_config (dict): training configuration to keep models for, keys
+                         not included are set to their values in
+                         base_model_config (if None, use base_model_config)
+
+    Returns
+    -------
+    stack (ModelStack): stacked models
+    """
+    model_config = dict(base_model_config, **(model_config or {}))
+    artifacts = [
+        artifact
+            for model_file in model_files
+            for artifact in load_model_artifacts(model_file).values()
+            if (training_data in [None, artifact.get('training_data')] and
+                signal in [None, artifact.get('signal')] and
+                seed in [None, artifact.get('seed')] and
+                all(artifact.get(key, base_model_config[key]) == value
+                      for key, value in model_config.items()))
+    ]
+    if len(artifacts) == 0:
+        raise ValueError('No saved models found')
+    return ModelStack(artifacts)
@@ -0,0 +1,238 @@
+"""
+Functions for generating permutation null distributions for classifiers.
+
+Our usual negative control is a single CV run with shuffled labels, which
+gives one null AUROC/AUPR per outer fold. To get permutation p-values, we
+need the same statistic for hundreds of label permutations, and running the
+full CV (including the hyperparameter search) for each of them would take
+hundreds of times as long as the experiment itself.
+
+Here, we make a few simplifications that make this much cheaper:
+
+* the preprocessing for each outer fold (feature selection,
+  standardization, compression) doesn't depend on the labels, so it's
+  only done once per fold
+* the hyperparameters for each fold are fixed to the ones selected for the
+  true labels, rather than searched again for each permutation
+* the permuted label vectors share the same data matrix, so they can be fit
+  together as columns of a multi-target problem (see
+  solver_utilities.fit_logistic_enet), with one pass over the data per
+  iteration for all of them
+
+The true labels are included as permutation 0, so the observed statistic is
+computed with exactly the same procedure as the null statistics.
+
+Null distributions are stored compactly as (folds x permutations) float32
+arrays, in a compressed .npz file.
+"""
+import numpy as np
+from scipy.stats import rankdata
+from sklearn.metrics import average_precision_score
+
+import mpmp.config as cfg
+import mpmp.utilities.classify_utilities as cu
+import mpmp.utilities.solver_utilities as su
+
+def get_permuted_labels(y, n_permutations, rng):
+    """Get a matrix of permuted label vectors.
+
+    Arguments
+    ---------
+    y (np.array): binary labels
+    n_permutations (int): number of permutations
+    rng (np.random.Generator): random generator to draw permutations from
+
+    Returns
+    -------
+    Y (np.array): samples x (n_permutations + 1) labels, the first column
+                  contains the unpermuted labels
+    """
+    y = np.asarray(y, dtype='int8')
+    Y = np.empty((y.shape[0], n_permutations + 1), dtype='int8')
+    Y[:, 0] = y
+    for ix in range(1, n_permutations + 1):
+        Y[:, ix] = rng.permutation(y)
+    return Y
+
+
+def get_auroc(Y, scores):
+    """Get AUROC for each column of labels and scores.
+
+    This uses the Mann-Whitney U statistic (with average ranks for ties),
+    which is the same as sklearn's roc_auc_score, but can be computed for
+    all columns at once. Columns that only contain one class are NaN.
+    """
+    ranks = rankdata(scores, axis=0)
+    n_pos = Y.sum(axis=0)
+    n_neg = Y.shape[0] - n_pos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auroc = (((ranks * Y).sum(axis=0) - n_pos * (n_pos + 1) / 2) /
+                 (n_pos * n_neg))
+    return np.where((n_pos == 0) | (n_neg == 0), np.nan, auroc)
+
+
+def get_aupr(Y, scores):
+    """Get average precision for each column of labels and scores."""
+    return np.array([
+        average_precision_score(Y[:, ix], scores[:, ix])
+            if Y[:, ix].any() else np.nan
+        for ix in range(Y.shape[1])
+    ])
+
+
+def run_permutation_null(data_model,
+                         identifier,
+                         sample_info,
+                         num_folds,
+                         n_permutations,
+                         standardize_columns=False,
+                         fold_params=None,
+                         seed=None,
+                         max_iter=cfg.max_iter,
+                         max_columns=cfg.prox_max_columns):
+    """Get permutation null distributions of test set AUROC and AUPR.
+
+    Arguments
+    ---------
+    data_model (TCGADataModel): class containing preprocessed train/test data,
+                                with unshuffled labels
+    identifier (str): string describing the target value/environment
+    sample_info (pd.DataFrame): df with TCGA sample information
+    num_folds (int): number of cross-validation folds to run
+    n_permutations (int): number of label permutations
+    standardize_columns (bool): whether or not to standardize predictors
+    fold_params (list): (alpha, l1_ratio) to use for each fold, e.g. from the
+                        model artifacts for the signal experiment. If None,
+                        hyperparameters are selected for the true labels
+                        in each fold, with the prox solver.
+    seed (int): seed for permutations, if None use data_model.seed
+    max_iter (int): maximum number of iterations for each fit
+    max_columns (int): maximum number of permutations to fit at once
+
+    Returns
+    -------
+    null_results (dict): maps 'auroc' and 'aupr' to (folds x permutations)
+                         arrays of test set metrics (permutation 0 is the
+                         true labels), and 'alpha' and 'l1_ratio' to the
+                         hyperparameters used for each fold
+    """
+    if seed is None:
+        seed = data_model.seed
+    fold_assignments = cu.get_cv_fold_assignments(data_model,
+                                                  identifier,
+                                                  sample_info,
+                                                  num_folds)
+    Y = get_permuted_labels(
+        data_model.y_df.status.reindex(data_model.X_df.index).values,
+        n_permutations,
+        np.random.default_rng(seed)
+    )
+
+    null_results = {
+        'auroc': np.full((num_folds, Y.shape[1]), np.nan, dtype='float32'),
+        'aupr': np.full((num_folds, Y.shape[1]), np.nan, dtype='float32'),
+        'alpha': np.zeros(num_folds),
+        'l1_ratio': np.zeros(num_folds),
+    }
+    for fold_no in range(num_folds):
+        # the labels returned here aren't used, we get the permuted labels
+        # for the same samples below
+        X_train_df, X_test_df, _, _ = cu.get_fold_data(
+            data_model,
+            sample_info,
+            fold_assignments,
+            fold_no,
+            standardize_columns
+        )
+        Y_train = Y[data_model.X_df.index.get_indexer(X_train_df.index)]
+        Y_test = Y[data_model.X_df.index.get_indexer(X_test_df.index)]
+        X_train = su.get_design_matrix(X_train_df)
+        X_test = su.get_design_matrix(X_test_df)
+
+        if fold_params is None:
+            try:
+                search = su.MultiTargetGridSearchCV(
+                    alphas=cfg.alphas,
+                    l1_ratios=cfg.l1_ratios,
+                    cv=cfg.folds,
+                    max_iter=max_iter
+                ).fit(X_train, Y_train[:, [0]]).searches_[0]
+            except ValueError as e:
+                cu.check_one_class_error(e, identifier)
+            alpha = search.best_params_['classify__alpha']
+            l1_ratio = search.best_params_['classify__l1_ratio']
+        else:
+            alpha, l1_ratio = fold_params[fold_no]
+        null_results['alpha'][fold_no] = alpha
+        null_results['l1_ratio'][fold_no] = l1_ratio
+
+        for chunk_start in range(0, Y.shape[1], max_columns):
+            chunk = slice(chunk_start, chunk_start + max_columns)
+            sample_weight = su.get_balanced_weights(Y_train[:, chunk])
+            coef, intercept, _ = su.fit_logistic_enet(
+                X_train,
+                Y_train[:, chunk],
+                sample_weight,
+                alpha,
+                l1_ratio,
+                max_iter=max_iter
+            )
+            scores = X_test @ coef + intercept
+            null_results['auroc'][fold_no, chunk] = get_auroc(
+                Y_test[:, chunk], scores)
+            null_results['aupr'][fold_no, chunk] = get_aupr(
+                Y_test[:, chunk], scores)
+
+    return null_results
+
+
+def get_fold_params(artifacts):
+    """Get hyperparameters for each fold from saved model artifacts.
+
+    Arguments
+    ---------
+    artifacts (list or dict): model artifacts for each fold, from
+                              run_cv_stratified results or from
+                              model_utilities.load_model_artifacts
+
+    Returns
+    -------
+    fold_params (list): (alpha, l1_ratio) for each fold, ordered by fold
+    """
+    if isinstance(artifacts, dict):
+        artifacts = artifacts.values()
+    return [(artifact['alpha'], artifact['l1_ratio'])
+            for artifact in sorted(artifacts, key=lambda a: a['fold'])]
+
+
+def get_permutation_pvalue(null_results, metric='auroc'):
+    """Get permutation p-value for the mean of a metric over folds.
+
+    This uses the (1 + count) / (1 + n) estimate, so the p-value is never
+    0 (see Phipson and Smyth 2010).
+
+    Returns
+    -------
+    observed (float): mean metric over folds for the true labels
+    null_mean (float): mean of the null distribution
+    p_value (float): fraction of permutations with a mean metric at least
+                     as large as the observed value
+    """
+    fold_means = np.nanmean(null_results[metric], axis=0)
+    observed, null = fold_means[0], fold_means[1:]
+    p_value = (1 + np.count_nonzero(null >= observed)) / (1 + null.shape[0])
+    return observed, null.mean(), p_value
+
+
+def save_null_distribution(output_file, null_results):
+    """Save permutation null distributions to a compressed .npz file."""
+    # np.savez adds the extension if it's not there, so we open the file
+    # ourselves to make sure it's written to the given filename
+    with open(output_file, 'wb') as f:
+        np.savez_compressed(f, **null_results)
+
+
+def load_null_distribution(input_file):
+    """Load permutation null distributions saved with save_null_distribution."""
+    with np.load(input_file, allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
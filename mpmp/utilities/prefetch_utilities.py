@@ -0,0 +1,287 @@
+"""
+Functions for preparing data for upcoming experiments in the background.
+
+When experiments are run one at a time, each one first prepares its data
+(generating labels, aligning them with the training data, filtering to
+cross-data samples, and assigning CV folds), then trains models. Data
+preparation is mostly pandas operations and I/O, so the cores used for
+training sit idle while it runs, and vice versa.
+
+Here, a background thread prepares data for the next experiment(s) while
+the current one trains. Prepared data is put into a bounded queue: the
+thread stops preparing data when the queue has depth experiments waiting,
+or when the experiments waiting use more than max_bytes of memory (at
+least one experiment is always allowed to wait, so large experiments can
+still be prefetched one at a time). In the worst case, depth + 2
+experiments are in memory at once: the one being trained, the ones in the
+queue, and the one being prepared.
+
+The time each stage ('prepare' in the background thread and 'train' in the
+main thread) spends working and idle is recorded, to check whether
+prefetching is worthwhile: if training is idle waiting for data, data
+preparation is the bottleneck.
+
+The background thread prepares data on a shallow copy of the data model,
+so some state is shared between the two threads. This is safe because:
+
+* the loaded data, and the aligned data in _filtered_cache, are never
+  modified in place: process_data_for_gene replaces the copy's attributes
+  (labels are copied before they're shuffled), and training makes its
+  own copies of the data for each fold
+* the fold assignment cache in classify_utilities is only read and written
+  one key at a time (atomic for a dict), the cached arrays aren't modified,
+  and the cache files are written to a temporary file and then renamed
+* fold_projections and the stream solver's data store are only used for
+  training, which is always done in the main thread
+"""
+import copy
+import threading
+import time
+from collections import deque
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import mpmp.config as cfg
+import mpmp.utilities.classify_utilities as cu
+from mpmp.exceptions import NoTrainSamplesError
+
+# put on the queue after the last item, to tell the consumer to stop
+_done = object()
+
+class Prefetcher():
+    """
+    Iterate over items, preparing data for upcoming items in a background
+    thread.
+
+    Iterating yields (item, result, error) tuples in the same order as
+    items, where result is the output of prepare(item), or None if it
+    raised an exception (which is returned as error, rather than raised,
+    so the caller can decide whether to skip the item).
+    """
+
+    def __init__(self,
+                 prepare,
+                 items,
+                 depth=cfg.prefetch_depth,
+                 max_bytes=cfg.prefetch_max_bytes,
+                 get_nbytes=None):
+        """
+        Arguments
+        ---------
+        prepare (function): prepares data for a single item
+        items (list): items to iterate over
+        depth (int): maximum number of prepared items to keep waiting, if
+                     less than 1 items are prepared in the main thread
+                     when they're needed (i.e. no prefetching)
+        max_bytes (float): maximum memory used by prepared items waiting in
+                           the queue, not counting the first one
+        get_nbytes (function): gets memory used by a prepared item, if None
+                               memory isn't limited
+        """
+        self.prepare = prepare
+        self.items = list(items)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.get_nbytes = get_nbytes
+        self._reset_timings()
+
+    def __iter__(self):
+        self._reset_timings()
+        if self.depth < 1:
+            yield from self._iter_serial()
+        else:
+            yield from self._iter_prefetch()
+
+    def _reset_timings(self):
+        self.timings = {stage: {'n_tasks': 0, 'busy_time': 0.0, 'idle_time': 0.0}
+                          for stage in ('prepare', 'train')}
+
+    def _prepare_item(self, item):
+        start_time = time.time()
+        try:
+            result, error = self.prepare(item), None
+        except Exception as e:
+            result, error = None, e
+        self._record('prepare', 'busy_time', time.time() - start_time)
+        return result, error
+
+    def _record(self, stage, key, elapsed):
+        if key == 'busy_time':
+            self.timings[stage]['n_tasks'] += 1
+        self.timings[stage][key] += elapsed
+
+    def _iter_serial(self):
+        # without prefetching, each stage is idle while the other one runs
+        for item in self.items:
+            start_time = time.time()
+            result, error = self._prepare_item(item)
+            self._record('train', 'idle_time', time.time() - start_time)
+            start_time = time.time()
+            yield item, result, error
+            elapsed = time.time() - start_time
+            self._record('train', 'busy_time', elapsed)
+            self._record('prepare', 'idle_time', elapsed)
+
+    def _iter_prefetch(self):
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._cond = threading.Condition()
+        self._stop = False
+        thread = threading.Thread(target=self._produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.time()
+                with self._cond:
+                    while len(self._queue) == 0:
+                        self._cond.wait()
+                    entry = self._queue.popleft()
+                    if entry is not _done:
+                        self._queued_bytes -= entry[3]
+                    self._cond.notify_all()
+                self._record('train', 'idle_time', time.time() - start_time)
+                if entry is _done:
+                    break
+                item, result, error, _ = entry
+                # drop our reference to the queue entry, so the prepared
+                # data can be freed when the caller is done with it
+                del entry
+                start_time = time.time()
+                yield item, result, error
+                self._record('train', 'busy_time', time.time() - start_time)
+        finally:
+            # if the caller stops early (or raises an exception), stop the
+            # background thread and drop any prepared data
+            with self._cond:
+                self._stop = True
+                self._queue.clear()
+                self._cond.notify_all()
+            thread.join()
+
+    def _produce(self):
+        try:
+            for item in self.items:
+                result, error = self._prepare_item(item)
+                nbytes = 0
+                if error is None and self.get_nbytes is not None:
+                    nbytes = self.get_nbytes(result)
+                start_time = time.time()
+                with self._cond:
+                    while not self._stop and len(self._queue) > 0 and (
+                            len(self._queue) >= self.depth or
+                            self._queued_bytes + nbytes > self.max_bytes):
+                        self._cond.wait()
+                    if self._stop:
+                        return
+                    self._queue.append((item, result, error, nbytes))
+                    self._queued_bytes += nbytes
+                    self._cond.notify_all()
+                self._record('prepare', 'idle_time', time.time() - start_time)
+                del result
+        finally:
+            # always tell the consumer to stop, even if something went
+            # wrong here, so it doesn't wait forever
+            with self._cond:
+                self._queue.append(_done)
+                self._cond.notify_all()
+
+    def get_stage_report(self):
+        """Summarize busy and idle time for each stage.
+
+        For the 'prepare' stage, idle time is time spent waiting for space
+        in the queue (i.e. waiting for training to catch up). For the
+        'train' stage, idle time is time spent waiting for prepared data.
+
+        Returns
+        -------
+        report_df (pd.DataFrame): number of items, busy time, idle time,
+                                  mean time per item, and utilization
+                                  (fraction of time busy) for each stage
+        """
+        report = []
+        for stage, timings in self.timings.items():
+            total_time = timings['busy_time'] + timings['idle_time']
+            report.append([
+                stage,
+                timings['n_tasks'],
+                timings['busy_time'],
+                timings['idle_time'],
+                (timings['busy_time'] / timings['n_tasks']
+                    if timings['n_tasks'] > 0 else np.nan),
+                (timings['busy_time'] / total_time
+                    if total_time > 0 else np.nan)
+            ])
+        return pd.DataFrame(report, columns=[
+            'stage', 'n_tasks', 'busy_time', 'idle_time',
+            'mean_task_time', 'utilization'
+        ]).set_index('stage')
+
+
+def get_data_model_nbytes(data_model):
+    """Get memory used by the data prepared for a single experiment."""
+    return (data_model.X_df.memory_usage(index=True).sum() +
+            data_model.y_df.memory_usage(index=True).sum())
+
+
+def _prepare_gene_data(worker_model, sample_info, num_folds, experiment):
+    gene, classification, gene_dir, shuffle_labels, seed = experiment
+    worker_model.set_seed(seed)
+    worker_model.set_experiment_seed(gene, shuffle_labels)
+    worker_model.process_data_for_gene(gene,
+                                       classification,
+                                       gene_dir,
+                                       shuffle_labels=shuffle_labels)
+    try:
+        # fold assignments are cached (see get_fold_assignments), so this
+        # is only computed once
+        cu.get_cv_fold_assignments(worker_model, gene, sample_info, num_folds)
+    except NoTrainSamplesError:
+        # this is raised again (and handled) when the experiment is run
+        pass
+    # the copy shares the loaded data with worker_model, but not the data
+    # for this experiment, which is replaced when the next one is prepared
+    return copy.copy(worker_model)
+
+
+def prefetch_gene_data(data_model,
+                       experiments,
+                       sample_info,
+                       num_folds,
+                       depth=cfg.prefetch_depth,
+                       max_bytes=cfg.prefetch_max_bytes):
+    """Iterate over gene experiments, preparing data in the background.
+
+    The data for each experiment is prepared with process_data_for_gene on
+    a copy of data_model, which is yielded as the result for the
+    experiment, so data_model itself isn't modified. Labels are shuffled
+    using a generator seeded for the experiment, the same as when calling
+    data_model.set_seed and data_model.set_experiment_seed before
+    process_data_for_gene.
+
+    Arguments
+    ---------
+    data_model (TCGADataModel): class containing TCGA data
+    experiments (list): list of (gene, classification, gene_dir,
+                        shuffle_labels, seed) tuples
+    sample_info (pd.DataFrame): df with TCGA sample information
+    num_folds (int): number of cross-validation folds
+    depth (int): maximum number of prepared experiments to keep waiting
+    max_bytes (float): maximum memory used by prepared experiments waiting
+
+    Returns
+    -------
+    prefetcher (Prefetcher): yields (experiment, data model, error) for
+                             each experiment, see Prefetcher
+    """
+    return Prefetcher(
+        partial(_prepare_gene_data,
+                copy.copy(data_model),
+                sample_info,
+                num_folds),
+        experiments,
+        depth=depth,
+        max_bytes=max_bytes,
+        get_nbytes=get_data_model_nbytes
+    )
@@ -0,0 +1,145 @@
+"""
+Functions for controlling how many processes and threads are used to train
+models.
+
+There are two levels of parallelism in the training path: joblib worker
+processes (for the hyperparameter search) and threads within each process
+(for BLAS/OpenMP, used by numpy, pandas and sklearn). By default each of
+these tries to use every core on the machine, so running both at once can
+use many more threads than there are cores, which makes everything slower.
+
+Here, a single core budget (set with set_core_budget, e.g. from the --cores
+argument to the run scripts) is split between processes and threads: the
+number of worker processes is chosen first, and the remaining cores are
+divided between them as BLAS/OpenMP threads.
+"""
+import os
+from contextlib import contextmanager
+
+from joblib import parallel_config
+from threadpoolctl import threadpool_info, threadpool_limits
+
+# number of cores this process is allowed to use, if None use all
+# available cores (see set_core_budget)
+_core_budget = None
+
+def get_available_cores():
+    """Get the number of cores this process is allowed to run on."""
+    try:
+        # this respects CPU affinity (e.g. from cluster job schedulers),
+        # unlike os.cpu_count
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def set_core_budget(n_cores=None):
+    """Set the number of cores to use for model training.
+
+    This also limits the number of BLAS/OpenMP threads in the current
+    process, so it should be called before doing any heavy computation.
+
+    Arguments
+    ---------
+    n_cores (int): number of cores to use, if None or less than 1 use all
+                   available cores
+
+    Returns
+    -------
+    n_cores (int): the core budget that was set
+    """
+    global _core_budget
+    if n_cores is None or n_cores < 1:
+        n_cores = get_available_cores()
+    _core_budget = n_cores
+    threadpool_limits(limits=n_cores)
+    return n_cores
+
+
+def get_core_budget():
+    """Get the number of cores to use for model training."""
+    if _core_budget is None:
+        return get_available_cores()
+    return _core_budget
+
+
+def get_n_jobs(n_tasks=None):
+    """Get number of worker processes to use for n_tasks independent tasks.
+
+    We prefer processes over threads, since most of our fits (e.g. SGD) are
+    single-threaded, but there's no point in having more processes than
+    tasks.
+    """
+    n_jobs = get_core_budget()
+    if n_tasks is not None:
+        n_jobs = min(n_jobs, n_tasks)
+    return max(n_jobs, 1)
+
+
+def get_threads_per_job(n_jobs):
+    """Get number of BLAS/OpenMP threads for each of n_jobs processes."""
+    return max(get_core_budget() // max(n_jobs, 1), 1)
+
+
+@contextmanager
+def limit_threads(n_threads=None):
+    """Limit BLAS/OpenMP threads in the current process.
+
+    This can also be used as a function decorator, in which case the
+    limit is computed each time the function is called.
+
+    Arguments
+    ---------
+    n_threads (int): maximum number of threads, if None use the core budget
+    """
+    if n_threads is None:
+        n_threads = get_core_budget()
+    with threadpool_limits(limits=n_threads):
+        yield
+
+
+@contextmanager
+def worker_config(n_jobs):
+    """Limit BLAS/OpenMP threads in joblib workers, within the core budget.
+
+    Calls to joblib.Parallel inside this context use the loky backend with
+    each worker limited to get_threads_per_job(n_jobs) threads.
+    """
+    with parallel_config(backend='loky',
+                         inner_max_num_threads=get_threads_per_job(n_jobs)):
+        yield
+
+
+def get_resource_info(n_tasks=None, n_workers=1):
+    """Get the effective process/thread configuration, for logging.
+
+    Arguments
+    ---------
+    n_tasks (int): number of independent tasks in each hyperparameter
+                   search, used to get the number of worker processes
+    n_workers (int): number of experiment worker processes the core budget
+                     is split between (see scheduler_utilities.py)
+
+    Returns
+    -------
+    resource_info (dict): core budget, cores per experiment worker, number
+                          of search worker processes, threads per search
+                          worker, and the BLAS/OpenMP libraries loaded in
+                          the current process with their thread limits
+    """
+    cores_per_worker = get_threads_per_job(n_workers)
+    n_jobs = cores_per_worker if n_tasks is None else min(cores_per_worker,
+                                                          n_tasks)
+    return {
+        'cores': get_core_budget(),
+        'workers': n_workers,
+        'cores_per_worker': cores_per_worker,
+        'n_jobs': n_jobs,
+        'threads_per_job': max(cores_per_worker // n_jobs, 1),
+        'threadpools': [
+            {'user_api': pool['user_api'],
+             'internal_api': pool['internal_api'],
+             'num_threads': pool['num_threads']}
+            for pool in threadpool_info()
+        ],
+    }
@@ -0,0 +1,686 @@
+"""
+Functions for running classification experiments as a graph of tasks, on a
+pool of worker processes.
+
+When experiments are run one at a time (see run_cv_stratified in
+classify_utilities.py), the only parallelism is within the hyperparameter
+search for each outer CV fold. The rest of the work (data preprocessing,
+refitting, evaluation, writing results) is serial, so most cores sit idle
+for much of the run. Here, each experiment is split into stages:
+
+* prep: data preprocessing for an identifier (one task per experiment)
+* fold: preprocessing for an outer CV fold, e.g. standardization
+  (one task per outer fold)
+* grid: fitting one hyperparameter combination on one inner CV split
+  (one task per grid point/inner split, for each outer fold)
+* refit: model selection and refitting on the full training set
+  (one task per outer fold)
+* metrics: coefficients and performance metrics (one task per outer fold)
+* save: writing results to files (one task per experiment)
+
+and the tasks for all experiments are put into a single graph, so that any
+task can run as soon as its dependencies are finished and a worker is free.
+
+Data that is the same for all tasks (the data model, sample info, options)
+is shared with the workers when they are started (with the 'fork' start
+method, this is copy-on-write and nothing is pickled). Large intermediate
+results (the data matrix for each experiment and the preprocessed data for
+each fold) are written to a scratch directory as .npy files and memory
+mapped by the tasks that use them, rather than being passed through the
+process pool.
+"""
+import copy
+import heapq
+import multiprocessing as mp
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import mpmp.config as cfg
+import mpmp.utilities.classify_utilities as cu
+import mpmp.utilities.file_utilities as fu
+import mpmp.utilities.resource_utilities as ru
+import mpmp.utilities.solver_utilities as su
+from mpmp.exceptions import (
+    NoTestSamplesError,
+    NoTrainSamplesError,
+    OneClassError,
+)
+
+# read-only data shared by all tasks, this is set when each worker starts
+_shared_data = {}
+
+# maps errors raised by experiment tasks to skip reasons for the log file
+skip_reasons = {
+    KeyError: 'gene_not_found',
+    NoTestSamplesError: 'no_test_samples',
+    NoTrainSamplesError: 'no_train_samples',
+    OneClassError: 'one_class',
+}
+
+
+def _init_worker(shared_data, n_cores=None):
+    _shared_data.clear()
+    _shared_data.update(shared_data)
+    if n_cores is not None:
+        # each worker gets an equal share of the core budget, so tasks that
+        # use BLAS (or run their own worker processes, e.g. in train_model)
+        # don't oversubscribe the machine
+        ru.set_core_budget(n_cores)
+
+
+def _run_task(func, args, dep_results):
+    """Run a single task, and time it.
+
+    Exceptions are returned rather than raised, so that we still get timing
+    information for tasks that fail.
+    """
+    start_time = time.time()
+    try:
+        result, error = func(dep_results, *args), None
+    except Exception as e:
+        result, error = None, e
+    return result, error, start_time, time.time()
+
+
+class TaskGraph():
+    """
+    A directed acyclic graph of tasks, which can be run in parallel on a
+    pool of worker processes.
+
+    Each task is a module-level function, which is called with a list of the
+    results of its dependencies as the first argument, followed by any other
+    arguments provided when the task is added. Tasks are run in the order
+    they're added when possible, so tasks for experiments added earlier are
+    prioritized over tasks for later ones (which keeps the amount of
+    intermediate data on disk/in memory manageable).
+    """
+
+    def __init__(self):
+        # maps task ID to (stage, function, args, dependencies)
+        self.tasks = {}
+        self.stages = []
+
+    def add_task(self, task_id, stage, func, args=(), deps=()):
+        """Add a task to the graph.
+
+        Arguments
+        ---------
+        task_id (hashable): unique identifier for the task
+        stage (str): name of the stage the task is part of, for reporting
+        func (function): function to run, must be defined at module level
+        args (tuple): additional arguments to func
+        deps (list): IDs of tasks that must finish before this one, these
+                     must be added to the graph first
+
+        Returns
+        -------
+        task_id (hashable): unique identifier for the task
+        """
+        if task_id in self.tasks:
+            raise ValueError('duplicate task ID: {}'.format(task_id))
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError('unknown dependency: {}'.format(dep))
+        self.tasks[task_id] = (stage, func, tuple(args), tuple(deps))
+        if stage not in self.stages:
+            self.stages.append(stage)
+        return task_id
+
+    def run(self, n_workers=1, shared_data=None, progress=False):
+        """Run all tasks in the graph.
+
+        If a task fails, tasks that depend on it are skipped, and the error
+        is recorded for each of them.
+
+        Arguments
+        ---------
+        n_workers (int): number of worker processes, if 1 run tasks in the
+                         current process
+        shared_data (dict): read-only data to make available to tasks
+                            through get_shared_data
+        progress (bool): whether or not to show a progress bar
+
+        Returns
+        -------
+        results (dict): maps task IDs to results, for tasks that finished
+                        successfully and have no dependents
+        errors (dict): maps task IDs to errors, for tasks that failed or
+                       were skipped
+        """
+        shared_data = {} if shared_data is None else shared_data
+        self.n_workers = max(n_workers, 1)
+        self.results, self.errors, self.timings = {}, {}, {}
+
+        order = {task_id: ix for ix, task_id in enumerate(self.tasks)}
+        dependents = {task_id: [] for task_id in self.tasks}
+        n_waiting = {}
+        ready = []
+        for task_id, (_, _, _, deps) in self.tasks.items():
+            n_waiting[task_id] = len(deps)
+            for dep in deps:
+                dependents[dep].append(task_id)
+            if len(deps) == 0:
+                heapq.heappush(ready, (order[task_id], task_id))
+        # number of unfinished dependents for each task, we can discard
+        # a task's result once this reaches 0
+        n_unfinished = {task_id: len(dependents[task_id])
+                          for task_id in self.tasks}
+
+        pbar = tqdm(total=len(self.tasks), ncols=100, file=sys.stdout,
+                    disable=(not progress))
+
+        def get_dep_results(task_id):
+            return [self.results[dep] for dep in self.tasks[task_id][3]]
+
+        def finish(task_id, result, error, start_time, end_time):
+            self.timings[task_id] = (start_time, end_time)
+            pbar.update(1)
+            for dep in self.tasks[task_id][3]:
+                n_unfinished[dep] -= 1
+                if n_unfinished[dep] == 0:
+                    del self.results[dep]
+            if error is not None:
+                self._skip_dependents(task_id, error, dependents,
+                                      n_unfinished, pbar)
+                return
+            # if all dependents were skipped already, don't keep the result
+            if (len(dependents[task_id]) == 0) or (n_unfinished[task_id] > 0):
+                self.results[task_id] = result
+            for dependent in dependents[task_id]:
+                n_waiting[dependent] -= 1
+                if n_waiting[dependent] == 0 and dependent not in self.errors:
+                    heapq.heappush(ready, (order[dependent], dependent))
+
+        start_time = time.time()
+        if self.n_workers == 1:
+            _init_worker(shared_data)
+            while ready:
+                _, task_id = heapq.heappop(ready)
+                _, func, args, _ = self.tasks[task_id]
+                finish(task_id,
+                       *_run_task(func, args, get_dep_results(task_id)))
+        else:
+            # with fork, workers inherit shared data without pickling
+            mp_context = (mp.get_context('fork')
+                          if 'fork' in mp.get_all_start_methods() else None)
+            with ProcessPoolExecutor(max_workers=self.n_workers,
+                                     mp_context=mp_context,
+                                     initializer=_init_worker,
+                                     initargs=(shared_data,
+                                               ru.get_threads_per_job(
+                                                   self.n_workers))) as pool:
+                running = {}
+                while ready or running:
+                    # only submit as many tasks as there are workers, so
+                    # that we can pick the highest priority task whenever
+                    # a worker is free
+                    while ready and len(running) < self.n_workers:
+                        _, task_id = heapq.heappop(ready)
+                        _, func, args, _ = self.tasks[task_id]
+                        future = pool.submit(_run_task, func, args,
+                                             get_dep_results(task_id))
+                        running[future] = task_id
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(running.pop(future), *future.result())
+        self.wall_time = time.time() - start_time
+        pbar.close()
+
+        return self.results, self.errors
+
+    def _skip_dependents(self, task_id, error, dependents, n_unfinished, pbar):
+        """Record error for a failed task and all tasks downstream of it."""
+        to_skip = [task_id]
+        while to_skip:
+            skip_id = to_skip.pop()
+            if skip_id in self.errors:
+                continue
+            self.errors[skip_id] = error
+            if skip_id != task_id:
+                pbar.update(1)
+                for dep in self.tasks[skip_id][3]:
+                    n_unfinished[dep] -= 1
+                    if n_unfinished[dep] == 0 and dep in self.results:
+                        del self.results[dep]
+            to_skip.extend(dependents[skip_id])
+
+    def get_stage_report(self):
+        """Summarize worker utilization for each stage of the graph.
+
+        Utilization for a stage is the fraction of available worker time
+        (n_workers * time from start of first task to end of last task in
+        the stage) spent running tasks in that stage. Utilization for the
+        whole graph is the fraction of available worker time (over the
+        whole run) spent running any task; the rest is time that workers
+        were idle waiting for dependencies, or scheduling overhead.
+
+        Returns
+        -------
+        report_df (pd.DataFrame): number of tasks run, busy time, mean
+                                  time per task, time span, and utilization
+                                  for each stage
+        """
+        stage_timings = {stage: [] for stage in self.stages}
+        for task_id, timing in self.timings.items():
+            stage_timings[self.tasks[task_id][0]].append(timing)
+        stage_timings['total'] = list(self.timings.values())
+
+        report = []
+        for stage, timings in stage_timings.items():
+            if len(timings) == 0:
+                report.append([stage, 0, 0.0, np.nan, 0.0, np.nan])
+                continue
+            timings = np.array(timings)
+            busy_time = (timings[:, 1] - timings[:, 0]).sum()
+            if stage == 'total':
+                span = self.wall_time
+            else:
+                span = timings[:, 1].max() - timings[:, 0].min()
+            report.append([
+                stage,
+                timings.shape[0],
+                busy_time,
+                busy_time / timings.shape[0],
+                span,
+                busy_time / (self.n_workers * span) if span > 0 else np.nan
+            ])
+        return pd.DataFrame(report, columns=[
+            'stage', 'n_tasks', 'busy_time', 'mean_task_time',
+            'span', 'utilization'
+        ]).set_index('stage')
+
+
+def get_shared_data(key):
+    """Get read-only data shared by all tasks."""
+    return _shared_data[key]
+
+
+def get_skip_reason(error):
+    """Get reason for skipping an experiment from the error it raised.
+
+    Errors that aren't expected (i.e. not in skip_reasons) are re-raised.
+    """
+    for error_type, skip_reason in skip_reasons.items():
+        if isinstance(error, error_type):
+            return skip_reason
+    raise error
+
+
+def _get_scratch_dir(exp_key):
+    return Path(get_shared_data('scratch_dir'), exp_key)
+
+
+def _load_array_df(array_file, index, columns):
+    """Load a data frame stored as a .npy file, without reading it to memory."""
+    return pd.DataFrame(np.load(array_file, mmap_mode='r'),
+                        index=index,
+                        columns=columns)
+
+
+def _load_fold_data(fold_data):
+    """Load train/test data for a fold, from the output of _fold_task."""
+    X_train_df = _load_array_df(fold_data['X_train_file'],
+                                fold_data['train_index'],
+                                fold_data['columns'])
+    X_test_df = _load_array_df(fold_data['X_test_file'],
+                               fold_data['test_index'],
+                               fold_data['columns'])
+    return (X_train_df, X_test_df,
+            fold_data['y_train_df'], fold_data['y_test_df'])
+
+
+def _get_search(seed):
+    """Get hyperparameter search object, matching the sgd solver."""
+    return su.OOFGridSearchCV(
+        estimator=cu.get_sgd_estimator(seed, cfg.max_iter),
+        param_grid=cu.get_sgd_param_grid(cfg.alphas, cfg.l1_ratios),
+        cv=cfg.folds,
+        n_jobs=1
+    )
+
+
+def get_experiment_seed_id(exp_string, identifier):
+    """Get the identifier used to seed label shuffling for an experiment.
+
+    Purity experiments don't have an identifier, so they're seeded using the
+    experiment type (see TCGADataModel.set_experiment_seed).
+    """
+    return exp_string if identifier is None else identifier
+
+
+def _process_experiment_data(data_model, exp_string, identifier,
+                             classification, output_dir, shuffle_labels):
+    """Generate labels and aligned data for a single experiment."""
+    data_model.set_experiment_seed(
+        get_experiment_seed_id(exp_string, identifier), shuffle_labels)
+    if exp_string == 'cancer_type':
+        data_model.process_data_for_cancer_type(identifier,
+                                                output_dir,
+                                                shuffle_labels=shuffle_labels)
+    elif exp_string == 'purity':
+        data_model.process_purity_data(output_dir,
+                                       shuffle_labels=shuffle_labels)
+    else:
+        data_model.process_data_for_gene(identifier,
+                                         classification,
+                                         output_dir,
+                                         shuffle_labels=shuffle_labels)
+
+
+def _prep_task(dep_results, exp_key, identifier, classification, gene_dir,
+               shuffle_labels):
+    # shallow copy, so the data for this experiment doesn't replace the
+    # shared data model's (other prep tasks may run in the same process)
+    data_model = copy.copy(get_shared_data('data_model'))
+    model_options = get_shared_data('model_options')
+    _process_experiment_data(data_model,
+                             get_shared_data('exp_string'),
+                             identifier,
+                             classification,
+                             gene_dir,
+                             shuffle_labels)
+    fold_assignments = cu.get_cv_fold_assignments(
+        data_model,
+        identifier,
+        get_shared_data('sample_info'),
+        model_options.num_folds
+    )
+    exp_dir = _get_scratch_dir(exp_key)
+    exp_dir.mkdir(parents=True, exist_ok=True)
+    X_file = exp_dir / 'X.npy'
+    np.save(X_file, data_model.X_df.values)
+    return {
+        'X_file': X_file,
+        'index': data_model.X_df.index,
+        'columns': data_model.X_df.columns,
+        'y_df': data_model.y_df,
+        'gene_features': data_model.gene_features,
+        'fold_assignments': fold_assignments,
+    }
+
+
+def _fold_task(dep_results, exp_key, fold_no):
+    prep_data, = dep_results
+    # shallow copy, so the full data set is shared rather than copied,
+    # and fold projections (if any) are cached in this worker
+    data_model = copy.copy(get_shared_data('data_model'))
+    data_model.X_df = _load_array_df(prep_data['X_file'],
+                                     prep_data['index'],
+                                     prep_data['columns'])
+    data_model.y_df = prep_data['y_df']
+    data_model.gene_features = prep_data['gene_features']
+    (X_train_df,
+     X_test_df,
+     y_train_df,
+     y_test_df,
+     preprocessing) = cu.get_fold_data(data_model,
+                                       get_shared_data('sample_info'),
+                                       prep_data['fold_assignments'],
+                                       fold_no,
+                                       get_shared_data('standardize_columns'),
+                                       return_preprocessing=True)
+    X_train_file = _get_scratch_dir(exp_key) / 'X_train_{}.npy'.format(fold_no)
+    X_test_file = _get_scratch_dir(exp_key) / 'X_test_{}.npy'.format(fold_no)
+    np.save(X_train_file, X_train_df.values)
+    np.save(X_test_file, X_test_df.values)
+    return {
+        'X_train_file': X_train_file,
+        'X_test_file': X_test_file,
+        'train_index': X_train_df.index,
+        'test_index': X_test_df.index,
+        'columns': X_train_df.columns,
+        'y_train_df': y_train_df,
+        'y_test_df': y_test_df,
+        'preprocessing': preprocessing,
+        'splits': _get_search(data_model.seed).get_splits(
+            X_train_df.values, y_train_df.status.values),
+    }
+
+
+def _grid_task(dep_results, identifier, candidate_ix, split_ix):
+    fold_data, = dep_results
+    search = _get_search(get_shared_data('data_model').seed)
+    train_ixs, valid_ixs = fold_data['splits'][split_ix]
+    try:
+        return su.fit_and_predict(
+            search.estimator,
+            np.load(fold_data['X_train_file'], mmap_mode='r'),
+            fold_data['y_train_df'].status.values,
+            train_ixs,
+            valid_ixs,
+            search.get_candidates()[candidate_ix]
+        )
+    except ValueError as e:
+        cu.check_one_class_error(e, identifier)
+
+
+def _refit_task(dep_results, identifier):
+    fold_data, grid_results = dep_results[0], dep_results[1:]
+    X_train_df, X_test_df, y_train_df, _ = _load_fold_data(fold_data)
+    seed = get_shared_data('data_model').seed
+    solver = get_shared_data('model_options').solver
+    search = get_shared_data('model_options').search
+    try:
+        if solver == 'sgd' and search == 'grid':
+            search = _get_search(seed)
+            search.set_search_results(search.get_candidates(),
+                                      fold_data['splits'],
+                                      grid_results,
+                                      X_train_df.shape[0])
+            search.refit(X_train_df, y_train_df.status)
+            return (search,
+                    search.decision_function(X_train_df),
+                    search.decision_function(X_test_df),
+                    search.cv_decision_function_)
+        else:
+            # other solvers/search methods fit the whole grid at once, so
+            # there are no separate grid tasks
+            return cu.train_model(
+                X_train=X_train_df,
+                X_test=X_test_df,
+                y_train=y_train_df,
+                alphas=cfg.alphas,
+                l1_ratios=cfg.l1_ratios,
+                seed=seed,
+                n_folds=cfg.folds,
+                max_iter=cfg.max_iter,
+                solver=solver,
+                search=search
+            )
+    except ValueError as e:
+        cu.check_one_class_error(e, identifier)
+
+
+def _metrics_task(dep_results, identifier, shuffle_labels, fold_no):
+    fold_data, model_results = dep_results
+    X_train_df, X_test_df, y_train_df, y_test_df = _load_fold_data(fold_data)
+    return cu.get_fold_results(
+        model_results,
+        X_train_df,
+        X_test_df,
+        y_train_df,
+        y_test_df,
+        identifier,
+        get_shared_data('model_options').training_data,
+        'shuffled' if shuffle_labels else 'signal',
+        get_shared_data('data_model').seed,
+        fold_no,
+        output_preds=get_shared_data('output_preds'),
+        preprocessing=fold_data['preprocessing']
+    )
+
+
+def _save_task(dep_results, exp_key, identifier, gene_dir, check_file,
+               shuffle_labels):
+    exp_string = get_shared_data('exp_string')
+    results = {}
+    for fold_results in dep_results:
+        for result_type, result_df in fold_results.items():
+            results.setdefault(
+                '{}_{}'.format(exp_string, result_type), []
+            ).append(result_df)
+    fu.save_results(gene_dir,
+                    check_file,
+                    results,
+                    exp_string,
+                    identifier,
+                    shuffle_labels,
+                    get_shared_data('model_options'))
+    # intermediate data for this experiment isn't needed anymore
+    shutil.rmtree(_get_scratch_dir(exp_key), ignore_errors=True)
+
+
+def add_experiment_tasks(graph,
+                         identifier,
+                         classification,
+                         gene_dir,
+                         check_file,
+                         shuffle_labels,
+                         num_folds,
+                         solver=cfg.default_solver,
+                         search=cfg.default_search):
+    """Add tasks for a single experiment to a task graph.
+
+    Arguments
+    ---------
+    graph (TaskGraph): graph to add tasks to
+    identifier (str): gene or cancer type to run experiment for (None for
+                      purity experiments)
+    classification (str): 'oncogene' or 'TSG', only used for genes
+    gene_dir (str): directory to write output to
+    check_file (str): coefficients file, from fu.check_output_file
+    shuffle_labels (bool): whether or not to shuffle labels (negative control)
+    num_folds (int): number of outer cross-validation folds
+    solver (str): how to fit models, options in cfg.solvers
+    search (str): how to search over hyperparameters, options in
+                  cfg.search_methods
+
+    Returns
+    -------
+    save_task (tuple): ID of the final task for this experiment
+    """
+    exp_key = '{}_{}'.format(identifier,
+                             'shuffled' if shuffle_labels else 'signal')
+    n_candidates = len(_get_search(cfg.default_seed).get_candidates())
+    prep_task = graph.add_task(
+        (exp_key, 'prep'), 'prep', _prep_task,
+        args=(exp_key, identifier, classification, gene_dir, shuffle_labels)
+    )
+    metrics_tasks = []
+    for fold_no in range(num_folds):
+        fold_task = graph.add_task(
+            (exp_key, 'fold', fold_no), 'fold', _fold_task,
+            args=(exp_key, fold_no), deps=[prep_task]
+        )
+        grid_tasks = []
+        if solver == 'sgd' and search == 'grid':
+            # candidates vary slowest, in the order expected by
+            # OOFGridSearchCV.set_search_results
+            for candidate_ix in range(n_candidates):
+                for split_ix in range(cfg.folds):
+                    grid_tasks.append(graph.add_task(
+                        (exp_key, 'grid', fold_no, candidate_ix, split_ix),
+                        'grid', _grid_task,
+                        args=(identifier, candidate_ix, split_ix),
+                        deps=[fold_task]
+                    ))
+        refit_task = graph.add_task(
+            (exp_key, 'refit', fold_no), 'refit', _refit_task,
+            args=(identifier,), deps=[fold_task] + grid_tasks
+        )
+        metrics_tasks.append(graph.add_task(
+            (exp_key, 'metrics', fold_no), 'metrics', _metrics_task,
+            args=(identifier, shuffle_labels, fold_no),
+            deps=[fold_task, refit_task]
+        ))
+    return graph.add_task(
+        (exp_key, 'save'), 'save', _save_task,
+        args=(exp_key, identifier, gene_dir, check_file, shuffle_labels),
+        deps=metrics_tasks
+    )
+
+
+def run_gene_experiments(data_model,
+                         experiments,
+                         sample_info,
+                         model_options,
+                         exp_string='gene',
+                         standardize_columns=False,
+                         output_preds=False,
+                         n_workers=1,
+                         progress=False):
+    """Run a list of classification experiments in parallel.
+
+    Results are written to files as each experiment finishes, in the same
+    format as for run_cv_stratified. Despite the name, this also runs
+    cancer type and purity experiments: the data for each experiment is
+    generated according to exp_string.
+
+    Arguments
+    ---------
+    data_model (TCGADataModel): class containing TCGA data
+    experiments (list): list of (identifier, classification, output_dir,
+                        check_file, shuffle_labels) tuples, one for each
+                        experiment. For cancer type experiments identifier
+                        is the cancer type, for purity experiments it's
+                        None, and classification is only used for genes.
+    sample_info (pd.DataFrame): df with TCGA sample information
+    model_options (Namespace): model options, from the run script
+    exp_string (str): type of experiment being run, 'gene', 'cancer_type'
+                      or 'purity'
+    standardize_columns (bool): whether or not to standardize predictors
+    output_preds (bool): whether or not to write predictions to file
+    n_workers (int): number of worker processes
+    progress (bool): whether or not to show a progress bar
+
+    Returns
+    -------
+    errors (dict): maps (identifier, shuffle_labels) to the error raised,
+                   for experiments that didn't finish
+    stage_report (pd.DataFrame): utilization for each stage, see
+                                 TaskGraph.get_stage_report
+    """
+    graph = TaskGraph()
+    save_tasks = {}
+    for gene, classification, gene_dir, check_file, shuffle_labels in experiments:
+        save_task = add_experiment_tasks(graph,
+                                         gene,
+                                         classification,
+                                         gene_dir,
+                                         check_file,
+                                         shuffle_labels,
+                                         model_options.num_folds,
+                                         solver=model_options.solver,
+                                         search=model_options.search)
+        save_tasks[save_task] = (gene, shuffle_labels)
+
+    scratch_dir = tempfile.mkdtemp(prefix='mpmp_')
+    try:
+        _, task_errors = graph.run(
+            n_workers=n_workers,
+            shared_data={
+                'data_model': data_model,
+                'sample_info': sample_info,
+                'model_options': model_options,
+                'exp_string': exp_string,
+                'standardize_columns': standardize_columns,
+                'output_preds': output_preds,
+                'scratch_dir': scratch_dir,
+            },
+            progress=progress
+        )
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    errors = {exp: task_errors[save_task]
+                for save_task, exp in save_tasks.items()
+                if save_task in task_errors}
+    return errors, graph.get_stage_report()
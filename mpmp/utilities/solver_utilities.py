@@ -0,0 +1,1729 @@
+"""
+Solvers and hyperparameter search methods for fitting elastic net logistic
+regression models.
+
+The default approach in train_model (classify_utilities.py) is to fit an
+SGDClassifier from scratch for every point in the hyperparameter grid. The
+classes here return an object with the same interface as a fit GridSearchCV
+object (best_estimator_, best_params_, cv_results_, decision_function,
+predict_proba), and also keep the out-of-fold predictions from the search
+(cv_decision_function_) so the best model doesn't need to be refit on each
+CV split.
+"""
+import pickle
+import tempfile
+import time
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.special import expit
+from sklearn.base import BaseEstimator, clone
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model._base import LinearClassifierMixin
+from sklearn.metrics import log_loss, roc_auc_score
+from sklearn.model_selection import KFold, ParameterGrid, StratifiedKFold
+from sklearn.pipeline import Pipeline
+from sklearn.utils.class_weight import compute_sample_weight
+
+import mpmp.config as cfg
+
+def alpha_to_C(alpha, n_samples):
+    """Convert SGDClassifier regularization strength to LogisticRegression C.
+
+    SGDClassifier minimizes
+      (1/n) * sum(loss) + alpha * penalty(w)
+    and LogisticRegression minimizes
+      C * sum(loss) + penalty(w)
+    so the two are equivalent when C = 1 / (n * alpha).
+    """
+    return 1.0 / (n_samples * alpha)
+
+
+def get_balanced_weights(Y, mask=None):
+    """Get sample weights for each target, scaled for a weighted mean loss.
+
+    This gives the same objective as SGDClassifier with
+    class_weight='balanced': each sample is weighted by n / (2 * n_class),
+    and the loss is averaged over the n samples, so the weight for each
+    sample is 1 / (2 * n_class).
+
+    Arguments
+    ---------
+    Y (np.array): samples x targets binary labels
+    mask (np.array): samples x targets boolean array, samples that are False
+                     for a target get weight 0 (e.g. validation samples)
+
+    Returns
+    -------
+    weights (np.array): samples x targets sample weights
+    """
+    if mask is None:
+        mask = np.ones(Y.shape, dtype='bool')
+    n_pos = np.sum(mask & (Y == 1), axis=0)
+    n_neg = np.sum(mask & (Y == 0), axis=0)
+    return mask * np.where(Y == 1,
+                           1 / (2 * np.maximum(n_pos, 1)),
+                           1 / (2 * np.maximum(n_neg, 1)))
+
+
+def get_lipschitz_constants(X, sample_weight, n_iter=30):
+    """Estimate Lipschitz constant of the weighted logistic loss gradient.
+
+    For each column of sample_weight, this is 1/4 of the largest eigenvalue of
+    X'^T diag(s) X' (where X' is X with a column of ones for the intercept),
+    estimated by power iteration for all columns at once. Power iteration
+    underestimates the largest eigenvalue, so we scale the estimate up a bit
+    to be safe.
+    """
+    # start from the same vector for each column, so the estimate for a
+    # column doesn't depend on the other columns
+    V = np.ones((X.shape[1], sample_weight.shape[1]))
+    v_b = np.ones(sample_weight.shape[1])
+    for _ in range(n_iter):
+        norms = np.sqrt(np.sum(V**2, axis=0) + v_b**2)
+        V, v_b = V / norms, v_b / norms
+        R = sample_weight * (X @ V + v_b)
+        V, v_b = X.T @ R, R.sum(axis=0)
+    eigvals = np.sqrt(np.sum(V**2, axis=0) + v_b**2)
+    return 1.2 * 0.25 * eigvals
+
+
+def get_strong_rule_mask(grad, coef, l1_pen, l1_prev):
+    """Find features that can be screened out of a fit, for each column.
+
+    This uses the sequential strong rule (Tibshirani et al. 2012): given the
+    gradient of the loss at the solution for a previous (larger) l1 penalty,
+    feature j is discarded if its coefficient is 0 and
+      |grad_j| < 2 * l1_pen - l1_prev
+    Discarded features are very likely to have zero coefficients in the
+    solution, but this isn't guaranteed, so the KKT conditions for discarded
+    features have to be checked after fitting (see fit_logistic_enet).
+
+    Arguments
+    ---------
+    grad (np.array): features x columns gradient of the loss
+    coef (np.array): features x columns coefficients the gradient was
+                     computed at
+    l1_pen (np.array): l1 penalty (alpha * l1_ratio) for each column
+    l1_prev (np.array): l1 penalty that coef is the solution for, for
+                        each column
+
+    Returns
+    -------
+    mask (np.array): features x columns boolean array, True for features
+                     that are kept
+    """
+    return (coef != 0) | (np.abs(grad) >= (2 * l1_pen - l1_prev))
+
+
+class HybridDesignMatrix():
+    """
+    Data matrix made up of a block of dense columns, followed by a block of
+    sparse columns.
+
+    This is used for feature matrices where most features are real-valued
+    (e.g. gene expression) but some are mostly zeros (e.g. one-hot cancer
+    type covariates), so the sparse features don't have to be stored as
+    dense floats. It supports the operations used by the prox solver: matrix
+    products with dense arrays (X @ W and X.T @ R), and subsetting rows and
+    columns (X[rows] and X[:, cols]; columns must be selected in increasing
+    order, or at least with the dense columns first).
+    """
+
+    def __init__(self, dense, sparse):
+        """
+        Arguments
+        ---------
+        dense (np.array): samples x dense features array
+        sparse (scipy.sparse matrix): samples x sparse features matrix
+        """
+        self.dense = np.asarray(dense, dtype='float64')
+        self.sparse = sp.csr_matrix(sparse, dtype='float64')
+        self.n_dense = self.dense.shape[1]
+        self.shape = (self.dense.shape[0],
+                      self.n_dense + self.sparse.shape[1])
+
+    @property
+    def T(self):
+        return _TransposedDesignMatrix(self)
+
+    def __matmul__(self, W):
+        return (self.dense @ W[:self.n_dense] +
+                self.sparse @ W[self.n_dense:])
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        dense, sparse = self.dense[rows], self.sparse[rows]
+        if not (isinstance(cols, slice) and cols == slice(None)):
+            cols = np.arange(self.shape[1])[cols]
+            is_dense = cols < self.n_dense
+            n_dense = np.count_nonzero(is_dense)
+            if not is_dense[:n_dense].all():
+                raise IndexError('dense columns must be selected before '
+                                 'sparse columns')
+            dense = dense[:, cols[:n_dense]]
+            sparse = sparse[:, cols[n_dense:] - self.n_dense]
+        return HybridDesignMatrix(dense, sparse)
+
+    def toarray(self):
+        """Get the data as a dense array."""
+        return np.hstack((self.dense, self.sparse.toarray()))
+
+
+class _TransposedDesignMatrix():
+    """Transpose of a HybridDesignMatrix, for computing X.T @ R."""
+
+    def __init__(self, X):
+        self.X = X
+        self.shape = X.shape[::-1]
+
+    def __matmul__(self, R):
+        return np.concatenate((self.X.dense.T @ R, self.X.sparse.T @ R))
+
+
+def get_design_matrix(X):
+    """Get a data matrix in the form used by the prox solver.
+
+    If X is a DataFrame with sparse columns at the end (e.g. the one-hot
+    cancer type covariates added by tcga_utilities.align_matrices), this
+    returns a HybridDesignMatrix, so the sparse columns don't have to be
+    converted to dense arrays. Otherwise it returns X as a dense array.
+
+    Arguments
+    ---------
+    X (array-like): samples x features data
+
+    Returns
+    -------
+    X (np.array or HybridDesignMatrix): samples x features data matrix
+    """
+    if isinstance(X, HybridDesignMatrix):
+        return X
+    if isinstance(X, pd.DataFrame):
+        is_sparse = np.array([isinstance(dtype, pd.SparseDtype)
+                              for dtype in X.dtypes], dtype='bool')
+        n_dense = np.count_nonzero(~is_sparse)
+        if is_sparse.any() and not is_sparse[:n_dense].any():
+            return HybridDesignMatrix(
+                X.iloc[:, :n_dense].to_numpy(dtype='float64'),
+                X.iloc[:, n_dense:].sparse.to_coo()
+            )
+    return np.asarray(X, dtype='float64')
+
+
+def fit_logistic_enet(X,
+                      Y,
+                      sample_weight,
+                      alphas,
+                      l1_ratios,
+                      max_iter=1000,
+                      tol=cfg.prox_tol,
+                      lipschitz=None,
+                      screen=cfg.prox_screen,
+                      screen_every=10):
+    """Fit elastic net logistic regression models for many columns at once.
+
+    Each column has its own labels, sample weights and hyperparameters, but
+    all columns share the same data matrix, so each iteration needs only one
+    pass over X (two matrix products) to update all the models.
+
+    Minimizes (for each column)
+      sum_i(s_i * log_loss_i) + alpha * (l1_ratio * |w|_1 +
+                                         (1 - l1_ratio) / 2 * |w|_2^2)
+    (with an unpenalized intercept) using accelerated proximal gradient
+    descent (FISTA). This is the same objective as SGDClassifier, with
+    sample weights from get_balanced_weights.
+
+    Each column is updated until it converges, independently of the others,
+    so results for a column don't depend on what it was fit with.
+
+    If screen is True, features that are very likely to have zero
+    coefficients (see get_strong_rule_mask) are left out of the gradient
+    computations. We start from the intercept-only model, which is the
+    solution for any l1 penalty above max_j |grad_j| (the basic strong rule),
+    then every screen_every iterations we screen again using the gradient at
+    the current coefficients, still relative to that penalty (the current
+    coefficients aren't a solution for any penalty, so we can't use the
+    sequential rule's tighter threshold). When a column converges, we check
+    the KKT conditions for its screened features, and if any of them are
+    violated we add them back in and keep updating the column; features
+    that were added back are never screened out again, so screening and
+    the KKT checks can't keep undoing each other.
+
+    Arguments
+    ---------
+    X (array-like): samples x features data matrix, this can be a
+                    HybridDesignMatrix (see get_design_matrix)
+    Y (np.array): samples x columns binary labels
+    sample_weight (np.array): samples x columns sample weights
+    alphas (np.array): regularization strength for each column
+    l1_ratios (np.array): elastic net mixing parameter for each column
+    max_iter (int): maximum number of iterations
+    tol (float): stop updating a column when the largest change in its
+                 coefficients is less than tol * (largest coefficient)
+    lipschitz (np.array): Lipschitz constant of the loss gradient for each
+                          column, if None estimate it from the data
+    screen (bool): whether or not to screen out features while fitting
+    screen_every (int): number of iterations between screening steps
+
+    Returns
+    -------
+    coef (np.array): features x columns coefficients
+    intercept (np.array): intercept for each column
+    n_iter (np.array): number of iterations run for each column
+    """
+    X = get_design_matrix(X)
+    n_cols = Y.shape[1]
+    alphas = np.broadcast_to(np.asarray(alphas, dtype='float64'), (n_cols,))
+    l1_ratios = np.broadcast_to(np.asarray(l1_ratios, dtype='float64'),
+                                (n_cols,))
+    l1_pen = alphas * l1_ratios
+    l2_pen = alphas * (1 - l1_ratios)
+    if lipschitz is None:
+        lipschitz = get_lipschitz_constants(X, sample_weight)
+    step = 1 / (lipschitz + l2_pen)
+
+    coef = np.zeros((X.shape[1], n_cols))
+    intercept = np.zeros(n_cols)
+    n_iter = np.zeros(n_cols, dtype='int')
+
+    # we only keep the columns that haven't converged in the working arrays
+    # below, so that converged columns don't take up time in the matrix
+    # products (the working arrays are only subset when a column converges)
+    active = np.arange(n_cols)
+    W, b = coef.copy(), intercept.copy()
+    # extrapolated points, for acceleration
+    W_z, b_z = W.copy(), b.copy()
+    t = np.ones(n_cols)
+    Y_a, S_a = Y, sample_weight
+    l1_a, l2_a, step_a = l1_pen, l2_pen, step
+
+    # features that aren't screened out for each active column, and the
+    # union of these over all active columns (we only compute gradients
+    # for the features in the union)
+    mask_a = np.ones(coef.shape, dtype='bool')
+    kept = np.arange(X.shape[1])
+    X_kept = X
+    # features added back after a KKT check, for each active column
+    kkt_a = np.zeros(coef.shape, dtype='bool')
+
+    for iter_ix in range(max_iter):
+        # with strong l1 penalties most coefficients are 0, so we can get
+        # the margins using only the features with nonzero coefficients
+        nz_features = np.flatnonzero(np.any(W_z != 0, axis=1))
+        if nz_features.shape[0] < X.shape[1] // 2:
+            margins = X[:, nz_features] @ W_z[nz_features, :]
+        else:
+            margins = X @ W_z
+        R = S_a * (expit(margins + b_z) - Y_a)
+        if screen and (iter_ix % screen_every == 0):
+            loss_grad = X.T @ R
+            if iter_ix == 0:
+                # the intercept-only model is the solution for any l1
+                # penalty above max_j |grad_j|
+                l1_max_a = np.abs(loss_grad).max(axis=0)
+            mask_a = (get_strong_rule_mask(loss_grad, W_z, l1_a, l1_max_a) |
+                      kkt_a)
+            kept = np.flatnonzero(mask_a.any(axis=1))
+            X_kept = X[:, kept]
+            grad = l2_a * W_z + loss_grad
+        else:
+            grad = l2_a * W_z
+            grad[kept, :] += X_kept.T @ R
+        W_new = W_z - step_a * grad
+        W_new = np.sign(W_new) * np.maximum(np.abs(W_new) - step_a * l1_a, 0)
+        if screen:
+            W_new *= mask_a
+        b_new = b_z - step_a * R.sum(axis=0)
+
+        t_new = (1 + np.sqrt(1 + 4 * t**2)) / 2
+        momentum = (t - 1) / t_new
+        W_diff, b_diff = W_new - W, b_new - b
+        W_z = W_new + momentum * W_diff
+        b_z = b_new + momentum * b_diff
+        W, b, t = W_new, b_new, t_new
+        n_iter[active] += 1
+
+        max_change = np.maximum(np.max(np.abs(W_diff), axis=0),
+                                np.abs(b_diff))
+        max_coef = np.maximum(np.max(np.abs(W), axis=0), np.abs(b))
+        converged = max_change <= tol * np.maximum(max_coef, 1e-12)
+
+        if screen and converged.any():
+            # check KKT conditions for screened features: the gradient of
+            # the loss must be no larger than the l1 penalty, otherwise the
+            # feature should have a nonzero coefficient
+            conv_ixs = np.flatnonzero(converged & ~mask_a.all(axis=0))
+            if conv_ixs.shape[0] > 0:
+                R_conv = S_a[:, conv_ixs] * (
+                    expit(X @ W[:, conv_ixs] + b[conv_ixs]) -
+                    Y_a[:, conv_ixs]
+                )
+                violations = (~mask_a[:, conv_ixs] &
+                              (np.abs(X.T @ R_conv) > l1_a[conv_ixs]))
+                violated = violations.any(axis=0)
+                if violated.any():
+                    # add features back in and restart acceleration for
+                    # columns where screening was wrong
+                    mask_a[:, conv_ixs] |= violations
+                    kkt_a[:, conv_ixs] |= violations
+                    converged[conv_ixs[violated]] = False
+                    t[conv_ixs[violated]] = 1
+                    W_z[:, conv_ixs[violated]] = W[:, conv_ixs[violated]]
+                    b_z[conv_ixs[violated]] = b[conv_ixs[violated]]
+
+        if converged.any():
+            coef[:, active[converged]] = W[:, converged]
+            intercept[active[converged]] = b[converged]
+            keep = ~converged
+            active = active[keep]
+            if active.shape[0] == 0:
+                break
+            W, W_z, b, b_z, t = W[:, keep], W_z[:, keep], b[keep], b_z[keep], t[keep]
+            Y_a, S_a = Y_a[:, keep], S_a[:, keep]
+            l1_a, l2_a, step_a = l1_a[keep], l2_a[keep], step_a[keep]
+            mask_a = mask_a[:, keep]
+            if screen:
+                l1_max_a, kkt_a = l1_max_a[keep], kkt_a[:, keep]
+
+        # the union of kept features can change when columns converge or
+        # when features are added back in after a KKT check
+        new_kept = np.flatnonzero(mask_a.any(axis=1))
+        if not np.array_equal(new_kept, kept):
+            kept = new_kept
+            X_kept = X[:, kept]
+
+    # columns that didn't converge in max_iter iterations
+    if active.shape[0] > 0:
+        coef[:, active] = W
+        intercept[active] = b
+
+    return coef, intercept, n_iter
+
+
+def _get_backing_memmap(X):
+    """Get the file-backed memory map that X is a view of, if there is one."""
+    while X is not None:
+        if isinstance(X, np.memmap) and X.filename is not None:
+            return X
+        X = getattr(X, 'base', None)
+    return None
+
+
+@contextmanager
+def shared_array(X, n_jobs=-1, min_bytes=cfg.shared_array_min_bytes):
+    """Get a version of X that can be shared with worker processes.
+
+    joblib memory maps large arrays before sending them to workers, but it
+    does this again for every call to Parallel, and once per worker for
+    other pool implementations. Here we write X to a temporary .npy file
+    once and memory map it, so it can be used for every fit on the same
+    data (the hyperparameter search, refitting the best model, and
+    prediction) and is only ever sent to workers as a file reference.
+
+    If X is small, is already memory mapped, or all the fits will run in
+    the current process (n_jobs = 1), X is used as is.
+
+    Arguments
+    ---------
+    X (array-like): samples x features data
+    n_jobs (int): number of jobs the data will be used with
+    min_bytes (int): only share arrays larger than this
+
+    Yields
+    ------
+    X_shared (np.array): read-only memory map with the same values as X, or
+                         X as a numpy array
+    """
+    X = np.asarray(X)
+    if (effective_n_jobs(n_jobs) == 1 or X.nbytes <= min_bytes or
+            _get_backing_memmap(X) is not None):
+        yield X
+        return
+    with tempfile.TemporaryDirectory(prefix='mpmp_shared_') as temp_dir:
+        array_file = Path(temp_dir, 'X.npy')
+        np.save(array_file, np.ascontiguousarray(X))
+        yield np.load(array_file, mmap_mode='r')
+
+
+def get_serialized_bytes(tasks, n_jobs=-1, max_nbytes=cfg.shared_array_min_bytes):
+    """Estimate the number of bytes sent to workers for a list of tasks.
+
+    This follows how joblib (with the default loky backend) handles numpy
+    arrays: memory mapped arrays are sent as a reference to their file,
+    other arrays larger than max_nbytes are dumped to a temporary file once
+    per call to Parallel (we count the bytes dumped), and everything else
+    is pickled along with each task. If the tasks run in the current
+    process, nothing is serialized.
+
+    Arguments
+    ---------
+    tasks (list): tuple of arguments for each task
+    n_jobs (int): number of jobs the tasks will be run with
+    max_nbytes (int): joblib's threshold for memory mapping arrays
+
+    Returns
+    -------
+    n_bytes (int): estimated number of bytes serialized
+    """
+    if effective_n_jobs(n_jobs) == 1:
+        return 0
+    # large arrays are only dumped once per call to Parallel, even if they
+    # appear in many tasks
+    dumped_bytes = {}
+
+    # arrays that aren't pickled are replaced with a persistent ID (this
+    # works on python 3.7, unlike Pickler.reducer_override)
+    class _TaskPickler(pickle.Pickler):
+        def persistent_id(self, obj):
+            if isinstance(obj, np.ndarray):
+                if _get_backing_memmap(obj) is not None:
+                    return 'memmap'
+                if obj.nbytes > max_nbytes:
+                    dumped_bytes[id(obj)] = obj.nbytes
+                    return 'dumped'
+            return None
+
+    n_bytes = 0
+    for task in tasks:
+        buf = _CountingBuffer()
+        _TaskPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(task)
+        n_bytes += buf.n_bytes
+    return n_bytes + sum(dumped_bytes.values())
+
+
+class _CountingBuffer():
+    """File-like object that just counts the bytes written to it."""
+
+    def __init__(self):
+        self.n_bytes = 0
+
+    def write(self, data):
+        self.n_bytes += len(data)
+
+
+def fit_with_info(estimator, X, y, train_loss=cfg.record_train_loss,
+                  **fit_params):
+    """Fit a model, and record how long it took and whether it converged.
+
+    Arguments
+    ---------
+    estimator (sklearn Pipeline): model to fit, with a 'classify' step
+    X (array-like): samples x features training data
+    y (array-like): binary labels for training data
+    train_loss (bool): whether or not to record the final training loss,
+                       this takes an extra pass over the training data
+    fit_params: passed to estimator.fit
+
+    Returns
+    -------
+    fit_info (dict): number of iterations (epochs for SGDClassifier), fit
+                     time in seconds, whether or not the fit converged
+                     before reaching max_iter (sklearn raises a
+                     ConvergenceWarning for these fits), and if train_loss
+                     is True, final training loss (log loss with balanced
+                     class weights)
+    """
+    start_time = time.time()
+    estimator.fit(X, y, **fit_params)
+    fit_time = time.time() - start_time
+    clf = estimator.named_steps['classify']
+    n_iter = int(np.max(clf.n_iter_))
+    fit_info = {
+        'n_iter': n_iter,
+        'fit_time': fit_time,
+        'converged': n_iter < clf.max_iter,
+    }
+    if train_loss:
+        fit_info['train_loss'] = log_loss(
+            y, expit(estimator.decision_function(X)),
+            sample_weight=compute_sample_weight('balanced', y),
+            labels=[0, 1])
+    return fit_info
+
+
+def fit_and_predict(estimator, X, y, train_ixs, valid_ixs, params):
+    """Fit a model on one CV split, and predict on the validation set.
+
+    Returns the validation predictions/AUROC, and information about the
+    fit (see fit_with_info).
+    """
+    estimator = clone(estimator).set_params(**params)
+    fit_info = fit_with_info(estimator, X[train_ixs], y[train_ixs])
+    y_valid = estimator.decision_function(X[valid_ixs])
+    return y_valid, roc_auc_score(y[valid_ixs], y_valid), fit_info
+
+
+def _fit_and_predict_budget(estimator, X, y, train_ixs, valid_ixs, params,
+                            warm_start=False):
+    """Fit a model on one CV split for successive halving.
+
+    If warm_start is True, estimator has already been fit on this split
+    (with the same hyperparameters) in a previous round, and we continue
+    fitting it rather than starting over.
+
+    Returns the fit estimator as well as the validation predictions/AUROC,
+    so it can be used for the next round.
+    """
+    if warm_start:
+        estimator = estimator.set_params(classify__warm_start=True, **params)
+    else:
+        estimator = clone(estimator).set_params(**params)
+    with warnings.catch_warnings():
+        # fits in early rounds aren't expected to converge
+        warnings.filterwarnings('ignore', category=ConvergenceWarning)
+        estimator.fit(X[train_ixs], y[train_ixs])
+    y_valid = estimator.decision_function(X[valid_ixs])
+    return y_valid, roc_auc_score(y[valid_ixs], y_valid), estimator
+
+
+class WarmStartCache():
+    """
+    Solutions from previous model searches, used to initialize fits with the
+    same hyperparameters (and inner CV split) in the next search.
+
+    This is meant for the outer CV folds of a single experiment, which share
+    most of their training data, so the solutions for one fold are usually
+    close to the solutions for the next one. Coefficients are matched up by
+    feature name, and features that weren't in the previous search start at
+    0, so this is only useful if features mean the same thing in each search
+    (e.g. not with fold-level PCA compression).
+
+    We also keep track of how many iterations each fit took when it was
+    started from zero weights (generally in the first fold), to estimate
+    how many iterations the warm starts saved.
+    """
+
+    def __init__(self):
+        self.feature_names = None
+        self.solutions = {}
+        self.cold_n_iter = {}
+
+    def set_features(self, feature_names):
+        """Set the feature names for the data in the next search."""
+        self.feature_names = pd.Index(feature_names)
+
+    def get(self, key):
+        """Get (coef, intercept) to initialize a fit with, or None.
+
+        Arguments
+        ---------
+        key (tuple): identifies the fit, e.g. (hyperparameters, split index)
+        """
+        if key not in self.solutions:
+            return None
+        coef, intercept = self.solutions[key]
+        return (coef.reindex(self.feature_names, fill_value=0.0).values,
+                intercept)
+
+    def update(self, key, coef, intercept, n_iter, warm):
+        """Save the solution for a fit.
+
+        Arguments
+        ---------
+        key (tuple): identifies the fit, as in get
+        coef (np.array): coefficients for the current features
+        intercept (float): intercept
+        n_iter (int): number of iterations the fit took
+        warm (bool): whether or not the fit was warm started
+
+        Returns
+        -------
+        n_iter_saved (int): number of iterations saved, compared to the
+                            last time this fit was started from zero
+                            weights (0 if it never was)
+        """
+        self.solutions[key] = (pd.Series(coef, index=self.feature_names),
+                               intercept)
+        if not warm:
+            self.cold_n_iter[key] = n_iter
+            return 0
+        return self.cold_n_iter.get(key, n_iter) - n_iter
+
+
+class OOFGridSearchCV():
+    """
+    Exhaustive grid search over hyperparameters, like GridSearchCV, that
+    also keeps the out-of-fold decision function values for each grid point.
+
+    With GridSearchCV, getting cross-validated predictions for the best
+    model requires refitting it on each CV split (e.g. with cross_val_predict),
+    even though the grid search already fit exactly those models. Here we save
+    the predictions during the search instead.
+
+    The splits, scores and selected hyperparameters are the same as for
+    GridSearchCV with scoring='roc_auc'.
+    """
+
+    def __init__(self, estimator, param_grid, cv=4, n_jobs=-1):
+        """
+        Arguments
+        ---------
+        estimator (sklearn estimator): model to fit, must have a
+                                       decision_function method
+        param_grid (dict): maps parameter names to lists of values to try
+        cv (int): number of CV folds
+        n_jobs (int): number of jobs to run in parallel (-1 = all processors)
+        """
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        """Fit models for each hyperparameter combination and pick the best.
+
+        Arguments
+        ---------
+        X (array-like): samples x features training data
+        y (array-like): binary labels for training data
+        """
+        X_values = np.asarray(X)
+        y_values = np.asarray(y)
+        candidates = self.get_candidates()
+        splits = self.get_splits(X_values, y_values)
+
+        tasks = [(self.estimator, X_values, y_values, train_ixs, valid_ixs,
+                  params)
+                 for params in candidates
+                 for train_ixs, valid_ixs in splits]
+        self.bytes_serialized_ = get_serialized_bytes(tasks, self.n_jobs)
+        out = Parallel(n_jobs=self.n_jobs)(
+            delayed(fit_and_predict)(*task) for task in tasks
+        )
+
+        self.set_search_results(candidates, splits, out, X_values.shape[0])
+        self.refit(X_values, y_values)
+        return self
+
+    def _get_fit_info_row(self, params, split, fit_info):
+        # only hyperparameters that vary in the grid are included
+        row = {name.replace('classify__', ''): params[name]
+               for name, values in self.param_grid.items()
+               if len(values) > 1}
+        return dict(row, split=split, **fit_info)
+
+    def get_candidates(self):
+        """Get list of hyperparameter combinations to search over."""
+        return list(ParameterGrid(self.param_grid))
+
+    def get_splits(self, X, y):
+        """Get (train, validation) indexes for each CV split."""
+        # GridSearchCV uses (unshuffled) stratified splits for classifiers
+        return list(StratifiedKFold(n_splits=self.cv).split(X, y))
+
+    def set_search_results(self, candidates, splits, out, n_samples):
+        """Select the best hyperparameters, given results for each grid point.
+
+        This is separate from fit so the fits for each grid point can be run
+        elsewhere (e.g. by the task scheduler in scheduler_utilities.py).
+
+        Arguments
+        ---------
+        candidates (list): hyperparameter combinations, from get_candidates
+        splits (list): CV splits, from get_splits
+        out (list): (validation decision function, validation AUROC) for
+                    each candidate and split, with splits varying fastest,
+                    optionally with fit information (see fit_with_info) as
+                    a third element
+        n_samples (int): number of training samples
+        """
+        n_splits = len(splits)
+        split_scores = np.array([result[1] for result in out]).reshape(
+            len(candidates), n_splits)
+        cv_decisions = np.zeros((len(candidates), n_samples))
+        for ix, (y_valid, *_) in enumerate(out):
+            _, valid_ixs = splits[ix % n_splits]
+            cv_decisions[ix // n_splits, valid_ixs] = y_valid
+
+        # convergence information for each fit, if it was recorded
+        self.fit_info_ = None
+        if len(out) > 0 and all(len(result) > 2 for result in out):
+            self.fit_info_ = pd.DataFrame([
+                self._get_fit_info_row(candidates[ix // n_splits],
+                                       ix % n_splits,
+                                       result[2])
+                for ix, result in enumerate(out)
+            ])
+
+        mean_scores = np.average(split_scores, axis=1)
+        # ties are broken in favor of the first parameter combination in
+        # the grid, like GridSearchCV
+        self.best_index_ = int(np.argmax(mean_scores))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = mean_scores[self.best_index_]
+        self.cv_results_ = {
+            'params': candidates,
+            'mean_test_score': mean_scores,
+            'std_test_score': np.std(split_scores, axis=1),
+        }
+        for param_name in self.param_grid.keys():
+            self.cv_results_['param_{}'.format(param_name)] = np.array(
+                [params[param_name] for params in candidates])
+        for split_ix in range(n_splits):
+            self.cv_results_['split{}_test_score'.format(split_ix)] = (
+                split_scores[:, split_ix]
+            )
+        self.cv_decision_function_ = cv_decisions[self.best_index_, :]
+        # one fit for each candidate/split, plus refitting the best model
+        self.n_fits_ = len(out) + 1
+        return self
+
+    def refit(self, X, y):
+        """Fit the best model on all the training data."""
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_)
+        if getattr(self, 'fit_info_', None) is None:
+            self.best_estimator_.fit(np.asarray(X), np.asarray(y))
+        else:
+            fit_info = fit_with_info(self.best_estimator_, np.asarray(X),
+                                     np.asarray(y))
+            self.fit_info_ = pd.concat((
+                self.fit_info_,
+                pd.DataFrame([self._get_fit_info_row(self.best_params_,
+                                                     'refit', fit_info)])
+            ), ignore_index=True)
+        return self
+
+    def decision_function(self, X):
+        return self.best_estimator_.decision_function(np.asarray(X))
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(np.asarray(X))
+
+
+class HalvingOOFGridSearchCV(OOFGridSearchCV):
+    """
+    Successive halving search over hyperparameters, which otherwise works
+    the same way as OOFGridSearchCV.
+
+    Every hyperparameter combination is first fit with a small budget, and
+    only the best 1/factor of them are kept for the next round, which has
+    factor times the budget. In the last round the remaining combinations
+    are fit with the full budget, and the best is selected from those.
+
+    The budget can either be the number of training samples (i.e. early
+    rounds are fit on a stratified subsample of each training split, and
+    evaluated on the full validation split), or an estimator parameter such
+    as the number of epochs (classify__max_iter). Note that with the default
+    tolerance, SGDClassifier usually converges in a few epochs for our
+    hyperparameter grid, so budgeting by number of samples saves much more
+    time.
+
+    Since poor hyperparameter combinations are usually obvious with a small
+    budget, this is much faster than fitting all of them with the full
+    budget, at the cost of sometimes choosing a slightly worse model. The
+    results of the last round are stored in cv_results_, and the results of
+    all rounds in halving_results_.
+    """
+
+    def __init__(self,
+                 estimator,
+                 param_grid,
+                 cv=4,
+                 n_jobs=-1,
+                 factor=3,
+                 resource='n_samples',
+                 max_resources='auto',
+                 warm_start=True,
+                 random_state=cfg.default_seed):
+        """
+        Arguments
+        ---------
+        estimator (sklearn estimator): model to fit, must have a
+                                       decision_function method
+        param_grid (dict): maps parameter names to lists of values to try
+        cv (int): number of CV folds
+        n_jobs (int): number of jobs to run in parallel (-1 = all processors)
+        factor (int): proportion of candidates kept in each round is
+                      1/factor, and the budget grows by factor each round
+        resource (str): 'n_samples', or estimator parameter to use as budget
+        max_resources (int): budget for the last round, if 'auto' this is
+                             the size of the smallest training split (for
+                             n_samples) or the estimator's parameter value
+        warm_start (bool): if the budget is an estimator parameter, whether
+                           or not to continue fitting models from the
+                           previous round, this requires the estimator's
+                           classifier to support warm_start
+        random_state (int): seed for subsampling training splits
+        """
+        super().__init__(estimator, param_grid, cv=cv, n_jobs=n_jobs)
+        self.factor = factor
+        self.resource = resource
+        self.max_resources = max_resources
+        self.warm_start = warm_start
+        self.random_state = random_state
+
+    def get_budgets(self, n_candidates, max_resources):
+        """Get (number of candidates, budget) for each round."""
+        # this is the same schedule as sklearn's HalvingGridSearchCV: enough
+        # rounds to get to fewer than factor candidates in the last round
+        n_rounds = 1
+        while self.factor**n_rounds <= n_candidates:
+            n_rounds += 1
+        min_resources = max(
+            max_resources // self.factor**(n_rounds - 1), 1)
+        return [(int(np.ceil(n_candidates / self.factor**round_ix)),
+                 max_resources if round_ix == n_rounds - 1
+                   else min_resources * self.factor**round_ix)
+                for round_ix in range(n_rounds)]
+
+    def _subsample(self, train_ixs, y, n_samples):
+        """Get a stratified subsample of a training split."""
+        rng = np.random.default_rng(self.random_state)
+        frac = n_samples / train_ixs.shape[0]
+        sub_ixs = []
+        for label in np.unique(y[train_ixs]):
+            label_ixs = train_ixs[y[train_ixs] == label]
+            # make sure we have at least one sample from each class
+            n_label = max(int(round(frac * label_ixs.shape[0])), 1)
+            sub_ixs.append(rng.choice(label_ixs, n_label, replace=False))
+        return np.sort(np.concatenate(sub_ixs))
+
+    def fit(self, X, y):
+        """Fit models for each hyperparameter combination and pick the best.
+
+        Arguments
+        ---------
+        X (array-like): samples x features training data
+        y (array-like): binary labels for training data
+        """
+        X_values = np.asarray(X)
+        y_values = np.asarray(y)
+        candidates = self.get_candidates()
+        splits = self.get_splits(X_values, y_values)
+
+        by_samples = (self.resource == 'n_samples')
+        max_resources = self.max_resources
+        if max_resources == 'auto':
+            max_resources = (
+                min(train_ixs.shape[0] for train_ixs, _ in splits)
+                  if by_samples
+                  else self.estimator.get_params()[self.resource]
+            )
+
+        # indexes of candidates remaining in the search
+        remaining = list(range(len(candidates)))
+        # fit models from the previous round, and their budget
+        models, prev_resources = {}, 0
+        self.halving_results_ = []
+        n_fits, bytes_serialized = 0, 0
+        for n_candidates, n_resources in self.get_budgets(len(candidates),
+                                                          max_resources):
+            # keep the best candidates from the last round, in the original
+            # order (ties are broken in favor of the first in the grid)
+            remaining = sorted(remaining[:n_candidates])
+            warm_start = (self.warm_start and (not by_samples) and
+                          (prev_resources > 0))
+            if by_samples and n_resources < max_resources:
+                round_splits = [(self._subsample(train_ixs, y_values, n_resources),
+                                 valid_ixs)
+                                for train_ixs, valid_ixs in splits]
+                round_params = {}
+            elif by_samples:
+                # in the last round, use all the training samples
+                round_splits, round_params = splits, {}
+            else:
+                round_splits = splits
+                round_params = {self.resource: (
+                    n_resources - prev_resources if warm_start
+                      else n_resources
+                )}
+            tasks = [(models[(cand_ix, split_ix)] if warm_start
+                        else self.estimator,
+                      X_values, y_values, train_ixs, valid_ixs,
+                      dict(candidates[cand_ix], **round_params),
+                      warm_start)
+                     for cand_ix in remaining
+                     for split_ix, (train_ixs, valid_ixs)
+                       in enumerate(round_splits)]
+            bytes_serialized += get_serialized_bytes(tasks, self.n_jobs)
+            out = Parallel(n_jobs=self.n_jobs)(
+                delayed(_fit_and_predict_budget)(*task) for task in tasks
+            )
+            n_fits += len(out)
+            models = {
+                (cand_ix, split_ix): out[ix * len(splits) + split_ix][2]
+                for ix, cand_ix in enumerate(remaining)
+                for split_ix in range(len(splits))
+            }
+            prev_resources = n_resources
+            out = [(y_valid, score) for y_valid, score, _ in out]
+
+            mean_scores = np.array(
+                [score for _, score in out]
+            ).reshape(len(remaining), len(splits)).mean(axis=1)
+            self.halving_results_.append({
+                'n_resources': n_resources,
+                'params': [candidates[cand_ix] for cand_ix in remaining],
+                'mean_test_score': mean_scores,
+            })
+            # stable sort, so ties stay in the original order
+            remaining = [remaining[ix] for ix in
+                           np.argsort(-mean_scores, kind='stable')]
+
+        # cv_results_ and out-of-fold predictions come from the last round,
+        # which was fit with the full budget
+        self.set_search_results(
+            [candidates[cand_ix] for cand_ix in sorted(remaining)],
+            splits, out, X_values.shape[0]
+        )
+        self.n_fits_ = n_fits + 1
+        self.bytes_serialized_ = bytes_serialized
+        self.refit(X_values, y_values)
+        return self
+
+
+class ProxLogisticClassifier(LinearClassifierMixin, BaseEstimator):
+    """
+    Elastic net logistic regression with balanced class weights, fit using
+    proximal gradient descent (see fit_logistic_enet).
+
+    This is mostly used to hold the models fit by MultiTargetGridSearchCV,
+    but it can be fit on its own as well.
+    """
+
+    def __init__(self, alpha=0.0001, l1_ratio=0.15, max_iter=1000,
+                 tol=cfg.prox_tol):
+        self.alpha = alpha
+        self.l1_ratio = l1_ratio
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def fit(self, X, y):
+        X = get_design_matrix(X)
+        Y = np.asarray(y)[:, np.newaxis]
+        coef, intercept, n_iter = fit_logistic_enet(
+            X, Y, get_balanced_weights(Y), self.alpha, self.l1_ratio,
+            max_iter=self.max_iter, tol=self.tol
+        )
+        return self._set_coef(coef[:, 0], intercept[0], n_iter[0])
+
+    def _set_coef(self, coef, intercept, n_iter):
+        self.coef_ = coef[np.newaxis, :]
+        self.intercept_ = np.array([intercept])
+        self.n_iter_ = np.array([n_iter])
+        self.classes_ = np.array([0, 1])
+        self.n_features_in_ = coef.shape[0]
+        return self
+
+    def predict_proba(self, X):
+        probs = expit(self.decision_function(X))
+        return np.vstack((1 - probs, probs)).T
+
+
+class MultiTargetGridSearchCV():
+    """
+    Grid search over elastic net hyperparameters for many binary targets
+    that share the same data matrix.
+
+    Instead of running a separate search for each target, and fitting each
+    hyperparameter combination separately, all (target, hyperparameter
+    combination) pairs are fit at once for each inner CV split. The weights
+    are stored as a features x (targets * grid points) matrix, so each pass
+    over the data updates every model with one matrix product. The inner CV
+    splits are stratified by each target's labels, as in GridSearchCV; since
+    they're generally different for each target, samples outside a target's
+    training split are given zero weight rather than dropped.
+
+    After fitting, searches_ contains a fit OOFGridSearchCV object for each
+    target, with the same attributes as for a single-target search.
+    """
+
+    def __init__(self, alphas, l1_ratios, cv=4, max_iter=1000,
+                 tol=cfg.prox_tol, max_columns=cfg.prox_max_columns):
+        """
+        Arguments
+        ---------
+        alphas (list): regularization strengths to search over, these are
+                       scaled the same way as for SGDClassifier
+        l1_ratios (list): elastic net mixing parameters to search over
+        cv (int): number of inner CV folds
+        max_iter (int): maximum number of iterations for each fit
+        tol (float): stopping tolerance for each fit
+        max_columns (int): maximum number of models to fit at once, this
+                           limits memory usage to about
+                           (n_samples + n_features) * max_columns floats
+        """
+        self.alphas = alphas
+        self.l1_ratios = l1_ratios
+        self.cv = cv
+        self.max_iter = max_iter
+        self.tol = tol
+        self.max_columns = max_columns
+
+    def fit(self, X, Y):
+        """Fit models for each hyperparameter combination and target.
+
+        Arguments
+        ---------
+        X (array-like): samples x features training data
+        Y (array-like): samples x targets binary labels for training data
+        """
+        # sparse covariate columns are kept sparse here, if there are any
+        X_values = get_design_matrix(X)
+        Y_values = np.asarray(Y)
+        n_targets = Y_values.shape[1]
+
+        searches = [OOFGridSearchCV(
+            estimator=Pipeline(steps=[('classify', ProxLogisticClassifier(
+                max_iter=self.max_iter, tol=self.tol))]),
+            param_grid={'classify__alpha': self.alphas,
+                        'classify__l1_ratio': self.l1_ratios},
+            cv=self.cv
+        ) for _ in range(n_targets)]
+        candidates = searches[0].get_candidates()
+        splits = [search.get_splits(X_values, Y_values[:, k])
+                    for k, search in enumerate(searches)]
+
+        # (validation decision function, AUROC) for each target, indexed
+        # by candidate then split, like in OOFGridSearchCV
+        out = [[None] * (len(candidates) * self.cv) for _ in range(n_targets)]
+        # fit as many candidates at once as we can, columns are ordered by
+        # candidate, then by target
+        chunk_size = max(self.max_columns // n_targets, 1)
+        for split_ix in range(self.cv):
+            train_mask = np.zeros(Y_values.shape, dtype='bool')
+            for k in range(n_targets):
+                train_mask[splits[k][split_ix][0], k] = True
+            sample_weight = get_balanced_weights(Y_values, train_mask)
+            # this only depends on the data and the weights, so we can
+            # reuse it for every hyperparameter combination
+            lipschitz = get_lipschitz_constants(X_values, sample_weight)
+            for chunk_start in range(0, len(candidates), chunk_size):
+                chunk = candidates[chunk_start:chunk_start+chunk_size]
+                coef, intercept, _ = fit_logistic_enet(
+                    X_values,
+                    np.tile(Y_values, (1, len(chunk))),
+                    np.tile(sample_weight, (1, len(chunk))),
+                    np.repeat([c['classify__alpha'] for c in chunk], n_targets),
+                    np.repeat([c['classify__l1_ratio'] for c in chunk], n_targets),
+                    max_iter=self.max_iter,
+                    tol=self.tol,
+                    lipschitz=np.tile(lipschitz, len(chunk))
+                )
+                for k in range(n_targets):
+                    valid_ixs = splits[k][split_ix][1]
+                    y_valid = (X_values[valid_ixs] @ coef[:, k::n_targets] +
+                               intercept[k::n_targets])
+                    for ix in range(len(chunk)):
+                        cand_ix = chunk_start + ix
+                        out[k][cand_ix * self.cv + split_ix] = (
+                            y_valid[:, ix],
+                            roc_auc_score(Y_values[valid_ixs, k],
+                                          y_valid[:, ix])
+                        )
+
+        for k, search in enumerate(searches):
+            search.set_search_results(candidates, splits[k], out[k],
+                                      X_values.shape[0])
+
+        # refit the best model for each target, all at once
+        coef, intercept, n_iter = fit_logistic_enet(
+            X_values,
+            Y_values,
+            get_balanced_weights(Y_values),
+            [search.best_params_['classify__alpha'] for search in searches],
+            [search.best_params_['classify__l1_ratio'] for search in searches],
+            max_iter=self.max_iter,
+            tol=self.tol
+        )
+        for k, search in enumerate(searches):
+            search.best_estimator_ = clone(search.estimator).set_params(
+                **search.best_params_)
+            search.best_estimator_.named_steps['classify']._set_coef(
+                coef[:, k], intercept[k], n_iter[k])
+
+        self.searches_ = searches
+        return self
+
+
+class ElasticNetPathCV():
+    """
+    Select elastic net logistic regression hyperparameters by cross-validation,
+    fitting the regularization path for each l1_ratio with warm starts.
+
+    For each l1_ratio, models are fit in order of decreasing alpha (i.e. from
+    sparsest to least sparse), and each fit is initialized with the solution
+    for the previous alpha. Since solutions for adjacent alphas are close,
+    this takes far fewer passes over the data than fitting each point in the
+    grid from scratch.
+
+    The hyperparameters (and the regularization penalty) are the same as for
+    the SGDClassifier used by train_model, so results should be comparable.
+    """
+
+    def __init__(self,
+                 alphas,
+                 l1_ratios,
+                 n_folds=4,
+                 max_iter=1000,
+                 tol=1e-3,
+                 seed=cfg.default_seed,
+                 warm_start_cache=None):
+        """
+        Arguments
+        ---------
+        alphas (list): regularization strengths to search over, these are
+                       scaled the same way as for SGDClassifier
+        l1_ratios (list): elastic net mixing parameters to search over
+        n_folds (int): number of inner cross-validation folds
+        max_iter (int): max number of passes over the data for each fit
+        tol (float): stopping tolerance for each fit
+        seed (int): seed for random number generator
+        warm_start_cache (WarmStartCache): if provided, start each path from
+                                           the solution for its first alpha
+                                           (and the same split) from the
+                                           previous search, rather than
+                                           from zero weights
+        """
+        self.alphas = alphas
+        self.l1_ratios = l1_ratios
+        self.n_folds = n_folds
+        self.max_iter = max_iter
+        self.tol = tol
+        self.seed = seed
+        self.warm_start_cache = warm_start_cache
+
+    def _get_classifier(self, l1_ratio):
+        return LogisticRegression(penalty='elasticnet',
+                                  solver='saga',
+                                  l1_ratio=l1_ratio,
+                                  max_iter=self.max_iter,
+                                  tol=self.tol,
+                                  warm_start=True,
+                                  random_state=self.seed)
+
+    def _fit_path(self, X, y, l1_ratio, alphas=None, split_ix=None):
+        """Fit models along the regularization path for a single l1_ratio.
+
+        Yields (alpha, fit classifier) for each alpha, in decreasing order.
+        Note that the same classifier object is updated in place for each
+        alpha, so it should be used (or copied) before the next iteration.
+        """
+        if alphas is None:
+            alphas = self.alphas
+        alphas = sorted(alphas, reverse=True)
+        sample_weight = compute_sample_weight('balanced', y)
+        clf = self._get_classifier(l1_ratio)
+        warm = False
+        if self.warm_start_cache is not None:
+            # split_ix is None for the model refit on all the training data
+            init = self.warm_start_cache.get((alphas[0], l1_ratio, split_ix))
+            if init is not None:
+                # LogisticRegression with warm_start=True starts from
+                # coef_ and intercept_, if they're set
+                clf.coef_ = init[0][np.newaxis, :]
+                clf.intercept_ = np.array([init[1]])
+                warm = True
+        for alpha in alphas:
+            clf.set_params(C=alpha_to_C(alpha, X.shape[0]))
+            clf.fit(X, y, sample_weight=sample_weight)
+            if self.warm_start_cache is not None:
+                n_iter = int(clf.n_iter_[0])
+                self.n_iter_ += n_iter
+                self.n_iter_saved_ += self.warm_start_cache.update(
+                    (alpha, l1_ratio, split_ix), clf.coef_[0],
+                    clf.intercept_[0], n_iter, warm)
+            yield alpha, clf
+
+    def fit(self, X, y):
+        """Fit models for each hyperparameter combination and pick the best.
+
+        Arguments
+        ---------
+        X (array-like): samples x features training data
+        y (array-like): binary labels for training data
+        """
+        X_values = np.asarray(X)
+        y_values = np.asarray(y)
+        # same order as the parameter grid in GridSearchCV
+        params = [(alpha, l1_ratio) for alpha in self.alphas
+                                    for l1_ratio in self.l1_ratios]
+        n_params = len(params)
+        split_scores = np.zeros((self.n_folds, n_params))
+        # out-of-fold decision function values for each grid point
+        cv_decisions = np.zeros((n_params, X_values.shape[0]))
+        if self.warm_start_cache is not None:
+            self.n_iter_, self.n_iter_saved_ = 0, 0
+
+        # same splits as GridSearchCV with cv=n_folds, for classifiers
+        cv = StratifiedKFold(n_splits=self.n_folds)
+        for split_ix, (train_ixs, valid_ixs) in enumerate(
+                cv.split(X_values, y_values)):
+            for l1_ratio in self.l1_ratios:
+                for alpha, clf in self._fit_path(X_values[train_ixs],
+                                                 y_values[train_ixs],
+                                                 l1_ratio,
+                                                 split_ix=split_ix):
+                    param_ix = params.index((alpha, l1_ratio))
+                    y_valid = clf.decision_function(X_values[valid_ixs])
+                    cv_decisions[param_ix, valid_ixs] = y_valid
+                    split_scores[split_ix, param_ix] = roc_auc_score(
+                        y_values[valid_ixs], y_valid)
+
+        mean_scores = split_scores.mean(axis=0)
+        # ties are broken in favor of the first parameter combination in
+        # the grid, like GridSearchCV
+        self.best_index_ = int(np.argmax(mean_scores))
+        best_alpha, best_l1_ratio = params[self.best_index_]
+        self.best_params_ = {
+            'classify__alpha': best_alpha,
+            'classify__l1_ratio': best_l1_ratio,
+        }
+        self.best_score_ = mean_scores[self.best_index_]
+        self.cv_results_ = {
+            'params': [{'classify__alpha': a, 'classify__l1_ratio': l}
+                           for a, l in params],
+            'param_classify__alpha': np.array([a for a, _ in params]),
+            'param_classify__l1_ratio': np.array([l for _, l in params]),
+            'mean_test_score': mean_scores,
+            'std_test_score': split_scores.std(axis=0),
+        }
+        for split_ix in range(self.n_folds):
+            self.cv_results_['split{}_test_score'.format(split_ix)] = (
+                split_scores[split_ix, :]
+            )
+        self.cv_decision_function_ = cv_decisions[self.best_index_, :]
+
+        # refit on all the training data, following the path up to the
+        # best alpha so the final fit is warm started as well
+        refit_alphas = [a for a in self.alphas if a >= best_alpha]
+        for _, clf in self._fit_path(X_values, y_values,
+                                     best_l1_ratio, alphas=refit_alphas):
+            pass
+        self.n_fits_ = self.n_folds * n_params + len(refit_alphas)
+        self.best_estimator_ = Pipeline(steps=[('classify', clf)])
+        return self
+
+    def decision_function(self, X):
+        return self.best_estimator_.decision_function(np.asarray(X))
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(np.asarray(X))
+
+
+class GramCache():
+    """
+    Lazily computed covariance (Gram) matrix columns for a training set,
+    and for the training rows of each inner CV split.
+
+    The covariance of the features only depends on the data, not the
+    labels, so it can be shared by every target (and the shuffled label
+    control) fit on the same training set, if the inner CV splits don't
+    depend on the labels either. Columns are computed the first time a
+    feature enters a model, for all splits at once, in a single pass over
+    the data: only the columns for each inner split's validation rows are
+    stored, and the columns for the training rows of a split (or for all
+    rows) are sums of these.
+    """
+
+    def __init__(self, X, n_folds=4, seed=cfg.default_seed):
+        """
+        Arguments
+        ---------
+        X (array-like): samples x features training data
+        n_folds (int): number of inner CV splits, these are unstratified
+                       so they're the same for every target
+        seed (int): seed for shuffling samples into inner CV splits
+        """
+        X = np.asarray(X, dtype='float64')
+        n_features = X.shape[1]
+        self.n_samples = X.shape[0]
+        self.splits = list(KFold(n_splits=n_folds,
+                                 shuffle=True,
+                                 random_state=seed).split(X))
+        # the data is stored as a contiguous block of rows for each split's
+        # validation set, so computing Gram matrix columns doesn't need to
+        # copy rows
+        self.X_valid = [X[valid_ixs] for _, valid_ixs in self.splits]
+        self.n_valid = np.array([len(v) for _, v in self.splits])
+        self.valid_sums = np.array([X_v.sum(axis=0) for X_v in self.X_valid])
+        # X^T X is symmetric, so we store columns as rows: column j of the
+        # Gram matrix over the validation rows of split k is row col_pos[j]
+        # of valid_grams[k]
+        self.col_pos = np.full(n_features, -1)
+        self.n_cached = 0
+        self.valid_grams = np.zeros((n_folds, 0, n_features))
+
+    @property
+    def nbytes(self):
+        """Memory used by the data and the cached columns, in bytes."""
+        return (sum(X_valid.nbytes for X_valid in self.X_valid) +
+                self.valid_grams.nbytes)
+
+    def _add_columns(self, cols):
+        """Compute Gram matrix columns for features that aren't cached yet."""
+        new_cols = np.unique(cols[self.col_pos[cols] < 0])
+        if new_cols.shape[0] == 0:
+            return
+        if 2 * (self.n_cached + new_cols.shape[0]) > self.col_pos.shape[0]:
+            # if we need most of the columns anyway, it's faster to compute
+            # the rest of them all at once (BLAS is more efficient on one
+            # big product than on many small ones)
+            new_cols = np.flatnonzero(self.col_pos < 0)
+        n_cached = self.n_cached + new_cols.shape[0]
+        n_splits, capacity, n_features = self.valid_grams.shape
+        if n_cached > capacity:
+            # grow storage geometrically, so we don't copy it every time,
+            # but never past the number of features
+            capacity = min(max(n_cached, 2 * capacity), n_features)
+            valid_grams = np.zeros((n_splits, capacity, n_features))
+            valid_grams[:, :self.n_cached] = self.valid_grams[:, :self.n_cached]
+            self.valid_grams = valid_grams
+        new_pos = np.arange(self.n_cached, n_cached)
+        for split_ix, X_valid in enumerate(self.X_valid):
+            self.valid_grams[split_ix, new_pos] = X_valid[:, new_cols].T @ X_valid
+        self.col_pos[new_cols] = new_pos
+        self.n_cached = n_cached
+
+    def get_train_ixs(self, split_ix=None):
+        """Get training rows for an inner split (or all rows if None)."""
+        if split_ix is None:
+            return np.arange(self.n_samples)
+        return self.splits[split_ix][0]
+
+    def matvec(self, w):
+        """Get X @ w, for all rows in their original order."""
+        product = np.zeros(self.n_samples)
+        for (_, valid_ixs), X_valid in zip(self.splits, self.X_valid):
+            product[valid_ixs] = X_valid @ w
+        return product
+
+    def rmatvec(self, u, split_ix=None):
+        """Get X^T u over the training rows of an inner split (or all rows
+        if split_ix is None), where u has a value for every row."""
+        return sum(X_valid.T @ u[valid_ixs]
+                     for k, ((_, valid_ixs), X_valid) in enumerate(
+                         zip(self.splits, self.X_valid))
+                     if k != split_ix)
+
+    def get_mean(self, split_ix=None):
+        """Get feature means over the training rows of an inner split."""
+        total = self.valid_sums.sum(axis=0)
+        if split_ix is None:
+            return total / self.n_valid.sum()
+        return ((total - self.valid_sums[split_ix]) /
+                (self.n_valid.sum() - self.n_valid[split_ix]))
+
+    def _get_rows(self, cols, split_ix=None):
+        """Get Gram matrix rows (unnormalized) over the training rows of an
+        inner split, and the number of training rows."""
+        self._add_columns(cols)
+        pos = self.col_pos[cols]
+        return (sum(valid_gram[pos]
+                      for k, valid_gram in enumerate(self.valid_grams)
+                      if k != split_ix),
+                self.n_valid.sum() - (0 if split_ix is None
+                                        else self.n_valid[split_ix]))
+
+    def get_block(self, cols, split_ix=None):
+        """Get the covariance matrix for a subset of features.
+
+        This is over the training rows of an inner split (or all rows if
+        split_ix is None), using the population covariance like
+        StandardScaler.
+        """
+        cols = np.asarray(cols, dtype='int')
+        self._add_columns(cols)
+        block_ixs = np.ix_(self.col_pos[cols], cols)
+        block = sum(valid_gram[block_ixs]
+                      for k, valid_gram in enumerate(self.valid_grams)
+                      if k != split_ix)
+        n_train = self.n_valid.sum()
+        if split_ix is not None:
+            n_train -= self.n_valid[split_ix]
+        mean = self.get_mean(split_ix)[cols]
+        return block / n_train - np.outer(mean, mean)
+
+    def dot(self, cols, w, split_ix=None):
+        """Multiply covariance matrix columns by a vector.
+
+        Arguments
+        ---------
+        cols (np.array): features for the columns to multiply
+        w (np.array): vector to multiply by, same length as cols
+        split_ix (int): inner split, if None use all rows
+
+        Returns
+        -------
+        product (np.array): cov[:, cols] @ w, for all features
+        """
+        cols = np.asarray(cols, dtype='int')
+        rows, n_train = self._get_rows(cols, split_ix)
+        mean = self.get_mean(split_ix)
+        return (w @ rows) / n_train - mean * (mean[cols] @ w)
+
+
+def fit_quadratic_enet(hessian_block,
+                       hessian_dot,
+                       grad,
+                       alphas,
+                       l1_ratio,
+                       max_iter=1000,
+                       tol=cfg.gram_tol):
+    """Fit elastic net path for a quadratic loss with covariance updates.
+
+    This minimizes
+      grad^T w + (1/2) w^T H w + alpha * (l1_ratio * ||w||_1 +
+                                          (1 - l1_ratio) / 2 * ||w||_2^2)
+    for each alpha, in decreasing order with warm starts, using cyclic
+    coordinate descent on the active set (the "covariance updates" from
+    Friedman et al. 2010). Only the columns of H for features that enter a
+    model are used, and features are screened with the sequential strong
+    rule, then the KKT conditions are checked for all features after each fit.
+
+    Arguments
+    ---------
+    hessian_block (function): maps an array of feature indices to the
+                              corresponding square submatrix of H
+    hessian_dot (function): maps an array of feature indices and a vector
+                            of the same length to H[:, indices] @ vector
+    grad (np.array): gradient of the loss at w = 0
+    alphas (list): regularization strengths to fit
+    l1_ratio (float): elastic net mixing parameter
+    max_iter (int): maximum number of coordinate descent sweeps per fit
+    tol (float): stop when the largest change in the loss from updating a
+                 coefficient in a sweep is less than tol
+
+    Yields
+    ------
+    (alpha, coef, n_iter) for each alpha, in decreasing order
+    """
+    coef = np.zeros(grad.shape[0])
+    full_grad = grad.copy()
+    l1_prev = None
+    active = np.zeros(0, dtype='int')
+    for alpha in sorted(alphas, reverse=True):
+        l1_pen, l2_pen = alpha * l1_ratio, alpha * (1 - l1_ratio)
+        # for the first alpha, start with the features that violate the
+        # KKT conditions at w = 0
+        candidates = np.flatnonzero(get_strong_rule_mask(
+            full_grad, coef, l1_pen, l1_pen if l1_prev is None else l1_prev))
+        n_iter = 0
+        while True:
+            active = np.union1d(active, candidates)
+            H_aa = hessian_block(active)
+            diag = np.diag(H_aa).tolist()
+            w_list = coef[active].tolist()
+            g = grad[active] + H_aa @ coef[active]
+            for _ in range(max_iter - n_iter):
+                n_iter += 1
+                max_change = 0.0
+                for j in range(len(w_list)):
+                    z = diag[j] * w_list[j] - g[j]
+                    if z > l1_pen:
+                        w_new = (z - l1_pen) / (diag[j] + l2_pen)
+                    elif z < -l1_pen:
+                        w_new = (z + l1_pen) / (diag[j] + l2_pen)
+                    else:
+                        w_new = 0.0
+                    delta = w_new - w_list[j]
+                    if delta != 0.0:
+                        w_list[j] = w_new
+                        g += H_aa[:, j] * delta
+                        max_change = max(max_change, diag[j] * delta * delta)
+                if max_change < tol:
+                    break
+            coef[active] = w_list
+            # features outside the active set that violate the KKT conditions
+            # have to be added, then we refit
+            nonzero = active[coef[active] != 0]
+            full_grad = grad + hessian_dot(nonzero, coef[nonzero])
+            violations = np.abs(full_grad) > l1_pen
+            violations[active] = False
+            if not violations.any() or n_iter >= max_iter:
+                break
+            candidates = np.flatnonzero(violations)
+        # drop features that left the model, so they aren't swept over
+        active = active[coef[active] != 0]
+        l1_prev = l1_pen
+        yield alpha, coef.copy(), n_iter
+
+
+def fit_intercept(y_linear, y, sample_weight, intercept=0.0, n_iter=20):
+    """Fit the intercept of a logistic model with fixed coefficients.
+
+    This minimizes the weighted logistic loss over the intercept only,
+    with Newton's method, given the linear part of the model (X @ coef).
+    """
+    for _ in range(n_iter):
+        probs = expit(y_linear + intercept)
+        step = (np.sum(sample_weight * (probs - y)) /
+                max(np.sum(sample_weight * probs * (1 - probs)), 1e-12))
+        intercept -= step
+        if abs(step) < 1e-8:
+            break
+    return intercept
+
+
+def get_split_score(y_valid, y_pred):
+    """Get validation AUROC for an inner CV split.
+
+    If the validation set only has one class, the AUROC isn't defined, so
+    we score the split as 0.5 for every hyperparameter combination. That
+    way the split doesn't affect which combination is selected (since we
+    select using the mean score over splits).
+    """
+    if np.unique(y_valid).shape[0] < 2:
+        return 0.5
+    return roc_auc_score(y_valid, y_pred)
+
+
+class GramPathCV():
+    """
+    Select elastic net logistic regression hyperparameters by cross-validation,
+    fitting a quadratic approximation of the logistic loss using only the
+    feature covariance matrix and one gradient per target.
+
+    The balanced logistic loss is approximated by its second order expansion
+    at the null model (w = 0, which is the exact null model for balanced
+    class weights), with the Hessian approximated by (1/4) * the (unweighted)
+    feature covariance matrix. This is exact when the classes are the same
+    size. For imbalanced labels it's a heuristic approximation, not a bound:
+    the balanced weights up-weight samples in the smaller class, so the true
+    Hessian can be larger in the directions those samples span. Each
+    fit only depends on the labels through the gradient (a single X^T y
+    product), and the covariance matrix can be cached and shared by every
+    target fit on the same training data (see GramCache).
+
+    Since this is an approximation, coefficients won't be exactly the same
+    as for the other solvers, even with the same hyperparameters. After
+    fitting, the intercept is refit with the exact weighted logistic loss,
+    so predicted probabilities are reasonably calibrated.
+
+    Inner CV splits aren't stratified by the labels (so the covariance
+    matrices can be shared between targets), unlike the other solvers, so a
+    split's validation set can have only one class if there are very few
+    positive (or negative) samples; see get_split_score for how this is
+    handled.
+    """
+
+    def __init__(self,
+                 alphas,
+                 l1_ratios,
+                 n_folds=4,
+                 max_iter=1000,
+                 tol=cfg.gram_tol,
+                 seed=cfg.default_seed,
+                 gram_cache=None):
+        """
+        Arguments
+        ---------
+        alphas (list): regularization strengths to search over, these are
+                       scaled the same way as for SGDClassifier
+        l1_ratios (list): elastic net mixing parameters to search over
+        n_folds (int): number of inner cross-validation folds
+        max_iter (int): max number of coordinate descent sweeps for each fit
+        tol (float): stopping tolerance for each fit
+        seed (int): seed for inner CV splits
+        gram_cache (GramCache): covariance cache for the training data, if
+                                None a new one is created
+        """
+        self.alphas = alphas
+        self.l1_ratios = l1_ratios
+        self.n_folds = n_folds
+        self.max_iter = max_iter
+        self.tol = tol
+        self.seed = seed
+        self.gram_cache = gram_cache
+
+    def _fit_paths(self, y, alphas, l1_ratios, split_ix=None):
+        """Fit paths for each l1_ratio, on the training rows of a split.
+
+        Yields (alpha, l1_ratio, coef, intercept, n_iter) for each grid point.
+        """
+        cache = self.gram_cache_
+        train_mask = np.zeros(y.shape[0], dtype='bool')
+        train_mask[cache.get_train_ixs(split_ix)] = True
+        sample_weight = get_balanced_weights(y[:, np.newaxis],
+                                             train_mask[:, np.newaxis])[:, 0]
+        mean = cache.get_mean(split_ix)
+        # gradient of the weighted loss at the null model, the weights sum
+        # to 0.5 for each class, so the weighted residuals sum to 0 and
+        # centering the features doesn't change this
+        grad = cache.rmatvec(sample_weight * (0.5 - y), split_ix)
+        for l1_ratio in l1_ratios:
+            for alpha, coef, n_iter in fit_quadratic_enet(
+                    lambda cols: cache.get_block(cols, split_ix) / 4,
+                    lambda cols, w: cache.dot(cols, w, split_ix) / 4,
+                    grad,
+                    alphas,
+                    l1_ratio,
+                    max_iter=self.max_iter,
+                    tol=self.tol):
+                # centered features, so the intercept is -mean^T w
+                yield alpha, l1_ratio, coef, -(mean @ coef), n_iter
+
+    def fit(self, X, y):
+        """Fit models for each hyperparameter combination and pick the best.
+
+        Arguments
+        ---------
+        X (array-like): samples x features training data
+        y (array-like): binary labels for training data
+        """
+        if self.gram_cache is None:
+            self.gram_cache_ = GramCache(X, self.n_folds, self.seed)
+        else:
+            self.gram_cache_ = self.gram_cache
+        y_values = np.asarray(y)
+        if np.unique(y_values).shape[0] < 2:
+            raise ValueError('Only one class present in training labels')
+
+        estimator = Pipeline(steps=[('classify', ProxLogisticClassifier(
+            max_iter=self.max_iter, tol=self.tol))])
+        search = OOFGridSearchCV(
+            estimator=estimator,
+            param_grid={'classify__alpha': self.alphas,
+                        'classify__l1_ratio': self.l1_ratios},
+            cv=self.n_folds
+        )
+        candidates = search.get_candidates()
+        splits = self.gram_cache_.splits
+        out = [None] * (len(candidates) * self.n_folds)
+        for split_ix, (_, valid_ixs) in enumerate(splits):
+            X_valid = self.gram_cache_.X_valid[split_ix]
+            for alpha, l1_ratio, coef, intercept, _ in self._fit_paths(
+                    y_values, self.alphas, self.l1_ratios, split_ix):
+                cand_ix = candidates.index({'classify__alpha': alpha,
+                                            'classify__l1_ratio': l1_ratio})
+                y_valid = X_valid @ coef + intercept
+                out[cand_ix * self.n_folds + split_ix] = (
+                    y_valid, get_split_score(y_values[valid_ixs], y_valid))
+        search.set_search_results(candidates, splits, out, y_values.shape[0])
+
+        # refit the best model on all the training data, this only needs
+        # the path for the best l1_ratio up to the best alpha
+        best_alpha = search.best_params_['classify__alpha']
+        for _, _, coef, intercept, n_iter in self._fit_paths(
+                y_values,
+                [a for a in self.alphas if a >= best_alpha],
+                [search.best_params_['classify__l1_ratio']]):
+            pass
+        intercept = fit_intercept(self.gram_cache_.matvec(coef),
+                                  y_values,
+                                  get_balanced_weights(y_values[:, np.newaxis])[:, 0],
+                                  intercept)
+        search.best_estimator_ = clone(estimator).set_params(
+            **search.best_params_)
+        search.best_estimator_.named_steps['classify']._set_coef(
+            coef, intercept, n_iter)
+
+        for attr in ['best_index_', 'best_params_', 'best_score_',
+                     'cv_results_', 'cv_decision_function_', 'best_estimator_']:
+            setattr(self, attr, getattr(search, attr))
+        self.n_fits_ = search.n_fits_
+        return self
+
+    def decision_function(self, X):
+        return self.best_estimator_.decision_function(np.asarray(X))
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(np.asarray(X))
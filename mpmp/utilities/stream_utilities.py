@@ -0,0 +1,504 @@
+"""
+Functions for training classifiers on mini-batches of samples streamed from
+a memory-mapped data matrix.
+
+The standard approach (see run_cv_stratified in classify_utilities.py) makes
+the full training matrix for each outer CV fold, plus a standardized copy
+and a copy for each grid search worker. For large data types (e.g. me_450k
+with all probes) these copies can be several times the size of the loaded
+data.
+
+Here, the loaded data matrix is written to a .npy file once per data model
+(see get_data_store), and each experiment reads batches of rows from a
+memory map of the file: feature selection and standardization use fold
+statistics accumulated over batches, and models are fit with
+SGDClassifier.partial_fit. So training doesn't copy the data for each fold,
+and the memory it needs on top of the loaded data is about one batch of
+rows plus the model coefficients, regardless of the number of samples.
+Note that this isn't out-of-core: the data model still holds the loaded
+data matrix in memory.
+"""
+import tempfile
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.pipeline import Pipeline
+from sklearn.utils.class_weight import compute_sample_weight
+
+import mpmp.config as cfg
+from mpmp.utilities.solver_utilities import OOFGridSearchCV
+
+def write_memmap_store(X_df, filename, batch_size=cfg.stream_batch_size):
+    """Write a data frame to a .npy file, and memory map it.
+
+    The data is written a batch of rows at a time, so this doesn't make a
+    copy of the full matrix (as X_df.values would if X_df has columns with
+    different dtypes).
+
+    Arguments
+    ---------
+    X_df (pd.DataFrame): samples x features data
+    filename (str or Path): .npy file to write
+    batch_size (int): number of rows to write at a time
+
+    Returns
+    -------
+    X (np.memmap): read-only memory map of the written data
+    """
+    X = np.lib.format.open_memmap(filename,
+                                  mode='w+',
+                                  dtype='float64',
+                                  shape=X_df.shape)
+    for start in range(0, X_df.shape[0], batch_size):
+        X[start:start+batch_size] = X_df.iloc[start:start+batch_size].values
+    X.flush()
+    del X
+    return np.load(filename, mmap_mode='r')
+
+
+def get_data_store(data_model, batch_size=cfg.stream_batch_size):
+    """Get memory-mapped copy of the data loaded by a data model.
+
+    The data is written to a temporary .npy file the first time this is
+    called, and the memory map is reused for later experiments. Copies of
+    the data model (e.g. from the prefetcher) share the same store.
+
+    Arguments
+    ---------
+    data_model (TCGADataModel): class containing TCGA data
+    batch_size (int): number of rows to write at a time
+
+    Returns
+    -------
+    X (np.memmap): read-only memory map of data_model.data_df
+    """
+    store = data_model._stream_store
+    if 'X' not in store:
+        # the directory (and the file) are removed when the data model and
+        # all its copies are garbage collected
+        store['scratch_dir'] = tempfile.TemporaryDirectory(prefix='mpmp_stream_')
+        store['X'] = write_memmap_store(
+            data_model.data_df,
+            Path(store['scratch_dir'].name, 'X.npy'),
+            batch_size=batch_size
+        )
+    return store['X']
+
+
+class ExperimentMatrix():
+    """
+    Read-only view of the data matrix for a single experiment, backed by
+    the store for the data model it came from.
+
+    Indexing with an array of row positions returns a dense array with the
+    same rows and columns as X_df: gene features are read from the store,
+    and non-gene features (covariates, which are small and can depend on
+    the experiment) are kept in memory.
+    """
+
+    def __init__(self, store, store_df, X_df, gene_features):
+        """
+        Arguments
+        ---------
+        store (np.memmap): memory map of store_df, from get_data_store
+        store_df (pd.DataFrame): data written to the store, only the index
+                                 and columns are used
+        X_df (pd.DataFrame): data matrix for the experiment
+        gene_features (np.array): boolean array, True for columns of X_df
+                                  that are in store_df
+        """
+        self.store = store
+        self.shape = X_df.shape
+        self.store_row_ixs = store_df.index.get_indexer(X_df.index)
+        self.gene_ixs = np.flatnonzero(gene_features)
+        store_col_ixs = store_df.columns.get_indexer(
+            X_df.columns[self.gene_ixs])
+        if (self.store_row_ixs < 0).any() or (store_col_ixs < 0).any():
+            raise ValueError('X_df has gene features or samples that are '
+                             'not in the store')
+        # gene features are usually every column of the store, in order,
+        # so we can skip selecting them
+        if np.array_equal(store_col_ixs, np.arange(store.shape[1])):
+            store_col_ixs = None
+        self.store_col_ixs = store_col_ixs
+        self.covariate_ixs = np.flatnonzero(~gene_features)
+        self.covariates = X_df.iloc[:, self.covariate_ixs].to_numpy(
+            dtype='float64')
+
+    def __getitem__(self, row_ixs):
+        row_ixs = np.asarray(row_ixs)
+        X_batch = np.empty((row_ixs.shape[0], self.shape[1]))
+        gene_values = self.store[self.store_row_ixs[row_ixs]]
+        if self.store_col_ixs is not None:
+            gene_values = gene_values[:, self.store_col_ixs]
+        X_batch[:, self.gene_ixs] = gene_values
+        X_batch[:, self.covariate_ixs] = self.covariates[row_ixs]
+        return X_batch
+
+
+def get_batches(n_rows, batch_size):
+    """Split positions 0, ..., n_rows - 1 into contiguous batches."""
+    return [np.arange(start, min(start + batch_size, n_rows))
+              for start in range(0, n_rows, batch_size)]
+
+
+def get_feature_stats(X, row_ixs, feature_ixs, batch_size=cfg.stream_batch_size):
+    """Get mean and standard deviation of features, over a subset of rows.
+
+    Batch statistics are combined using the pairwise update from Chan et al.
+    1979, which is numerically stable. The standard deviation is the
+    population standard deviation, like StandardScaler.
+
+    Arguments
+    ---------
+    X (np.array): samples x features data matrix, can be a memory map
+    row_ixs (np.array): rows to compute statistics over
+    feature_ixs (np.array): features to compute statistics for
+    batch_size (int): number of rows to read at a time
+
+    Returns
+    -------
+    mean (np.array): mean of each feature
+    std (np.array): standard deviation of each feature
+    """
+    stats = (0, np.zeros(feature_ixs.shape[0]), np.zeros(feature_ixs.shape[0]))
+    for batch in get_batches(row_ixs.shape[0], batch_size):
+        stats = update_feature_stats(stats, X[row_ixs[batch]][:, feature_ixs])
+    n, mean, m2 = stats
+    return mean, np.sqrt(m2 / n)
+
+
+def update_feature_stats(stats, X_batch):
+    """Add a batch of rows to running feature statistics.
+
+    Arguments
+    ---------
+    stats (tuple): (number of rows, mean, sum of squared deviations from the
+                   mean) for the rows seen so far
+    X_batch (np.array): batch of rows to add
+
+    Returns
+    -------
+    stats (tuple): updated statistics, the population standard deviation is
+                   np.sqrt(m2 / n)
+    """
+    n, mean, m2 = stats
+    n_batch = X_batch.shape[0]
+    if n_batch == 0:
+        return stats
+    batch_mean = X_batch.mean(axis=0)
+    delta = batch_mean - mean
+    mean = mean + delta * (n_batch / (n + n_batch))
+    m2 = (m2 + np.sum((X_batch - batch_mean)**2, axis=0) +
+          delta**2 * (n * n_batch / (n + n_batch)))
+    return n + n_batch, mean, m2
+
+
+def get_mad_features(X, row_ixs, gene_ixs, subset_mad_genes,
+                     batch_size=cfg.stream_batch_size):
+    """Get the gene features with highest mean absolute deviation.
+
+    This is the same as the feature selection in tcga_utilities.subset_by_mad,
+    but computed over batches of rows (with one pass to get the mean of each
+    feature, and another pass to get the mean absolute deviation).
+
+    Arguments
+    ---------
+    X (np.array): samples x features data matrix, can be a memory map
+    row_ixs (np.array): rows to compute MAD over (i.e. the training set)
+    gene_ixs (np.array): columns of X that are gene features
+    subset_mad_genes (int): number of gene features to keep
+    batch_size (int): number of rows to read at a time
+
+    Returns
+    -------
+    mad_ixs (np.array): columns of X for the selected gene features, in
+                        descending order of MAD
+    """
+    mean, _ = get_feature_stats(X, row_ixs, gene_ixs, batch_size)
+    abs_dev = np.zeros(gene_ixs.shape[0])
+    for batch in get_batches(row_ixs.shape[0], batch_size):
+        abs_dev += np.abs(X[row_ixs[batch]][:, gene_ixs] - mean).sum(axis=0)
+    order = np.argsort(-abs_dev, kind='stable')
+    return gene_ixs[order[:subset_mad_genes]]
+
+
+class StreamingScaler():
+    """
+    Select and standardize features for batches of rows from a data matrix.
+
+    This does the same preprocessing as tcga_utilities.preprocess_data
+    (gene features are subset by MAD and standardized if requested, other
+    features are passed through unchanged), but the statistics it uses are
+    accumulated over batches, so the full matrix is never in memory.
+    """
+
+    def __init__(self, feature_ixs, standardize_mask,
+                 batch_size=cfg.stream_batch_size):
+        """
+        Arguments
+        ---------
+        feature_ixs (np.array): columns of the data matrix to keep, in the
+                                order they should be returned
+        standardize_mask (np.array): boolean array, same length as
+                                     feature_ixs, True for features that
+                                     should be standardized
+        batch_size (int): number of rows to read at a time
+        """
+        self.feature_ixs = feature_ixs
+        self.standardize_mask = standardize_mask
+        self.batch_size = batch_size
+
+    def fit(self, X, row_ixs):
+        """Get standardization statistics for a subset of rows of X."""
+        self.mean_ = np.zeros(self.feature_ixs.shape[0])
+        self.scale_ = np.ones(self.feature_ixs.shape[0])
+        if self.standardize_mask.any():
+            mean, std = get_feature_stats(
+                X, row_ixs, self.feature_ixs[self.standardize_mask],
+                self.batch_size)
+            self.mean_[self.standardize_mask] = mean
+            # constant features are only centered, like StandardScaler
+            self.scale_[self.standardize_mask] = np.where(std == 0, 1, std)
+        return self
+
+    def transform(self, X_batch):
+        """Select and standardize features for a batch of rows."""
+        return (X_batch[:, self.feature_ixs] - self.mean_) / self.scale_
+
+
+def get_fold_scaler(X,
+                    train_ixs,
+                    gene_features,
+                    standardize_columns=False,
+                    subset_mad_genes=-1,
+                    batch_size=cfg.stream_batch_size):
+    """Get (unfit) StreamingScaler for an outer CV fold.
+
+    Features are selected using the training rows only. The scaler should
+    be fit separately to the training and test rows, since that's how the
+    in-memory preprocessing works (see tcga_utilities.preprocess_data).
+
+    Arguments
+    ---------
+    X (np.array): samples x features data matrix, can be a memory map
+    train_ixs (np.array): rows in the training set
+    gene_features (np.array): boolean array, True for gene features
+    standardize_columns (bool): whether or not to standardize gene features
+    subset_mad_genes (int): if > 0, number of gene features to keep
+    batch_size (int): number of rows to read at a time
+
+    Returns
+    -------
+    scaler (StreamingScaler): scaler selecting gene features, then
+                              non-gene features
+    """
+    gene_ixs = np.flatnonzero(gene_features)
+    if subset_mad_genes > 0:
+        gene_ixs = get_mad_features(X, train_ixs, gene_ixs, subset_mad_genes,
+                                    batch_size)
+    non_gene_ixs = np.flatnonzero(~gene_features)
+    feature_ixs = np.concatenate((gene_ixs, non_gene_ixs))
+    standardize_mask = np.concatenate((
+        np.full(gene_ixs.shape[0], standardize_columns),
+        np.zeros(non_gene_ixs.shape[0], dtype='bool')
+    ))
+    return StreamingScaler(feature_ixs, standardize_mask, batch_size)
+
+
+class StreamingSGDSearchCV(OOFGridSearchCV):
+    """
+    Grid search over SGDClassifier hyperparameters, fitting models with
+    partial_fit on batches of rows.
+
+    Each batch is read (and standardized) once per epoch, then used to
+    update the models for every (grid point, CV split) pair, so an epoch
+    is a single pass over the data for the whole search. The stopping
+    criterion for each model is the same as for SGDClassifier.fit: stop
+    when the training loss (summed over the epoch, before each update)
+    hasn't improved by at least tol * n_samples in n_iter_no_change epochs.
+
+    The splits, scores and selected hyperparameters are computed the same
+    way as in OOFGridSearchCV. Note that SGDClassifier resets its cumulative
+    l1 penalty at each call to partial_fit, so the fit models (in particular,
+    their sparsity) depend somewhat on the batch size.
+    """
+
+    def __init__(self,
+                 alphas,
+                 l1_ratios,
+                 cv=4,
+                 max_iter=1000,
+                 tol=1e-3,
+                 n_iter_no_change=5,
+                 batch_size=cfg.stream_batch_size,
+                 seed=cfg.default_seed):
+        """
+        Arguments
+        ---------
+        alphas (list): regularization strengths to search over
+        l1_ratios (list): elastic net mixing parameters to search over
+        cv (int): number of inner CV folds
+        max_iter (int): maximum number of epochs for each model
+        tol (float): stopping tolerance for each model
+        n_iter_no_change (int): number of epochs with no improvement to
+                                wait before stopping
+        batch_size (int): number of rows to read at a time
+        seed (int): seed for random number generators
+        """
+        super().__init__(
+            estimator=Pipeline(steps=[('classify', SGDClassifier(
+                loss='log', penalty='elasticnet', random_state=seed))]),
+            param_grid={'classify__alpha': alphas,
+                        'classify__l1_ratio': l1_ratios},
+            cv=cv,
+            n_jobs=1
+        )
+        self.max_iter = max_iter
+        self.tol = tol
+        self.n_iter_no_change = n_iter_no_change
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def _get_batch(self, X, row_ixs, batch, scaler):
+        X_batch = np.asarray(X[row_ixs[batch]], dtype='float64')
+        if scaler is not None:
+            X_batch = scaler.transform(X_batch)
+        return X_batch
+
+    def _fit_models(self, X, y, row_ixs, scaler, models, train_masks):
+        """Fit models on batches of rows, until each one converges.
+
+        Arguments
+        ---------
+        X, y, row_ixs, scaler: data, see fit
+        models (list): list of (unfit) SGDClassifiers
+        train_masks (list): boolean array for each model, True for the
+                            positions in row_ixs it should be trained on
+        """
+        sample_weights = []
+        for train_mask in train_masks:
+            sample_weight = np.zeros(y.shape[0])
+            sample_weight[train_mask] = compute_sample_weight(
+                'balanced', y[train_mask])
+            sample_weights.append(sample_weight)
+        n_train = [np.count_nonzero(train_mask) for train_mask in train_masks]
+        best_loss = np.full(len(models), np.inf)
+        no_improvement = np.zeros(len(models), dtype='int')
+        active = np.ones(len(models), dtype='bool')
+
+        batches = get_batches(y.shape[0], self.batch_size)
+        rng = np.random.RandomState(self.seed)
+        for _ in range(self.max_iter):
+            epoch_loss = np.zeros(len(models))
+            # shuffle the order of the batches, but keep the rows in each
+            # batch contiguous so reads from the memory map are sequential
+            for batch_ix in rng.permutation(len(batches)):
+                batch = batches[batch_ix]
+                X_batch = self._get_batch(X, row_ixs, batch, scaler)
+                for ix in np.flatnonzero(active):
+                    train_mask = train_masks[ix][batch]
+                    if not train_mask.any():
+                        continue
+                    X_train, y_train = X_batch[train_mask], y[batch][train_mask]
+                    if hasattr(models[ix], 'coef_'):
+                        margins = models[ix].decision_function(X_train)
+                    else:
+                        margins = np.zeros(X_train.shape[0])
+                    # log loss, unweighted like in SGDClassifier.fit
+                    epoch_loss[ix] += np.sum(np.logaddexp(
+                        0, -(2 * y_train - 1) * margins))
+                    models[ix].partial_fit(
+                        X_train, y_train, classes=np.array([0, 1]),
+                        sample_weight=sample_weights[ix][batch][train_mask])
+
+            for ix in np.flatnonzero(active):
+                if epoch_loss[ix] > best_loss[ix] - self.tol * n_train[ix]:
+                    no_improvement[ix] += 1
+                else:
+                    no_improvement[ix] = 0
+                best_loss[ix] = min(best_loss[ix], epoch_loss[ix])
+            active &= (no_improvement < self.n_iter_no_change)
+            if not active.any():
+                break
+
+    def decision_function_rows(self, X, row_ixs, scaler=None):
+        """Get decision function of the best model for rows of X, in batches.
+
+        Arguments
+        ---------
+        X (np.array): samples x features data matrix, can be a memory map
+        row_ixs (np.array): rows to predict on
+        scaler (StreamingScaler): fit scaler for these rows, if None X is
+                                  assumed to be preprocessed already
+        """
+        return np.concatenate([
+            self.best_estimator_.decision_function(
+                self._get_batch(X, row_ixs, batch, scaler))
+            for batch in get_batches(row_ixs.shape[0], self.batch_size)
+        ])
+
+    def fit(self, X, y, row_ixs=None, scaler=None):
+        """Fit models for each hyperparameter combination and pick the best.
+
+        Arguments
+        ---------
+        X (array-like): samples x features data matrix, can be a memory map
+        y (array-like): binary labels for the rows in row_ixs
+        row_ixs (np.array): rows of X to train on, if None use all rows
+        scaler (StreamingScaler): scaler fit to the training rows, if None
+                                  X is assumed to be preprocessed already
+        """
+        if isinstance(X, pd.DataFrame):
+            X = X.values
+        y_values = np.asarray(y)
+        if row_ixs is None:
+            row_ixs = np.arange(X.shape[0])
+        n_samples = row_ixs.shape[0]
+        candidates = self.get_candidates()
+        splits = self.get_splits(np.zeros(n_samples), y_values)
+
+        models, train_masks = [], []
+        for params in candidates:
+            for train_ixs, _ in splits:
+                models.append(clone(self.estimator).set_params(**params)
+                                .named_steps['classify'])
+                train_mask = np.zeros(n_samples, dtype='bool')
+                train_mask[train_ixs] = True
+                train_masks.append(train_mask)
+        with warnings.catch_warnings():
+            # loss='log' is deprecated in newer sklearn versions, but the
+            # rest of the repo still uses it
+            warnings.filterwarnings('ignore', category=FutureWarning)
+            self._fit_models(X, y_values, row_ixs, scaler, models, train_masks)
+
+        # validation predictions for every model, in one pass over the data
+        valid_decisions = [[] for _ in models]
+        for batch in get_batches(n_samples, self.batch_size):
+            X_batch = self._get_batch(X, row_ixs, batch, scaler)
+            for ix, model in enumerate(models):
+                valid_mask = ~train_masks[ix][batch]
+                if valid_mask.any():
+                    valid_decisions[ix].append(
+                        model.decision_function(X_batch[valid_mask]))
+        out = []
+        for ix, decisions in enumerate(valid_decisions):
+            y_valid = np.concatenate(decisions)
+            out.append((y_valid,
+                        roc_auc_score(y_values[~train_masks[ix]], y_valid)))
+        self.set_search_results(candidates, splits, out, n_samples)
+
+        # refit the best model on all the training rows
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_)
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=FutureWarning)
+            self._fit_models(X, y_values, row_ixs, scaler,
+                             [self.best_estimator_.named_steps['classify']],
+                             [np.ones(n_samples, dtype='bool')])
+        return self
@@ -12,6 +12,8 @@ import pandas as pd
 from sklearn.preprocessing import StandardScaler
 
 import mpmp.config as cfg
+import mpmp.utilities.barcode_utilities as bu
+import mpmp.utilities.resource_utilities as ru
 
 def process_y_matrix(y_mutation,
                      y_copy,
@@ -134,7 +136,8 @@ def process_y_matrix_cancertype(acronym,
 def align_matrices(x_file_or_df,
                    y,
                    add_cancertype_covariate=True,
-                   add_mutation_covariate=True):
+                   add_mutation_covariate=True,
+                   sparse_covariates=cfg.sparse_covariates):
     """
     Process the x matrix for the given input file and align x and y together
 
@@ -144,6 +147,9 @@ def align_matrices(x_file_or_df,
     y: pandas DataFrame storing status of corresponding samples
     add_cancertype_covariate: if true, add one-hot encoded cancer type as a covariate
     add_mutation_covariate: if true, add log10(mutation burden) as a covariate
+    sparse_covariates: if true, store the one-hot cancer type covariates as
+                       sparse float columns at the end of the X matrix,
+                       rather than as dense uint8 columns
 
     Returns
     -------
@@ -165,15 +171,29 @@ def align_matrices(x_file_or_df,
     # add features to X matrix if necessary
     gene_features = np.ones(x_df.shape[1]).astype('bool')
 
+    covariate_dfs = []
     if add_cancertype_covariate:
         # add one-hot covariate for cancer type
-        covariate_df = pd.get_dummies(y.DISEASE)
-        x_df = x_df.merge(covariate_df, left_index=True, right_index=True)
+        if sparse_covariates:
+            # these are mostly zeros, and the dense float64 columns they'd be
+            # upcast to when combined with the expression data are large, so
+            # we keep them sparse (see solver_utilities.get_design_matrix)
+            covariate_dfs.append(
+                pd.get_dummies(y.DISEASE, sparse=True, dtype='float64'))
+        else:
+            covariate_dfs.append(pd.get_dummies(y.DISEASE))
 
     if add_mutation_covariate:
         # add covariate for mutation burden
         mutation_covariate_df = pd.DataFrame(y.loc[:, "log10_mut"], index=y.index)
-        x_df = x_df.merge(mutation_covariate_df, left_index=True, right_index=True)
+        if sparse_covariates:
+            # dense columns go before the sparse block
+            covariate_dfs.insert(0, mutation_covariate_df)
+        else:
+            covariate_dfs.append(mutation_covariate_df)
+
+    for covariate_df in covariate_dfs:
+        x_df = x_df.merge(covariate_df, left_index=True, right_index=True)
 
     num_added_features = x_df.shape[1] - gene_features.shape[0]
     if num_added_features > 0:
@@ -214,6 +234,7 @@ def preprocess_data(X_train_raw_df,
     return X_train_df, X_test_df
 
 
+@ru.limit_threads()
 def standardize_gene_features(x_df, gene_features):
     """Standardize (take z-scores of) real-valued gene expression features.
 
@@ -272,53 +293,45 @@ def subset_by_mad(X_train_df, X_test_df, gene_features, subset_mad_genes, verbos
     return train_df, test_df, gene_features
 
 
-def subsample_to_smallest_cancer_type(X_df,
-                                      y_df,
-                                      sample_info_df,
-                                      seed):
+def subsample_to_smallest_cancer_type(cancer_types, seed):
     """Subsample data to the size of the smallest cancer type in dataset.
 
-    Use sample_info_df, filtered to samples in X_df, to calculate the number of
-    samples present for each cancer type. Then randomly subsample each cancer
-    type to the smallest one, returning subsampled data and labels.
+    Samples are grouped by cancer type, then each cancer type is randomly
+    subsampled (without replacement) to the size of the smallest one.
+    This only generates positional indexes, so it doesn't have to touch the
+    data matrix itself.
+
+    Arguments
+    ---------
+    cancer_types (array-like): cancer type for each sample, either as integer
+                               codes or labels. Samples with missing cancer
+                               type (NaN, or a negative code) are excluded.
+    seed (int): seed for random number generator
+
+    Returns
+    -------
+    ss_ixs (np.array): sorted positional indexes of subsampled samples
     """
-    # group train samples by cancer type
-    grouped_samples_df = (
-        sample_info_df.reindex(X_df.index)
-                      .groupby('cancer_type')
-    )
+    if np.issubdtype(np.asarray(cancer_types).dtype, np.integer):
+        codes = np.asarray(cancer_types)
+    else:
+        codes, _ = pd.factorize(cancer_types)
 
-    # get count of each sample type in given dataset
-    counts_df = (
-        grouped_samples_df.count()
-                          .drop(columns=['id_for_stratification'])
-                          .rename(columns={'sample_type': 'disease_count'})
-                          .sort_values(by='disease_count', ascending=True)
-    )
+    valid_ixs = np.flatnonzero(codes >= 0)
+    valid_codes = codes[valid_ixs]
+    counts = np.bincount(valid_codes)
+    smallest_count = counts[counts > 0].min()
 
-    # get fewest samples in train set
-    smallest_count = counts_df.iloc[0, 0]
-
-    # subsample all cancer types in train set to smallest count
-    ss_ixs = np.array(
-        [np.random.choice(x, size=smallest_count)
-             for x in grouped_samples_df.groups.values()]).flatten()
-    X_ss_df = X_df.loc[ss_ixs, :]
-    y_ss_df = y_df.loc[ss_ixs, :]
-
-    # check that all cancer type counts are now the same
-    grouped_ss_df = (
-        sample_info_df.reindex(X_ss_df.index)
-                      .groupby('cancer_type')
-                      .count()
-                      .drop(columns=['id_for_stratification'])
-                      .rename(columns={'sample_type': 'disease_count'})
-                      .sort_values(by='disease_count', ascending=True)
-    )
-    assert min(grouped_ss_df.disease_count) == max(grouped_ss_df.disease_count)
+    # shuffle samples within each cancer type, then take the first
+    # smallest_count samples of each
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(valid_codes.shape[0]), valid_codes))
+    group_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank_in_group = (np.arange(order.shape[0]) -
+                     group_starts[valid_codes[order]])
+    ss_ixs = np.sort(valid_ixs[order[rank_in_group < smallest_count]])
 
-    # return subsampled data and labels
-    return X_ss_df, y_ss_df
+    return ss_ixs
 
 
 def get_overlap_data_types(use_subsampled=False, compressed_data=False):
@@ -422,36 +435,20 @@ def get_and_save_sample_info(tcga_df,
     tcga_id (pd.DataFrame): df describing sample type/cancer type for included samples
     """
 
-    # extract sample type in the order of the gene expression matrix
-    tcga_id = pd.DataFrame(tcga_df.index)
-
-    # extract the last two digits of the barcode and recode sample-type
-    tcga_id = tcga_id.assign(sample_type = tcga_id.sample_id.str[-2:])
-    tcga_id.sample_type = tcga_id.sample_type.replace(sampletype_codes_dict)
-
-    # extract the first two ID numbers after `TCGA-` and recode cancer-type
-    tcga_id = tcga_id.assign(
-        cancer_type=tcga_id.sample_id.str.split('TCGA-', expand=True)[1].str[:2]
-     )
-    tcga_id.cancer_type = tcga_id.cancer_type.replace(cancertype_codes_dict)
-
-    # append cancer-type with sample-type to generate stratification variable
-    tcga_id = tcga_id.assign(id_for_stratification = tcga_id.cancer_type.str.cat(tcga_id.sample_type))
-
-    # get stratification counts - function cannot work with singleton strats
-    stratify_counts = tcga_id.id_for_stratification.value_counts().to_dict()
-
-    # recode stratification variables if they are singletons
-    tcga_id = tcga_id.assign(stratify_samples_count = tcga_id.id_for_stratification)
-    tcga_id.stratify_samples_count = tcga_id.stratify_samples_count.replace(stratify_counts)
-    tcga_id.loc[tcga_id.stratify_samples_count == 1, "stratify_samples"] = "other"
+    # parse barcodes into sample type, cancer type, and stratification ID
+    # (cancer type + sample type), in the order of the data matrix
+    tcga_id = bu.parse_barcodes(tcga_df.index,
+                                sampletype_codes_dict,
+                                cancertype_codes_dict)
+    tcga_id = tcga_id.loc[:, ['sample_id',
+                              'sample_type',
+                              'cancer_type',
+                              'id_for_stratification']]
 
     # write files for downstream use
     os.makedirs(cfg.sample_info_dir, exist_ok=True)
     fname = os.path.join(cfg.sample_info_dir,
                          'tcga_{}_sample_identifiers.tsv'.format(training_data))
-
-    tcga_id.drop(['stratify_samples', 'stratify_samples_count'], axis='columns', inplace=True)
     tcga_id.to_csv(fname, sep='\t', index=False)
 
     return tcga_id
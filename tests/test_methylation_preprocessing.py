@@ -0,0 +1,80 @@
+"""
+Test cases for chunked methylation preprocessing in methylation_utilities.py
+"""
+import pytest
+import numpy as np
+import pandas as pd
+
+import mpmp.utilities.methylation_utilities as mu
+
+n_filter, n_impute, n_mad_genes = 3, 2, 50
+
+@pytest.fixture(scope='module')
+def raw_file(tmp_path_factory):
+    """Write a small probes x samples file with missing values"""
+    rng = np.random.default_rng(42)
+    n_probes, n_samples = 300, 20
+    samples = ['TCGA-{:02d}-{:04d}-01A-11D-A000-05'.format(10 + i, i)
+                   for i in range(n_samples)]
+    # two aliquots from the same tumor, the second should be removed
+    samples[5] = samples[4][:15] + '-01B-11D-A001-05'
+    X = rng.random((n_probes, n_samples)).astype('float32')
+    X[rng.random(X.shape) < 0.01] = np.nan
+    X[rng.random(X.shape) < 0.3 * (np.arange(n_samples) % 7 == 0)] = np.nan
+    df = pd.DataFrame(X,
+                      index=pd.Index(['cg{:08d}'.format(i) for i in range(n_probes)],
+                                     name='Composite Element REF'),
+                      columns=samples)
+    raw_file = tmp_path_factory.mktemp('raw') / 'raw.tsv'
+    df.to_csv(raw_file, sep='\t', float_format='%.6g')
+    return raw_file
+
+
+def preprocess_in_memory(raw_file):
+    """Same preprocessing steps as the 450K methylation notebook"""
+    df = pd.read_csv(raw_file, index_col=0, sep='\t', dtype='float32',
+                     converters={0: str}).transpose()
+    df.index.rename('sample_id', inplace=True)
+    df.index = df.index.str.slice(start=0, stop=15)
+    df = df.loc[~df.index.duplicated(), :]
+    sample_na = df.transpose().isna().sum()
+    bad_samples = sample_na.sort_values(ascending=False).iloc[:n_filter].index.values
+    df = df.loc[~df.index.isin(bad_samples)]
+    df = df.fillna(df.mean(), limit=n_impute)
+    df.dropna(axis='columns', inplace=True)
+    mad_genes = (df - df.mean()).abs().mean().sort_values(ascending=False)
+    return df, df.loc[:, mad_genes.iloc[:n_mad_genes].index]
+
+
+@pytest.mark.parametrize('max_memory_gb', [1e-6, 1e-4, 8])
+def test_chunked_preprocessing(raw_file, tmp_path, max_memory_gb):
+    """Test that chunked preprocessing matches in-memory preprocessing"""
+    full_df, mad_df = preprocess_in_memory(raw_file)
+    values, metadata, mad_values = mu.preprocess_methylation_data(
+        raw_file,
+        tmp_path,
+        n_filter=n_filter,
+        n_impute=n_impute,
+        max_memory_gb=max_memory_gb
+    )
+    assert np.array_equal(metadata['samples'], full_df.index.values)
+    assert np.array_equal(metadata['probes'], full_df.columns.values)
+    assert np.array_equal(np.asarray(values).T, full_df.values)
+
+    chunked_mad_df = mu.subset_by_mad(values, metadata, mad_values, n_mad_genes)
+    pd.testing.assert_frame_equal(chunked_mad_df, mad_df)
+
+
+def test_probe_count_curve(raw_file):
+    """Test incremental probe counts against filtering for each count"""
+    df = pd.read_csv(raw_file, index_col=0, sep='\t').transpose()
+    sample_na = df.transpose().isna().sum()
+    samples_sorted = sample_na.sort_values(ascending=False)
+    expected_counts = []
+    for filter_count in range(df.shape[0] + 1):
+        bad_samples = samples_sorted.iloc[:filter_count].index.values
+        expected_counts.append(
+            df.loc[~df.index.isin(bad_samples)].dropna(axis='columns').shape[1]
+        )
+    probe_counts = mu.get_probe_count_curve(df.values.T, max_memory_gb=1e-6)
+    assert np.array_equal(probe_counts, expected_counts)
@@ -1,14 +1,34 @@
 """
 Test cases for model fitting code in classify_utilities.py
 """
+import copy
+import threading
+from argparse import Namespace
+from collections import OrderedDict
+from pathlib import Path
+
 import pytest
 import numpy as np
 import pandas as pd
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import StratifiedKFold
 
+import mpmp.config as cfg
 import mpmp.test_config as tcfg
 from mpmp.data_models.tcga_data_model import TCGADataModel
+from mpmp.exceptions import ResultsFileExistsError
 import mpmp.utilities.classify_utilities as cu
+import mpmp.utilities.compression_utilities as cmp
 import mpmp.utilities.data_utilities as du
+import mpmp.utilities.file_utilities as fu
+import mpmp.utilities.model_utilities as mu
+import mpmp.utilities.null_utilities as nu
+import mpmp.utilities.prefetch_utilities as pf
+import mpmp.utilities.resource_utilities as ru
+import mpmp.utilities.scheduler_utilities as sch
+import mpmp.utilities.solver_utilities as su
+import mpmp.utilities.stream_utilities as stream
+import mpmp.utilities.tcga_utilities as tu
 
 @pytest.fixture
 def data_model(data_type):
@@ -53,3 +73,957 @@ def test_stratified_classification(data_model, data_type, gene_info):
     assert np.allclose(metrics_df['auroc'].values, old_results)
 
 
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_fold_compression_cache(data_type):
+    """Test that projections fit within folds are reused across runs"""
+    tcga_data = TCGADataModel(training_data=data_type,
+                              fold_compression=True,
+                              n_dim=10,
+                              debug=True, test=True)
+    sample_info_df = du.load_sample_info(train_data_type=data_type)
+    gene, classification = tcfg.stratified_gene_info[0]
+    n_projections = []
+    for shuffle_labels in (False, True):
+        tcga_data.process_data_for_gene(gene,
+                                        classification,
+                                        gene_dir=None,
+                                        shuffle_labels=shuffle_labels)
+        results = cu.run_cv_stratified(tcga_data,
+                                       'gene',
+                                       gene,
+                                       data_type,
+                                       sample_info_df,
+                                       num_folds=4,
+                                       standardize_columns=True,
+                                       shuffle_labels=shuffle_labels)
+        n_projections.append(len(tcga_data.fold_projections))
+        coef_df = pd.concat(results['gene_coef'])
+        # compressed features + covariates
+        assert coef_df.groupby('fold').size().iloc[0] == (
+            10 + np.count_nonzero(~tcga_data.gene_features)
+        )
+    # one projection per fold, shared by the shuffled control
+    assert n_projections == [4, 4]
+
+    # projections for different seeds aren't shared, and the least recently
+    # used ones are dropped when the cache is full
+    X_df = tcga_data.X_df
+    covariates = X_df.columns[~tcga_data.gene_features]
+    cache = OrderedDict()
+    for seed in (1, 2):
+        cmp.compress_fold(X_df, X_df, covariates, 10, seed=seed, cache=cache)
+    assert [key[2] for key in cache] == [1, 2]
+    nbytes = cmp.get_projection_nbytes(cache[next(iter(cache))])
+    for seed in (1, 3):
+        cmp.compress_fold(X_df, X_df, covariates, 10, seed=seed, cache=cache,
+                          max_bytes=2.5 * nbytes)
+    assert [key[2] for key in cache] == [1, 3]
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_fold_assignments(data_model, tmp_path):
+    """Test that precomputed fold assignments match stratified splits"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    cu._fold_assignment_cache.clear()
+    fold_assignments = cu.get_fold_assignments(tcga_data.X_df,
+                                               sample_info_df,
+                                               num_folds=4,
+                                               seed=tcga_data.seed,
+                                               cache_dir=tmp_path)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    kf = StratifiedKFold(n_splits=4, shuffle=True, random_state=tcga_data.seed)
+    strat_ids = cu.get_stratification_info(
+        tcga_data.X_df, sample_info_df, num_folds=4
+    ).id_for_stratification
+    for fold_no, (train_ixs, test_ixs) in enumerate(
+            kf.split(tcga_data.X_df, strat_ids)):
+        fold_train_ixs, fold_test_ixs = cu.get_fold_ixs(fold_assignments, fold_no)
+        assert np.array_equal(train_ixs, fold_train_ixs)
+        assert np.array_equal(test_ixs, fold_test_ixs)
+
+    # assignments should be loaded from file if they're not in memory
+    cu._fold_assignment_cache.clear()
+    assert np.array_equal(
+        fold_assignments,
+        cu.get_fold_assignments(tcga_data.X_df,
+                                sample_info_df,
+                                num_folds=4,
+                                seed=tcga_data.seed,
+                                cache_dir=tmp_path)
+    )
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_fold_data_subsample(data_model, monkeypatch):
+    """Test subsampling each fold to the smallest cancer type"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    fold_assignments = cu.get_cv_fold_assignments(tcga_data,
+                                                  gene,
+                                                  sample_info_df,
+                                                  num_folds=4)
+    monkeypatch.setattr(cfg, 'subsample_to_smallest', True)
+    X_train_df, X_test_df, y_train_df, y_test_df = cu.get_fold_data(
+        tcga_data, sample_info_df, fold_assignments, 0)
+    for X_df, y_df in ((X_train_df, y_train_df), (X_test_df, y_test_df)):
+        assert X_df.index.equals(y_df.index)
+        counts = sample_info_df.cancer_type.reindex(X_df.index).value_counts()
+        assert (counts[counts > 0] == counts.max()).all()
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_set_seed(data_model):
+    """Test that label shuffling depends only on the data model's seed"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    global_state = np.random.get_state()[1].copy()
+    shuffled_labels = {}
+    for seed in (1, 2, 1):
+        tcga_data.set_seed(seed)
+        tcga_data.process_data_for_gene(gene,
+                                        classification,
+                                        gene_dir=None,
+                                        shuffle_labels=True)
+        shuffled_labels.setdefault(seed, []).append(
+            tcga_data.y_df.status.values)
+    # same seed should give the same shuffled labels, different seeds
+    # should give different labels, and the global random state
+    # shouldn't be used
+    assert np.array_equal(*shuffled_labels[1])
+    assert not np.array_equal(shuffled_labels[1][0], shuffled_labels[2][0])
+    assert np.array_equal(global_state, np.random.get_state()[1])
+
+    # each experiment should get its own random stream, which doesn't
+    # depend on the draws made before it
+    tcga_data.set_seed(1)
+    tcga_data.set_experiment_seed(gene, True)
+    first_draw = tcga_data.rng.random()
+    tcga_data.set_experiment_seed(gene, True)
+    assert tcga_data.rng.random() == first_draw
+    assert tcga_data.seed == 1
+    tcga_data.set_experiment_seed('OTHER_GENE', True)
+    assert tcga_data.rng.random() != first_draw
+
+    # unshuffled labels should come from the cache, not be modified
+    # by the shuffling
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    y_df_raw = tcga_data._generate_gene_labels(gene, classification, None)
+    assert np.array_equal(tcga_data.y_df.status.values,
+                          y_df_raw.loc[tcga_data.y_df.index].status.values)
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+@pytest.mark.parametrize('solver', ['path', 'gram'])
+def test_path_solver(data_model, data_type, solver):
+    """Test that the path/gram solvers can be used in place of the SGD grid search"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False,
+                                   output_preds=True,
+                                   solver=solver)
+    metrics_df = pd.concat(results['gene_metrics'])
+    assert metrics_df.shape[0] == 4 * 3
+    assert metrics_df.auroc.between(0, 1).all()
+    # TP53 is fairly easy to predict, even with the test data subset
+    assert metrics_df[metrics_df.data_type == 'test'].auroc.mean() > 0.7
+    preds_df = pd.concat(results['gene_preds'])
+    assert preds_df.index.equals(preds_df.index.unique())
+    assert preds_df.shape[0] == tcga_data.X_df.shape[0]
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_warm_start(data_model, data_type):
+    """Test warm starting fits from the previous outer fold"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False,
+                                   solver='path',
+                                   warm_start=True)
+    metrics_df = pd.concat(results['gene_metrics'])
+    assert metrics_df.auroc.between(0, 1).all()
+    assert (metrics_df.n_iter > 0).all()
+    # the first fold is started from zero weights
+    assert (metrics_df[metrics_df.fold == 0].n_iter_saved == 0).all()
+    assert metrics_df.n_iter_saved.notna().all()
+
+    # solutions are matched up by feature name
+    cache = su.WarmStartCache()
+    cache.set_features(['a', 'b', 'c'])
+    assert cache.update('key', np.array([1.0, 2.0, 3.0]), 0.5, 10, False) == 0
+    cache.set_features(['c', 'd', 'a'])
+    coef, intercept = cache.get('key')
+    assert np.array_equal(coef, [3.0, 0.0, 1.0]) and intercept == 0.5
+    assert cache.update('key', coef, intercept, 4, True) == 6
+    assert cache.get('other_key') is None
+
+    for solver in ['sgd', 'prox']:
+        with pytest.raises(ValueError):
+            cu.run_cv_stratified(tcga_data,
+                                 'gene',
+                                 gene,
+                                 data_type,
+                                 sample_info_df,
+                                 num_folds=4,
+                                 solver=solver,
+                                 warm_start=True)
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_task_graph(data_model, data_type, tmp_path):
+    """Test that results from the task scheduler match serial results"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False)
+    metrics_df = pd.concat(results['gene_metrics'])
+
+    model_options = Namespace(num_folds=4,
+                              solver='sgd',
+                              search='grid',
+                              training_data=data_type,
+                              seed=tcga_data.seed,
+                              n_dim=None)
+    experiments = [
+        (gene, classification, tmp_path, tmp_path / 'coef.tsv.gz', False),
+        ('NOT_A_GENE', classification, tmp_path, tmp_path / 'x.tsv.gz', False),
+    ]
+    errors, stage_report = sch.run_gene_experiments(tcga_data,
+                                                    experiments,
+                                                    sample_info_df,
+                                                    model_options,
+                                                    standardize_columns=True,
+                                                    n_workers=2)
+    assert list(errors.keys()) == [('NOT_A_GENE', False)]
+    assert sch.get_skip_reason(errors[('NOT_A_GENE', False)]) == 'gene_not_found'
+    graph_metrics_df = pd.read_csv(
+        list(tmp_path.glob('*classify_metrics*'))[0], sep='\t'
+    )
+    assert np.allclose(metrics_df['auroc'].values,
+                       graph_metrics_df['auroc'].values,
+                       atol=1e-4)
+    assert stage_report.loc['grid', 'n_tasks'] == (
+        4 * cfg.folds * len(cfg.alphas) * len(cfg.l1_ratios)
+    )
+
+    # running tasks in this process shouldn't change the shared data model
+    X_df, y_df = tcga_data.X_df, tcga_data.y_df
+    for check_file in tmp_path.glob('*.tsv.gz'):
+        check_file.unlink()
+    sch.run_gene_experiments(tcga_data,
+                             experiments[:1],
+                             sample_info_df,
+                             model_options,
+                             standardize_columns=True,
+                             n_workers=1)
+    assert tcga_data.X_df is X_df and tcga_data.y_df is y_df
+
+    # cancer type experiments are run the same way
+    tcga_data.set_experiment_seed('BRCA', True)
+    tcga_data.process_data_for_cancer_type('BRCA', None, shuffle_labels=True)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'cancer_type',
+                                   'BRCA',
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=True)
+    metrics_df = pd.concat(results['cancer_type_metrics'])
+    errors, _ = sch.run_gene_experiments(
+        tcga_data,
+        [('BRCA', None, tmp_path, tmp_path / 'brca.tsv.gz', True)],
+        sample_info_df,
+        model_options,
+        exp_string='cancer_type',
+        standardize_columns=True,
+        n_workers=2
+    )
+    assert len(errors) == 0
+    graph_metrics_df = pd.read_csv(
+        list(tmp_path.glob('BRCA_*classify_metrics*'))[0], sep='\t'
+    )
+    assert np.allclose(metrics_df['auroc'].values,
+                       graph_metrics_df['auroc'].values,
+                       atol=1e-4)
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_multi_target(data_model, data_type, monkeypatch):
+    """Test that genes fit together get the same results as when fit alone"""
+    tcga_data, sample_info_df = data_model
+    # smaller grid, to keep the test fast
+    monkeypatch.setattr(cfg, 'alphas', cfg.alphas[::2])
+    monkeypatch.setattr(cfg, 'l1_ratios', cfg.l1_ratios[::2])
+    gene, classification = tcfg.stratified_gene_info[0]
+    # add a copy of the gene, which will have the same samples
+    copy_gene = '{}_copy'.format(gene)
+    tcga_data.mutation_df[copy_gene] = tcga_data.mutation_df[gene]
+    tcga_data.copy_loss_df[copy_gene] = tcga_data.copy_loss_df[gene]
+    tcga_data.copy_gain_df[copy_gene] = tcga_data.copy_gain_df[gene]
+
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False,
+                                   solver='prox')
+    metrics_df = pd.concat(results['gene_metrics'])
+
+    # the data for each gene should only be aligned once
+    n_filtered = []
+    filter_data = tcga_data._filter_data
+    def count_filter_data(*args, **kwargs):
+        n_filtered.append(1)
+        return filter_data(*args, **kwargs)
+    monkeypatch.setattr(tcga_data, '_filter_data', count_filter_data)
+    monkeypatch.setattr(tcga_data, '_filtered_cache', (None, None))
+    all_results = cu.run_cv_multi_target(
+        tcga_data,
+        'gene',
+        [(gene, classification, None),
+         (copy_gene, classification, None),
+         ('NOT_A_GENE', classification, None)],
+        data_type,
+        sample_info_df,
+        num_folds=4,
+        standardize_columns=True
+    )
+    assert isinstance(all_results['NOT_A_GENE'], KeyError)
+    assert len(n_filtered) == 2
+    for identifier in (gene, copy_gene):
+        assert np.allclose(
+            metrics_df['auroc'].values,
+            pd.concat(all_results[identifier]['gene_metrics'])['auroc'].values
+        )
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_halving_search(data_model, data_type):
+    """Test successive halving search, and that fit info is recorded"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False,
+                                   search='halving')
+    metrics_df = pd.concat(results['gene_metrics'])
+    n_candidates = len(cfg.alphas) * len(cfg.l1_ratios)
+    # 36 candidates -> 12 -> 4 -> 2, plus refitting the best model
+    n_fits = cfg.folds * sum(
+        int(np.ceil(n_candidates / cfg.halving_factor**i)) for i in range(4)
+    ) + 1
+    assert (metrics_df.n_fits == n_fits).all()
+    assert (metrics_df.fit_time > 0).all()
+    assert metrics_df.auroc.notna().all()
+
+    # grid search should record the number of fits as well
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False)
+    metrics_df = pd.concat(results['gene_metrics'])
+    assert (metrics_df.n_fits == cfg.folds * n_candidates + 1).all()
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_fit_info(data_model, data_type):
+    """Test that convergence information is recorded for every fit"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False)
+    metrics_df = pd.concat(results['gene_metrics'])
+    fits_df = pd.concat(results['gene_fits'])
+    n_candidates = len(cfg.alphas) * len(cfg.l1_ratios)
+    # one row for each candidate/split and the refit, for each fold
+    assert fits_df.shape[0] == 4 * (n_candidates * cfg.folds + 1)
+    assert (fits_df.split == 'refit').sum() == 4
+    assert (metrics_df.n_fits == n_candidates * cfg.folds + 1).all()
+    assert fits_df.n_iter.between(1, cfg.max_iter).all()
+    assert (fits_df.fit_time > 0).all()
+    assert (fits_df.converged == (fits_df.n_iter < cfg.max_iter)).all()
+    # training loss takes an extra pass over the data, so it's opt-in
+    assert 'train_loss' not in fits_df.columns
+
+    rng = np.random.default_rng(cfg.default_seed)
+    X = rng.standard_normal((200, 20))
+    y = (X[:, 0] + rng.standard_normal(200) > 0).astype(int)
+    estimator = cu.get_sgd_estimator(cfg.default_seed, max_iter=100)
+    fit_info = su.fit_with_info(estimator, X, y, train_loss=True)
+    assert fit_info['train_loss'] > 0
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_permutation_null(data_model, data_type, tmp_path):
+    """Test permutation null distributions for fixed hyperparameters"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False,
+                                   solver='prox')
+    # fit permutations in a few chunks
+    null_results = nu.run_permutation_null(
+        tcga_data,
+        gene,
+        sample_info_df,
+        num_folds=4,
+        n_permutations=20,
+        standardize_columns=True,
+        fold_params=nu.get_fold_params(results['gene_model']),
+        max_columns=8
+    )
+    assert null_results['auroc'].shape == (4, 21)
+
+    # the true labels are permutation 0, and the prox solver fits the same
+    # models, so these should match the signal results
+    metrics_df = pd.concat(results['gene_metrics'])
+    test_auroc = metrics_df[metrics_df.data_type == 'test'].auroc.values
+    assert np.allclose(null_results['auroc'][:, 0], test_auroc, atol=1e-5)
+
+    # null AUROCs should be the same as sklearn's, and centered near 0.5
+    rng = np.random.default_rng(cfg.default_seed)
+    Y = rng.integers(2, size=(50, 5))
+    scores = rng.normal(size=(50, 5)).round(1)
+    assert np.allclose(nu.get_auroc(Y, scores),
+                       [roc_auc_score(Y[:, ix], scores[:, ix])
+                          for ix in range(5)])
+    assert abs(np.nanmean(null_results['auroc'][:, 1:]) - 0.5) < 0.1
+
+    output_file = tmp_path / 'null_distribution.npz'
+    nu.save_null_distribution(output_file, null_results)
+    loaded_results = nu.load_null_distribution(output_file)
+    assert loaded_results.keys() == null_results.keys()
+    assert np.array_equal(loaded_results['aupr'], null_results['aupr'],
+                          equal_nan=True)
+    _, _, p_value = nu.get_permutation_pvalue(loaded_results)
+    assert 1 / 21 <= p_value <= 1
+
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+@pytest.mark.parametrize('depth, max_bytes', [(0, 0), (2, 0), (2, 1e9)])
+def test_prefetch(data_model, depth, max_bytes):
+    """Test that prefetched data matches data prepared in the main thread"""
+    tcga_data, sample_info_df = data_model
+    experiments = [(gene, classification, None, shuffle_labels, seed)
+                     for shuffle_labels in (False, True)
+                     for gene, classification in tcfg.stratified_gene_info
+                     for seed in (1, 2)]
+    prefetcher = pf.prefetch_gene_data(tcga_data,
+                                       experiments,
+                                       sample_info_df,
+                                       num_folds=4,
+                                       depth=depth,
+                                       max_bytes=max_bytes)
+    for experiment, gene_data, error in prefetcher:
+        assert error is None
+        gene, classification, _, shuffle_labels, seed = experiment
+        tcga_data.set_seed(seed)
+        tcga_data.set_experiment_seed(gene, shuffle_labels)
+        tcga_data.process_data_for_gene(gene,
+                                        classification,
+                                        gene_dir=None,
+                                        shuffle_labels=shuffle_labels)
+        assert gene_data.seed == seed
+        assert gene_data.X_df.equals(tcga_data.X_df)
+        assert gene_data.y_df.equals(tcga_data.y_df)
+
+    report_df = prefetcher.get_stage_report()
+    assert report_df.n_tasks.tolist() == [len(experiments)] * 2
+    assert (report_df.idle_time >= 0).all()
+
+    # stopping early should stop the background thread
+    n_threads = threading.active_count()
+    for _ in prefetcher:
+        break
+    assert threading.active_count() == n_threads
+
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_prefetch_concurrent(data_model, data_type):
+    """Test that training while preparing data gives the same results"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    # the same gene with different seeds shares cached data between the
+    # thread preparing data and the thread training models
+    experiments = [(gene, classification, None, shuffle_labels, seed)
+                     for shuffle_labels in (False, True)
+                     for seed in (1, 2)]
+    aurocs = {}
+    for depth in (0, 2):
+        for experiment, gene_data, error in pf.prefetch_gene_data(
+                tcga_data, experiments, sample_info_df, num_folds=4,
+                depth=depth):
+            assert error is None
+            results = cu.run_cv_stratified(gene_data,
+                                           'gene',
+                                           gene,
+                                           data_type,
+                                           sample_info_df,
+                                           num_folds=4,
+                                           standardize_columns=True,
+                                           shuffle_labels=experiment[3])
+            aurocs.setdefault(experiment, []).append(
+                pd.concat(results['gene_metrics']).auroc.values)
+    for serial_auroc, prefetch_auroc in aurocs.values():
+        assert np.array_equal(serial_auroc, prefetch_auroc)
+
+
+def test_screening():
+    """Test that screening features doesn't change the prox solver results"""
+    rng = np.random.default_rng(cfg.default_seed)
+    X = rng.standard_normal((200, 500))
+    y = (X[:, :10].sum(axis=1) + rng.standard_normal(200) > 0).astype(int)
+    alphas = np.repeat(cfg.alphas, len(cfg.l1_ratios)) / 10
+    l1_ratios = np.tile(cfg.l1_ratios, len(cfg.alphas))
+    Y = np.tile(y[:, np.newaxis], (1, alphas.shape[0]))
+    sample_weight = su.get_balanced_weights(Y)
+    results = {}
+    for screen in (False, True):
+        results[screen] = su.fit_logistic_enet(
+            X, Y, sample_weight, alphas, l1_ratios, tol=1e-6, screen=screen)
+    coef, intercept, _ = results[True]
+    assert np.allclose(coef, results[False][0], atol=1e-3)
+    assert np.allclose(intercept, results[False][1], atol=1e-3)
+    # KKT conditions should hold for features with zero coefficients
+    R = sample_weight * (1 / (1 + np.exp(-(X @ coef + intercept))) - Y)
+    loss_grad = np.abs(X.T @ R)
+    assert np.all((coef != 0) | (loss_grad <= 1.01 * alphas * l1_ratios))
+
+def test_sparse_covariates():
+    """Test that sparse covariates give the same prox solver results"""
+    rng = np.random.default_rng(cfg.default_seed)
+    samples = ['sample{}'.format(i) for i in range(200)]
+    X_df = pd.DataFrame(rng.standard_normal((200, 50)), index=samples)
+    X_df.columns = X_df.columns.astype(str)
+    y_df = pd.DataFrame({
+        'DISEASE': rng.choice(['BRCA', 'LUAD', 'SKCM'], 200),
+        'log10_mut': rng.standard_normal(200),
+    }, index=samples)
+    y = ((X_df.iloc[:, :3].sum(axis=1) + (y_df.DISEASE == 'SKCM') +
+          rng.standard_normal(200)) > 0.5).astype(int)
+    _, X_sparse_df, _, gene_features = tu.align_matrices(
+        X_df, y_df, sparse_covariates=True)
+    _, X_dense_df, _, _ = tu.align_matrices(
+        X_df, y_df, sparse_covariates=False)
+
+    # cancer type covariates should be sparse columns at the end
+    is_sparse = [isinstance(dtype, pd.SparseDtype) for dtype in X_sparse_df.dtypes]
+    assert is_sparse == [False] * 51 + [True] * 3
+    assert gene_features.sum() == 50
+    X = su.get_design_matrix(X_sparse_df)
+    assert isinstance(X, su.HybridDesignMatrix)
+    X_dense = X_dense_df.reindex(X_sparse_df.columns, axis='columns').values
+    assert np.array_equal(X.toarray(), X_dense)
+    W = rng.standard_normal((X.shape[1], 2))
+    R = rng.standard_normal((X.shape[0], 2))
+    assert np.allclose(X @ W, X_dense @ W)
+    assert np.allclose(X.T @ R, X_dense.T @ R)
+    assert np.array_equal(X[::2, [0, 50, 52]].toarray(),
+                          X_dense[::2][:, [0, 50, 52]])
+
+    # coefficients should be the same, in the same order as the columns
+    coef_dfs = []
+    for X_train_df in (X_sparse_df, X_dense_df):
+        cv_pipeline, *_ = cu.train_model(
+            X_train_df, X_train_df, pd.DataFrame({'status': y}),
+            alphas=[0.01], l1_ratios=[0.15], seed=cfg.default_seed,
+            solver='prox')
+        coef_dfs.append(cu.extract_coefficients(
+            cv_pipeline, X_train_df.columns, 'signal', cfg.default_seed
+        ).set_index('feature'))
+    assert np.allclose(coef_dfs[0].weight,
+                       coef_dfs[1].weight.reindex(coef_dfs[0].index))
+    assert coef_dfs[0].loc['SKCM', 'weight'] > 0
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+def test_streaming(data_model, data_type):
+    """Test preprocessing and training on batches from a memory map"""
+    tcga_data, sample_info_df = data_model
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+
+    # preprocessing in batches should match in-memory preprocessing
+    X = stream.ExperimentMatrix(
+        stream.get_data_store(tcga_data, batch_size=16),
+        tcga_data.data_df,
+        tcga_data.X_df,
+        tcga_data.gene_features
+    )
+    assert X.shape == tcga_data.X_df.shape
+    assert np.allclose(X[np.arange(X.shape[0])], tcga_data.X_df.values)
+    fold_assignments = cu.get_cv_fold_assignments(tcga_data, gene,
+                                                  sample_info_df, 4)
+    train_ixs, test_ixs = cu.get_fold_ixs(fold_assignments, 0)
+    X_train_df, X_test_df = tu.preprocess_data(
+        tcga_data.X_df.iloc[train_ixs], tcga_data.X_df.iloc[test_ixs],
+        tcga_data.gene_features, standardize_columns=True,
+        subset_mad_genes=50)
+    scaler = stream.get_fold_scaler(X, train_ixs, tcga_data.gene_features,
+                                    standardize_columns=True,
+                                    subset_mad_genes=50, batch_size=16)
+    assert np.array_equal(tcga_data.X_df.columns[scaler.feature_ixs],
+                          X_train_df.columns)
+    assert np.allclose(scaler.fit(X, train_ixs).transform(X[train_ixs]),
+                       X_train_df.values)
+    assert np.allclose(scaler.fit(X, test_ixs).transform(X[test_ixs]),
+                       X_test_df.values)
+
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False,
+                                   output_preds=True,
+                                   solver='stream')
+    metrics_df = pd.concat(results['gene_metrics'])
+    n_candidates = len(cfg.alphas) * len(cfg.l1_ratios)
+    assert metrics_df.shape[0] == 4 * 3
+    assert (metrics_df.n_fits == cfg.folds * n_candidates + 1).all()
+    assert metrics_df.auroc.notna().all()
+    preds_df = pd.concat(results['gene_preds'])
+    assert preds_df.shape[0] == tcga_data.X_df.shape[0]
+    # the store is written once per data model, and shared with copies
+    assert stream.get_data_store(copy.copy(tcga_data)) is X.store
+
+def test_shared_array():
+    """Test that shared training data isn't serialized for each task"""
+    rng = np.random.default_rng(cfg.default_seed)
+    X = rng.standard_normal((100, 50))
+    y = np.tile([0, 1], 50)
+    estimator = cu.get_sgd_estimator(cfg.default_seed)
+    splits = list(StratifiedKFold(n_splits=3).split(X, y))
+    with su.shared_array(X, n_jobs=2, min_bytes=0) as X_shared:
+        assert np.array_equal(X_shared, X)
+        n_bytes = {}
+        for name, X_task in [('copied', X), ('shared', X_shared)]:
+            tasks = [(estimator, X_task, y, train_ixs, valid_ixs, {})
+                     for train_ixs, valid_ixs in splits]
+            n_bytes[name] = su.get_serialized_bytes(tasks, n_jobs=2,
+                                                    max_nbytes=np.inf)
+    assert n_bytes['copied'] - n_bytes['shared'] >= 3 * X.nbytes
+    # nothing is serialized if tasks run in the current process
+    assert su.get_serialized_bytes(tasks, n_jobs=1) == 0
+    with su.shared_array(X, n_jobs=1, min_bytes=0) as X_shared:
+        assert X_shared is X
+
+
+def test_resource_config():
+    """Test that the core budget is split between processes and threads."""
+    try:
+        assert ru.set_core_budget(4) == 4
+        assert ru.get_n_jobs() == 4
+        # no more processes than tasks, remaining cores go to threads
+        assert ru.get_n_jobs(2) == 2
+        assert ru.get_threads_per_job(2) == 2
+        assert ru.get_threads_per_job(8) == 1
+        info = ru.get_resource_info(n_tasks=30, n_workers=2)
+        assert info['cores_per_worker'] == 2
+        assert info['n_jobs'] == 2
+        assert info['threads_per_job'] == 1
+    finally:
+        ru.set_core_budget(None)
+
+
+def test_config_filenames(tmp_path):
+    """Test that non-default solver options get their own results files."""
+    model_options = Namespace(training_data='expression',
+                              seed=42,
+                              n_dim=None,
+                              solver=cfg.default_solver,
+                              search=cfg.default_search,
+                              warm_start=False)
+    check_file = fu.check_output_file(tmp_path, 'TP53', False, model_options)
+    assert check_file.name == 'TP53_expression_signal_s42_coefficients.tsv.gz'
+    check_file.touch()
+    with pytest.raises(ResultsFileExistsError):
+        fu.check_output_file(tmp_path, 'TP53', False, model_options)
+    model_options.solver = 'path'
+    model_options.warm_start = True
+    check_file = fu.check_output_file(tmp_path, 'TP53', False, model_options)
+    assert check_file.name == (
+        'TP53_expression_signal_s42_solverpath_warmstart_coefficients.tsv.gz'
+    )
+
+    # compression fit within folds is kept separate from precomputed
+    # compressed data with the same number of dimensions
+    model_options = Namespace(training_data='expression',
+                              seed=42,
+                              n_dim=10,
+                              fold_compression=False)
+    check_file = fu.check_output_file(tmp_path, 'TP53', False, model_options)
+    assert check_file.name == 'TP53_expression_signal_s42_n10_coefficients.tsv.gz'
+    check_file.touch()
+    model_options.fold_compression = True
+    check_file = fu.check_output_file(tmp_path, 'TP53', False, model_options)
+    assert check_file.name == (
+        'TP53_expression_signal_s42_n10_foldcmp_coefficients.tsv.gz'
+    )
+    fu.save_model_options(tmp_path, model_options)
+    assert Path(tmp_path,
+                'expression_s42_foldcmp_model_options.pkl').exists()
+
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+@pytest.mark.parametrize('fold_compression', [False, True])
+def test_model_artifacts(data_type, fold_compression, tmp_path):
+    """Test that saved models reproduce test set predictions"""
+    tcga_data = TCGADataModel(training_data=data_type,
+                              fold_compression=fold_compression,
+                              n_dim=10,
+                              debug=True, test=True)
+    sample_info_df = du.load_sample_info(train_data_type=data_type)
+    gene, classification = tcfg.stratified_gene_info[0]
+    tcga_data.process_data_for_gene(gene,
+                                    classification,
+                                    gene_dir=None,
+                                    shuffle_labels=False)
+    results = cu.run_cv_stratified(tcga_data,
+                                   'gene',
+                                   gene,
+                                   data_type,
+                                   sample_info_df,
+                                   num_folds=4,
+                                   standardize_columns=True,
+                                   shuffle_labels=False,
+                                   output_preds=True)
+    mu.save_model_artifacts(tmp_path / 'model.npz', results['gene_model'])
+    artifacts = mu.load_model_artifacts(tmp_path / 'model.npz')
+    assert list(artifacts.keys()) == [0, 1, 2, 3]
+
+    preds_df = pd.concat(results['gene_preds'])
+    coef_df = pd.concat(results['gene_coef'])
+    for fold_no, artifact in artifacts.items():
+        assert artifact['identifier'] == gene
+        fold_coef_df = coef_df[(coef_df.fold == fold_no) &
+                               (coef_df.weight != 0)]
+        assert artifact['coef_ix'].shape[0] == fold_coef_df.shape[0]
+        # test sets are standardized independently, so we refit the scaler
+        # to reproduce the saved predictions
+        fold_preds_df = preds_df[preds_df.fold_no == fold_no]
+        y_pred = mu.decision_function(artifact,
+                                      tcga_data.X_df.loc[fold_preds_df.index],
+                                      refit_scaler=True)
+        assert np.allclose(1 / (1 + np.exp(-y_pred)),
+                           fold_preds_df.positive_prob.values)
+
+
+@pytest.mark.parametrize('data_type', [tcfg.test_data_types[0]])
+@pytest.mark.parametrize('fold_compression', [False, True])
+def test_model_stack(data_type, fold_compression, tmp_path):
+    """Test that stacked models get the same predictions as each model"""
+    tcga_data = TCGADataModel(training_data=data_type,
+                              fold_compression=fold_compression,
+                              n_dim=10,
+                              debug=True, test=True)
+    sample_info_df = du.load_sample_info(train_data_type=data_type)
+    artifacts = []
+    for gene, classification in tcfg.stratified_gene_info[:2]:
+        tcga_data.process_data_for_gene(gene,
+                                        classification,
+                                        gene_dir=None,
+                                        shuffle_labels=False)
+        results = cu.run_cv_stratified(tcga_data,
+                                       'gene',
+                                       gene,
+                                       data_type,
+                                       sample_info_df,
+                                       num_folds=4,
+                                       standardize_columns=True,
+                                       shuffle_labels=False)
+        artifacts += results['gene_model']
+    stack = mu.ModelStack(artifacts)
+    X_df = tcga_data.X_df.iloc[:50]
+    # cancer type covariates depend on the gene, missing covariates should
+    # be the same as zeros
+    X_full_df = X_df.reindex(columns=stack.input_features_, fill_value=0)
+
+    # scoring in chunks from a file gives the same results as scoring each
+    # model on its own, for both ways of standardizing the input
+    X_df.to_csv(tmp_path / 'X.tsv', sep='\t')
+    for standardize in ['train', 'input']:
+        y_pred_df = stack.decision_function(tmp_path / 'X.tsv',
+                                            chunk_size=7,
+                                            standardize=standardize)
+        assert y_pred_df.index.equals(X_df.index)
+        for model_ix, artifact in enumerate(artifacts):
+            assert np.allclose(
+                y_pred_df.iloc[:, model_ix].values,
+                mu.decision_function(artifact, X_full_df,
+                                     refit_scaler=(standardize == 'input'))
+            )
+
+    # probabilities are averaged over the models for each fold
+    probs_df = stack.predict_proba(X_df, chunk_size=7)
+    gene = tcfg.stratified_gene_info[0][0]
+    assert probs_df.shape == (X_df.shape[0], 2)
+    assert np.allclose(
+        probs_df.loc[:, gene].values,
+        np.mean([1 / (1 + np.exp(-mu.decision_function(artifact, X_full_df)))
+                   for artifact in artifacts
+                   if artifact['identifier'] == gene], axis=0)
+    )
+
+    # models are only stacked with models trained with the same
+    # configuration (models saved without one use the base configuration)
+    model_options = Namespace(solver='path', n_dim=None)
+    gene_artifacts = [artifact for artifact in artifacts
+                        if artifact['identifier'] == gene]
+    mu.save_model_artifacts(tmp_path / 'model.npz', [
+        dict(artifact, **mu.get_model_config(model_options))
+            for artifact in gene_artifacts
+    ])
+    with pytest.raises(ValueError):
+        mu.load_model_stack([tmp_path / 'model.npz'])
+    path_stack = mu.load_model_stack([tmp_path / 'model.npz'],
+                                     model_config={'solver': 'path'})
+    assert path_stack.n_models == len(gene_artifacts)
+
+    # models that can't use any of the input features raise an error,
+    # rather than just predicting their intercept
+    X_other_df = X_df.set_axis(
+        ['other_{}'.format(ix) for ix in range(X_df.shape[1])], axis=1)
+    with pytest.raises(ValueError, match='None of the input features'):
+        stack.predict_proba(X_other_df)
+
+
+def test_gram_solver():
+    """Test coordinate descent solution and covariance cache reuse"""
+    rng = np.random.default_rng(cfg.default_seed)
+    X = rng.standard_normal((200, 30))
+    y = (X[:, :3].sum(axis=1) + rng.standard_normal(200) > 1).astype(int)
+
+    # check the KKT conditions for the quadratic problem at each alpha
+    cache = su.GramCache(X, n_folds=3)
+    sample_weight = su.get_balanced_weights(y[:, np.newaxis])[:, 0]
+    grad = X.T @ (sample_weight * (0.5 - y))
+    l1_ratio = 0.5
+    for alpha, coef, _ in su.fit_quadratic_enet(
+            lambda cols: cache.get_block(cols) / 4,
+            lambda cols, w: cache.dot(cols, w) / 4,
+            grad, [0.01, 0.03, 0.1], l1_ratio, tol=1e-12):
+        H = np.cov(X, rowvar=False, bias=True) / 4
+        smooth_grad = grad + H @ coef + alpha * (1 - l1_ratio) * coef
+        nz = coef != 0
+        assert nz.any()
+        assert np.allclose(smooth_grad[nz],
+                           -alpha * l1_ratio * np.sign(coef[nz]), atol=1e-5)
+        assert np.all(np.abs(smooth_grad[~nz]) <= alpha * l1_ratio + 1e-8)
+
+    # fitting another target with the same cache doesn't need any more
+    # covariance columns, and gets the same results as a new cache
+    search = su.GramPathCV(alphas=cfg.alphas,
+                           l1_ratios=cfg.l1_ratios,
+                           n_folds=3,
+                           gram_cache=cache).fit(X, y)
+    n_columns = cache.n_cached
+    search = su.GramPathCV(alphas=cfg.alphas,
+                           l1_ratios=cfg.l1_ratios,
+                           n_folds=3,
+                           gram_cache=cache).fit(X, 1 - y)
+    assert cache.n_cached == n_columns
+    new_search = su.GramPathCV(alphas=cfg.alphas,
+                               l1_ratios=cfg.l1_ratios,
+                               n_folds=3).fit(X, 1 - y)
+    assert search.best_params_ == new_search.best_params_
+    assert np.allclose(search.decision_function(X),
+                       new_search.decision_function(X))
+
+    # covariances for an inner split's training rows are derived from the
+    # stored validation blocks
+    train_ixs = cache.get_train_ixs(0)
+    cols = np.arange(5)
+    assert np.allclose(cache.get_block(cols, split_ix=0),
+                       np.cov(X[train_ixs][:, cols], rowvar=False, bias=True))
+
+    # caches are dropped once they use more than max_bytes, except the
+    # current one
+    X_df = pd.DataFrame(X)
+    cu._gram_caches.clear()
+    first = cu.get_gram_cache(X_df, 3, cfg.default_seed, max_bytes=1e9)
+    assert cu.get_gram_cache(X_df.copy(), 3, cfg.default_seed) is first
+    cu.get_gram_cache(X_df.iloc[:100], 3, cfg.default_seed,
+                      max_bytes=first.nbytes)
+    assert len(cu._gram_caches) == 1
+    cu._gram_caches.clear()
@@ -0,0 +1,74 @@
+"""
+Test cases for data preprocessing code in tcga_utilities.py
+"""
+import pytest
+import numpy as np
+import pandas as pd
+
+import mpmp.utilities.barcode_utilities as bu
+import mpmp.utilities.tcga_utilities as tu
+
+@pytest.mark.parametrize('seed', [1, 42])
+def test_subsample_to_smallest(seed):
+    """Test that subsampling gives balanced cancer types"""
+    cancer_types = np.array(['BRCA'] * 50 + ['LUAD'] * 20 + ['GBM'] * 7 +
+                            [np.nan] * 3, dtype='object')
+    np.random.default_rng(seed).shuffle(cancer_types)
+    ss_ixs = tu.subsample_to_smallest_cancer_type(cancer_types, seed)
+
+    # indexes should be sorted and unique, and missing values excluded
+    assert np.array_equal(ss_ixs, np.unique(ss_ixs))
+    ss_counts = pd.Series(cancer_types[ss_ixs]).value_counts(dropna=False)
+    assert ss_counts.to_dict() == {'BRCA': 7, 'LUAD': 7, 'GBM': 7}
+
+    # same seed should give the same subsample, for codes or labels
+    codes, _ = pd.factorize(cancer_types)
+    assert np.array_equal(ss_ixs,
+                          tu.subsample_to_smallest_cancer_type(codes, seed))
+
+
+def test_parse_barcodes():
+    """Test parsing of TCGA barcodes into cancer type/sample type"""
+    sample_ids = ['TCGA-02-0047-01', 'TCGA-02-0055-11', 'TCGA-A1-A0SB-01',
+                  'TCGA-ZZ-0001-06']
+    sampletype_codes_dict = {'01': 'Primary Solid Tumor',
+                             '11': 'Solid Tissue Normal'}
+    cancertype_codes_dict = {'02': 'GBM', 'A1': 'BRCA'}
+    barcode_df = bu.parse_barcodes(sample_ids,
+                                   sampletype_codes_dict,
+                                   cancertype_codes_dict)
+    assert barcode_df.sample_id.tolist() == sample_ids
+    assert barcode_df.participant.tolist() == ['0047', '0055', 'A0SB', '0001']
+    # codes that aren't in the code dicts should be left as is
+    assert barcode_df.cancer_type.tolist() == ['GBM', 'GBM', 'BRCA', 'ZZ']
+    assert barcode_df.sample_type.tolist() == ['Primary Solid Tumor',
+                                               'Solid Tissue Normal',
+                                               'Primary Solid Tumor',
+                                               '06']
+    assert barcode_df.id_for_stratification.tolist() == [
+        'GBMPrimary Solid Tumor', 'GBMSolid Tissue Normal',
+        'BRCAPrimary Solid Tumor', 'ZZ06'
+    ]
+
+    # second call should hit the cache, and return an equal copy
+    cached_df = bu.parse_barcodes(sample_ids,
+                                  sampletype_codes_dict,
+                                  cancertype_codes_dict)
+    pd.testing.assert_frame_equal(barcode_df, cached_df)
+    assert cached_df is not barcode_df
+
+    # missing sample IDs shouldn't be mapped to another code's description
+    missing_df = bu.parse_barcodes(sample_ids + [None],
+                                   sampletype_codes_dict,
+                                   cancertype_codes_dict)
+    assert missing_df.cancer_type.tolist()[:-1] == ['GBM', 'GBM', 'BRCA', 'ZZ']
+    assert missing_df.cancer_type.isna().tolist() == [False] * 4 + [True]
+    assert missing_df.sample_type.isna().tolist() == [False] * 4 + [True]
+
+
+def test_recode_stratification_ids():
+    """Test that rare stratification IDs are recoded"""
+    ids = ['a', 'a', 'a', 'b', 'b', 'c']
+    recoded_ids, counts = bu.recode_stratification_ids(ids, min_count=3)
+    assert recoded_ids.tolist() == ['a', 'a', 'a', 'other', 'other', 'other']
+    assert counts.tolist() == [3, 3, 3, 2, 2, 1]